@@ -0,0 +1,165 @@
+"""
+Compare the asyncio, gevent and threaded telnet backends.
+
+For each backend a server is started in its own process (gevent needs
+monkey patching, which must not leak into the other servers), then the
+given number of clients connect and wait for the prompt, and then each
+runs a command with all the sessions open.  Reported are the accept
+rate (connections brought up to the prompt per second), the command
+rate, the growth of the server's resident memory per idle session and
+the server's thread count.
+
+    python benchmarks/bench_backends.py --connections 1000,10000
+
+Linux only: memory is read from /proc.
+"""
+
+import argparse
+import asyncio
+import re
+import resource
+import subprocess
+import sys
+import time
+
+PROMPT = b'Telnet Server> '
+IAC, DONT, DO, WONT, WILL, ECHO, SGA = b'\xff', b'\xfe', b'\xfd', b'\xfc', b'\xfb', b'\x01', b'\x03'
+
+
+def serve_aio():
+    import asyncio
+    from telnetsrv.aio import TelnetHandler
+
+    async def main():
+        server = await asyncio.get_running_loop().create_server(TelnetHandler, '127.0.0.1', 0)
+        print(server.sockets[0].getsockname()[1], flush=True)
+        await server.serve_forever()
+    asyncio.run(main())
+
+
+def serve_green():
+    from gevent import monkey; monkey.patch_all()
+    import gevent.server
+    from telnetsrv.green import TelnetHandler
+    server = gevent.server.StreamServer(('127.0.0.1', 0), TelnetHandler.streamserver_handle, backlog=4096)
+    server.start()
+    print(server.server_port, flush=True)
+    server.serve_forever()
+
+
+def serve_threaded():
+    from telnetsrv.threaded import TelnetHandler, TelnetServer
+
+    class TelnetServer(TelnetServer):
+        request_queue_size = 4096
+    server = TelnetServer(('127.0.0.1', 0), TelnetHandler)
+    print(server.server_address[1], flush=True)
+    server.serve_forever()
+
+
+SERVERS = {
+    'aio': serve_aio,
+    'green': serve_green,
+    'threaded': serve_threaded,
+}
+
+
+def proc_status(pid, field):
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+
+
+def rss_kb(pid):
+    return proc_status(pid, 'VmRSS')
+
+
+def answer_options(data):
+    """Answer the server's option requests as a plain client would:
+    let it echo and suppress go-ahead, refuse everything else"""
+    answers = []
+    for cmd, opt in re.findall(b'\xff([\xfb\xfd])(.)', data, re.S):
+        if cmd == WILL:
+            answers.append(IAC + (DO if opt in (ECHO, SGA) else DONT) + opt)
+        else:
+            answers.append(IAC + WONT + opt)
+    return b''.join(answers)
+
+
+async def open_session(port, sessions):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    data = await reader.read(1024)
+    writer.write(answer_options(data))
+    if PROMPT not in data:
+        await reader.readuntil(PROMPT)
+    sessions.append((reader, writer))
+
+
+async def run_command(reader, writer):
+    writer.write(b'help\r\n')
+    await reader.readuntil(PROMPT)
+
+
+async def run_commands(sessions):
+    start = time.perf_counter()
+    await asyncio.gather(*[run_command(reader, writer) for reader, writer in sessions])
+    return time.perf_counter() - start
+
+
+async def run_clients(port, connections, concurrency):
+    sessions = []
+    pending = set()
+    start = time.perf_counter()
+    for _ in range(connections):
+        if len(pending) >= concurrency:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        pending.add(asyncio.ensure_future(open_session(port, sessions)))
+    await asyncio.gather(*pending)
+    return sessions, time.perf_counter() - start
+
+
+def bench(backend, connections, concurrency):
+    proc = subprocess.Popen([sys.executable, __file__, '--serve', backend], stdout=subprocess.PIPE)
+    try:
+        port = int(proc.stdout.readline())
+        time.sleep(0.5)
+        base = rss_kb(proc.pid)
+
+        async def main():
+            sessions, elapsed = await run_clients(port, connections, concurrency)
+            used = rss_kb(proc.pid) - base
+            threads = proc_status(proc.pid, 'Threads')
+            commands = await run_commands(sessions)
+            for reader, writer in sessions:
+                writer.close()
+            return elapsed, used, threads, commands
+        elapsed, used, threads, commands = asyncio.run(main())
+    finally:
+        proc.kill()
+        proc.wait()
+    print('%-8s %6d sessions  %8.1f sessions/s  %8.1f commands/s  %6.1f KiB/session  %4d threads' % (
+        backend, connections, connections / elapsed, connections / commands, used / float(connections), threads))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--connections', default='1000', help='comma separated session counts')
+    parser.add_argument('--concurrency', type=int, default=200,
+                        help='connections being set up at the same time')
+    parser.add_argument('--backends', default='aio,green,threaded')
+    parser.add_argument('--serve', choices=sorted(SERVERS), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    if args.serve:
+        SERVERS[args.serve]()
+        return
+    for connections in args.connections.split(','):
+        for backend in args.backends.split(','):
+            bench(backend, int(connections), args.concurrency)
+
+
+if __name__ == '__main__':
+    main()
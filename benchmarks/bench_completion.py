@@ -0,0 +1,66 @@
+"""
+Command completion and abbreviation lookup on a large command set.
+
+Builds a handler class with the given number of commands, named like
+those of a router CLI, then times completing command name prefixes
+and resolving abbreviations, per lookup.  A 4 character prefix matches
+about a tenth of the commands.
+
+    python benchmarks/bench_completion.py --commands 10000
+"""
+
+import argparse
+import random
+import time
+from telnetsrv.telnetsrvlib import TelnetHandlerBase
+
+VERBS = ['show', 'set', 'clear', 'debug', 'ping', 'trace', 'copy', 'reload', 'write', 'no']
+NOUNS = ['interface', 'route', 'bgp', 'ospf', 'vlan', 'arp', 'log', 'user', 'acl', 'qos']
+
+
+class CompletionHandler(TelnetHandlerBase):
+    """A handler with no connection."""
+    def __init__(self):
+        self.init_session()
+
+
+def make_handler(count):
+    def cmd(self, params):
+        """
+        A generated command.
+        """
+    names = ['%s_%s_%d' % (VERBS[i % len(VERBS)], NOUNS[i // len(VERBS) % len(NOUNS)], i)
+             for i in range(count)]
+    cls = type('Handler%d' % count, (CompletionHandler, ), dict(('cmd' + name.upper(), cmd) for name in names))
+    return cls(), names
+
+
+def per_call(fn, args):
+    start = time.perf_counter()
+    for arg in args:
+        fn(arg)
+    return (time.perf_counter() - start) / len(args) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--commands', type=int, default=10000)
+    parser.add_argument('--lookups', type=int, default=2000)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    handler, names = make_handler(args.commands)
+    print('%d commands, index built with the class in %.1f ms' % (
+        args.commands, (time.perf_counter() - start) * 1e3))
+    random.seed(1)
+    picks = [random.choice(names) for _ in range(args.lookups)]
+    for length in (4, 8, 12):
+        prefixes = [name[:length].encode() for name in picks]
+        print('complete %2d char prefix   %8.1f us' % (length, per_call(handler.complete, prefixes)))
+    print('resolve full name         %8.1f us' % per_call(handler.COMMANDS.resolve, [n.upper() for n in picks]))
+    prefixes = [name.upper()[:12] for name in picks]
+    print('resolve 12 char prefix    %8.1f us' % per_call(handler.COMMANDS.resolve, prefixes))
+
+
+if __name__ == '__main__':
+    main()
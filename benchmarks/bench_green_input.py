@@ -0,0 +1,89 @@
+"""
+Greenlet switches and throughput of the green handler's input path.
+
+A feeder greenlet plays the input cooker, feeding lines in blocks
+(one line per block by default, like a scripted client), while a
+reader greenlet reads them with readline.  The chunked cooked queue is
+compared with one queue item per byte.
+
+    python benchmarks/bench_green_input.py
+"""
+
+import argparse
+import time
+import gevent
+import gevent.queue
+import greenlet
+from telnetsrv.green import TelnetHandler
+from telnetsrv.utils import chr_py3
+
+
+class CountingQueue(gevent.queue.Queue):
+    """A queue counting the items put in it."""
+    items = 0
+
+    def put(self, item, *args, **kwargs):
+        self.items += 1
+        gevent.queue.Queue.put(self, item, *args, **kwargs)
+
+
+class ChunkedHandler(TelnetHandler):
+    """A green handler with no connection."""
+    def __init__(self):
+        self.init_session()
+        self.cookedq = CountingQueue()
+        self.sock = None
+        self.DOECHO = False
+
+
+class PerByteHandler(ChunkedHandler):
+    """The previous queueing: one queue item per byte."""
+    def inputcooker_store_queue(self, char):
+        for v in char:
+            self.cookedq.put(chr_py3(v))
+
+
+def run(handler_class, data, lines, block):
+    handler = handler_class()
+    switches = [0]
+
+    def trace(event, args):
+        if event == 'switch':
+            switches[0] += 1
+
+    def feeder():
+        for i in range(0, len(data), block):
+            handler.inputcooker_feed(data[i:i + block])
+            gevent.sleep(0)
+
+    def reader():
+        for _ in range(lines):
+            handler.readline(echo=False, use_history=False)
+
+    start = time.perf_counter()
+    old_trace = greenlet.settrace(trace)
+    try:
+        gevent.joinall([gevent.spawn(reader), gevent.spawn(feeder)])
+    finally:
+        greenlet.settrace(old_trace)
+    return switches[0], handler.cookedq.items, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--lines', type=int, default=20000)
+    parser.add_argument('--length', type=int, default=80, help='characters per line')
+    parser.add_argument('--block', type=int, default=0, help='bytes per feed (default: one line)')
+    args = parser.parse_args()
+
+    line = b'x' * args.length + b'\r\n'
+    data = line * args.lines
+    for handler_class in (PerByteHandler, ChunkedHandler):
+        switches, items, elapsed = run(handler_class, data, args.lines, args.block or len(line))
+        print('%-15s %8.2f switches/line  %8.2f queue items/line  %10.0f lines/s' % (
+            handler_class.__name__, switches / float(args.lines), items / float(args.lines),
+            args.lines / elapsed))
+
+
+if __name__ == '__main__':
+    main()
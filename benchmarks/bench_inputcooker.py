@@ -0,0 +1,51 @@
+"""
+Input cooker throughput.
+
+Feeds 1 MB of plain text and 1 MB of IAC-dense data (every fourth
+byte an escaped IAC) through TelnetHandlerBase.inputcooker_feed, in
+blocks of the old 20 byte recv size and of RECV_SIZE.
+
+    python benchmarks/bench_inputcooker.py
+"""
+
+import argparse
+import time
+from telnetsrv.telnetsrvlib import TelnetHandlerBase, IAC
+
+
+class CookerHandler(TelnetHandlerBase):
+    """A handler with no connection that discards the cooked input."""
+    def __init__(self):
+        self.init_session()
+        self.sock = None
+
+    def inputcooker_store_queue(self, char):
+        pass
+
+
+def feed(data, block):
+    handler = CookerHandler()
+    start = time.perf_counter()
+    for i in range(0, len(data), block):
+        handler.inputcooker_feed(data[i:i + block])
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', type=int, default=1 << 20, help='bytes of input')
+    args = parser.parse_args()
+
+    line = b'set interface eth0 description "uplink to core"\r\n'
+    inputs = {
+        'plain': (line * (args.size // len(line) + 1))[:args.size],
+        'iac-dense': (b'ab' + IAC + IAC) * (args.size // 4),
+    }
+    for name, data in sorted(inputs.items()):
+        for block in (20, TelnetHandlerBase.RECV_SIZE):
+            elapsed = feed(data, block)
+            print('%-10s block %6d  %8.2f MB/s' % (name, block, len(data) / elapsed / 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Output cooking throughput and memory.
+
+Writes a large log (plain text, and text with an IAC in every line)
+through a handler with no connection, comparing the previous write
+path with write and writestream.  Reports MB/s and the peak memory
+allocated while writing.
+
+    python benchmarks/bench_output_cooker.py
+"""
+
+import argparse
+import io
+import time
+import tracemalloc
+from telnetsrv.telnetsrvlib import TelnetHandlerBase, IAC
+from telnetsrv.utils import chr_py3, str_to_bytes
+
+
+class SinkHandler(TelnetHandlerBase):
+    """A handler with no connection that discards the cooked output."""
+    def __init__(self):
+        self.init_session()
+        self.sock = None
+
+    def output_ready(self):
+        while self.outq:
+            self.output_sent(len(self.outq.popleft()))
+
+
+class TwoPassHandler(SinkHandler):
+    """The previous write path: two replaces, then copied through the buffer."""
+    def write(self, text):
+        text = str_to_bytes(text)
+        text = text.replace(IAC, IAC+IAC)
+        text = text.replace(chr_py3(10), chr_py3(13) + chr_py3(10))
+        self.outbuf += text
+        self.flush()
+
+
+def run(handler_class, method, data):
+    handler = handler_class()
+    tracemalloc.start()
+    start = time.perf_counter()
+    if method == 'writestream':
+        handler.writestream(io.BytesIO(data))
+    else:
+        handler.write(data)
+    handler.flush()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', type=int, default=32 << 20, help='bytes of output')
+    args = parser.parse_args()
+
+    line = b'2024-01-01 00:00:00 eth0 link up, 1000 Mb/s full duplex, flow control off\n'
+    iac_line = line[:20] + IAC + line[21:]
+    inputs = {
+        'plain': (line * (args.size // len(line) + 1))[:args.size],
+        'iac': (iac_line * (args.size // len(iac_line) + 1))[:args.size],
+    }
+    for name, data in sorted(inputs.items()):
+        for handler_class, method in ((TwoPassHandler, 'write'), (SinkHandler, 'write'),
+                                      (SinkHandler, 'writestream')):
+            elapsed, peak = run(handler_class, method, data)
+            print('%-6s %-15s %-12s %8.1f MB/s  peak %8.1f MB' % (
+                name, handler_class.__name__, method, len(data) / elapsed / 1e6, peak / 1e6))
+
+
+if __name__ == '__main__':
+    main()
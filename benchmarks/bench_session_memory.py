@@ -0,0 +1,156 @@
+"""
+Memory per idle session.
+
+For each backend a server is started in its own process with
+tracemalloc on, and the given number of clients connect, answer the
+option requests and wait for the prompt.  The server is then signalled
+to report the Python memory it has allocated; the growth over the same
+report taken with a single session open, divided by the number of
+sessions, is what each idle session costs the server.  Memory held by
+the kernel (socket buffers) and by the interpreter's own free lists is
+not counted; see bench_backends.py for resident memory.
+
+    python benchmarks/bench_session_memory.py --connections 1000
+
+Also reported are the biggest allocation sites in the server, grouped
+by source line, with --top.
+"""
+
+import argparse
+import asyncio
+import os
+import resource
+import signal
+import subprocess
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_backends import open_session    # noqa: E402
+
+TOP = 0
+
+
+def report():
+    """Print the traced memory, then the biggest allocation sites"""
+    snapshot = tracemalloc.take_snapshot()
+    lines = ['%d' % sum(stat.size for stat in snapshot.statistics('filename'))]
+    for stat in snapshot.statistics('lineno')[:TOP]:
+        frame = stat.traceback[0]
+        lines.append('    %9d B %7d blocks  %s:%d' % (
+            stat.size, stat.count, os.path.relpath(frame.filename), frame.lineno))
+    print('\n'.join(lines) + '\n', flush=True)
+
+
+def serve_aio():
+    import asyncio
+    from telnetsrv.aio import TelnetHandler
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGUSR1, report)
+        server = await loop.create_server(TelnetHandler, '127.0.0.1', 0, backlog=4096)
+        print(server.sockets[0].getsockname()[1], flush=True)
+        await server.serve_forever()
+    asyncio.run(main())
+
+
+def serve_green():
+    from gevent import monkey; monkey.patch_all()
+    import gevent
+    import gevent.server
+    from telnetsrv.green import TelnetHandler
+    gevent.signal_handler(signal.SIGUSR1, report)
+    server = gevent.server.StreamServer(('127.0.0.1', 0), TelnetHandler.streamserver_handle, backlog=4096)
+    server.start()
+    print(server.server_port, flush=True)
+    server.serve_forever()
+
+
+def serve_threaded():
+    from telnetsrv.threaded import TelnetHandler, TelnetServer
+
+    class TelnetServer(TelnetServer):
+        request_queue_size = 4096
+    signal.signal(signal.SIGUSR1, lambda signum, frame: report())
+    server = TelnetServer(('127.0.0.1', 0), TelnetHandler)
+    print(server.server_address[1], flush=True)
+    server.serve_forever()
+
+
+SERVERS = {
+    'aio': serve_aio,
+    'green': serve_green,
+    'threaded': serve_threaded,
+}
+
+
+def read_report(proc):
+    proc.send_signal(signal.SIGUSR1)
+    lines = []
+    while True:
+        line = proc.stdout.readline().decode().rstrip('\n')
+        if not line:
+            break
+        lines.append(line)
+    return int(lines[0]), lines[1:]
+
+
+def bench(backend, connections, concurrency, top):
+    proc = subprocess.Popen([sys.executable, __file__, '--serve', backend, '--top', str(top)],
+                            stdout=subprocess.PIPE)
+    try:
+        port = int(proc.stdout.readline())
+
+        async def main():
+            # One session first, so that the modules and caches it brings
+            # in are not counted
+            sessions = []
+            await open_session(port, sessions)
+            await asyncio.sleep(0.5)
+            base, _ = read_report(proc)
+            pending = set()
+            for _ in range(connections):
+                if len(pending) >= concurrency:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                pending.add(asyncio.ensure_future(open_session(port, sessions)))
+            await asyncio.gather(*pending)
+            # Let the servers finish with the last answers
+            await asyncio.sleep(0.5)
+            used, sites = read_report(proc)
+            for reader, writer in sessions:
+                writer.close()
+            return used - base, sites
+        used, sites = asyncio.run(main())
+    finally:
+        proc.kill()
+        proc.wait()
+    print('%-8s %6d sessions  %8.0f B/session' % (backend, connections, used / float(connections)))
+    for line in sites:
+        print(line)
+
+
+def main():
+    global TOP
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--connections', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=200,
+                        help='connections being set up at the same time')
+    parser.add_argument('--backends', default='aio,green,threaded')
+    parser.add_argument('--top', type=int, default=0, help='allocation sites to list')
+    parser.add_argument('--serve', choices=sorted(SERVERS), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    if args.serve:
+        TOP = args.top
+        tracemalloc.start(25)
+        SERVERS[args.serve]()
+        return
+    for backend in args.backends.split(','):
+        bench(backend, args.connections, args.concurrency, args.top)
+
+
+if __name__ == '__main__':
+    main()
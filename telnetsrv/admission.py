@@ -0,0 +1,134 @@
+"""
+Admission control for new connections.
+
+An Admission is consulted as each connection is accepted, before any
+option negotiation, terminal setup or SSH key exchange.  It turns the
+connection away with a short banner when the server already has too
+many sessions, too many connections still negotiating or logging in,
+or when the connecting address has used up its rate.
+
+Set it as the admission attribute of a handler class; all sessions of
+the class (in one process) share it.
+"""
+
+import collections
+import logging
+import socket
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class Ticket(object):
+    """An admitted connection.  It is pending until established (logged in),
+    and holds its place until released."""
+    def __init__(self, admission):
+        self.admission = admission
+        self.state = 'pending'
+
+    def established(self):
+        """The connection has logged in"""
+        self.admission.move(self, 'session')
+
+    def release(self):
+        """The connection has ended.  May be called more than once."""
+        self.admission.move(self, None)
+
+
+class Admission(object):
+    """Limits the connections a handler class takes on.
+
+    max_sessions limits the connections at once, logged in or not;
+    max_pending those still negotiating or logging in.  rate allows each
+    address that many new connections a second, in bursts of up to
+    burst (rate, and at least one, by default).  Any limit may be None.
+    A connection turned away is sent banner and closed.
+    """
+    # Addresses whose rate is tracked; the longest idle are forgotten first
+    max_sources = 65536
+
+    def __init__(self, max_sessions=None, max_pending=None, rate=None, burst=None,
+                 banner=b"Too many connections, try again later.\r\n"):
+        self.max_sessions = max_sessions
+        self.max_pending = max_pending
+        self.rate = rate
+        if burst is None and rate is not None:
+            burst = max(1, rate)
+        self.burst = burst
+        self.banner = banner
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.sessions = 0
+        # Address: (tokens, time last updated), least recently used first
+        self.buckets = collections.OrderedDict()
+        # Connections turned away, by reason
+        self.rejected = collections.Counter()
+
+    def admit(self, address):
+        """Return a Ticket for a new connection from address, or None if
+        it is to be turned away"""
+        host = address[0] if address else None
+        with self.lock:
+            if self.max_sessions is not None and self.pending + self.sessions >= self.max_sessions:
+                reason = 'sessions'
+            elif self.max_pending is not None and self.pending >= self.max_pending:
+                reason = 'pending'
+            elif self.rate is not None and not self.take_token(host):
+                reason = 'rate'
+            else:
+                self.pending += 1
+                return Ticket(self)
+            self.rejected[reason] += 1
+        log.debug("Turned away %s: too many %s" % (host, reason))
+        return None
+
+    def reject(self, sock):
+        """Send the banner to a connection turned away and close it,
+        without waiting for the client"""
+        try:
+            sock.setblocking(False)
+            sock.send(self.banner)
+        except socket.error:
+            pass
+        try:
+            sock.close()
+        except socket.error:
+            pass
+
+    def stats(self):
+        """Return the connection counts"""
+        with self.lock:
+            return {
+                'pending': self.pending,
+                'sessions': self.sessions,
+                'rejected': dict(self.rejected),
+                'sources': len(self.buckets),
+            }
+
+    def take_token(self, host):
+        now = time.monotonic()
+        bucket = self.buckets.pop(host, None)
+        if bucket is None:
+            tokens = self.burst
+        else:
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        admitted = tokens >= 1
+        if admitted:
+            tokens -= 1
+        self.buckets[host] = (tokens, now)
+        if len(self.buckets) > self.max_sources:
+            self.buckets.popitem(last=False)
+        return admitted
+
+    def move(self, ticket, state):
+        with self.lock:
+            if ticket.state == 'pending':
+                self.pending -= 1
+            elif ticket.state == 'session':
+                self.sessions -= 1
+            if state == 'session' and ticket.state is not None:
+                self.sessions += 1
+            else:
+                state = None
+            ticket.state = state
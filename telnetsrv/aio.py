@@ -0,0 +1,490 @@
+"""
+# Telnet handler concrete class using asyncio
+"""
+
+import asyncio
+import collections
+import logging
+import types
+import weakref
+from telnetsrv.utils import chr_py3, str_to_bytes, is_lines
+from telnetsrv import profiling, telnetsrvlib
+from telnetsrv.telnetsrvlib import TelnetHandlerBase, CommandInterrupted, command
+from telnetsrv.timers import TimerWheel
+
+log = logging.getLogger(__name__)
+
+# The timer wheel shared by the sessions of each event loop
+timer_wheels = weakref.WeakKeyDictionary()
+
+
+async def _aiter(lines):
+    """Iterate over an iterable or an asynchronous iterable"""
+    if hasattr(lines, '__aiter__'):
+        async for line in lines:
+            yield line
+    else:
+        for line in lines:
+            yield line
+
+
+class InputBashLike(telnetsrvlib.InputBashLike):
+    """Bash-like input handling.  Continuation lines are requested by the
+    handler, since reading a line is a coroutine here."""
+    def process(self, line):
+        self.process_line(line)
+
+
+class TelnetHandler(TelnetHandlerBase, asyncio.Protocol):
+    """A telnet server handler using asyncio
+
+    The class is its own protocol factory, so it may be passed directly
+    to loop.create_server.  start_server_handle adapts it for use with
+    asyncio.start_server.
+
+    Incoming data is cooked straight from data_received, so an idle
+    session costs no task switching.  Because reading input must not
+    block the event loop, getc, readline, authentication_ok and handle
+    are coroutines in this class.  Commands may be plain methods or
+    coroutine methods; use a coroutine to await self.readline().
+
+    Each command runs as a task of its own, cancelled when the client
+    interrupts it.  A plain method holding up the event loop cannot be
+    interrupted; mark it executor='thread' to run it on the command
+    executor, where it may write output but not read input.  The
+    session stops waiting for it as soon as it is interrupted.
+
+    Output is queued in the transport.  With the 'block' OUTPUT_POLICY
+    the session stops reading input once OUTPUT_QUEUE_HIGH bytes are
+    waiting, and resumes at OUTPUT_QUEUE_LOW; other tasks writing to
+    the session should await drain().
+    """
+    input_reader = InputBashLike
+    __slots__ = ('transport', 'cookedq', 'cookedbuf', 'cookedpos', 'getc_waiter',
+                 'session_task', 'command_task', 'negotiated', 'drain_waiter')
+
+    def __init__(self, server=None):
+        self.init_session()
+        self.server = server
+        self.request = None
+        self.client_address = None
+        self.transport = None
+        # Cooked input runs (and key codes), read out through a local
+        # buffer, and the coroutine waiting on it, if any
+        self.cookedq = collections.deque()
+        self.cookedbuf = b''
+        self.cookedpos = 0
+        self.getc_waiter = None
+        self.session_task = None
+        # The task running the command, while there is one
+        self.command_task = None
+        # Set once the client has answered the option requests, while
+        # the session waits for that
+        self.negotiated = None
+        # Set while the transport's write buffer is above OUTPUT_QUEUE_HIGH
+        self.drain_waiter = None
+
+    @classmethod
+    async def start_server_handle(cls, reader, writer):
+        """Translate this class for use with asyncio.start_server.  The
+        handler takes over from the streams as the transport's protocol,
+        so it gets the transport's flow control as with create_server."""
+        handler = cls()
+        transport = writer.transport
+        transport.set_protocol(handler)
+        # What the stream read before the handler took over
+        reader.feed_eof()
+        data = await reader.read()
+        handler.connection_made(transport)
+        if handler.session_task is None:
+            # Turned away by admission
+            return
+        if data:
+            handler.data_received(data)
+        await handler.session_task
+
+    # -- asyncio.Protocol interface --
+
+    def connection_made(self, transport):
+        """Start the session for a new connection"""
+        self.transport = transport
+        self.transport.set_write_buffer_limits(self.OUTPUT_QUEUE_HIGH, self.OUTPUT_QUEUE_LOW)
+        self.client_address = transport.get_extra_info('peername')
+        self.request = self._FalseRequest()
+        self.request._sock = transport.get_extra_info('socket')
+        if self.admission is not None:
+            self.request.admission_ticket = self.admission.admit(self.client_address)
+            if self.request.admission_ticket is None:
+                transport.write(self.admission.banner)
+                transport.close()
+                return
+        log.debug("Accepted connection, starting telnet session for {}.".format(self.client_address))
+        self.session_task = asyncio.get_running_loop().create_task(self.session())
+
+    def data_received(self, data):
+        """Cook the incoming data"""
+        self.inputcooker_feed(data)
+        # Send any negotiation replies
+        self.flush()
+
+    def connection_lost(self, exc):
+        """Wake up any reader so the session can end"""
+        self.eof = 1
+        self._wake_getc()
+        self.resume_writing()
+
+    def pause_writing(self):
+        """The client is not keeping up with the output"""
+        self.drain_waiter = asyncio.get_running_loop().create_future()
+        if self.OUTPUT_POLICY == 'block':
+            self.transport.pause_reading()
+
+    def resume_writing(self):
+        """The output is down to OUTPUT_QUEUE_LOW"""
+        if self.drain_waiter is not None:
+            if not self.drain_waiter.done():
+                self.drain_waiter.set_result(None)
+            self.drain_waiter = None
+            if self.OUTPUT_POLICY == 'block' and not self.eof:
+                self.transport.resume_reading()
+
+    async def session(self):
+        """Run the session, as BaseRequestHandler does for blocking backends"""
+        self.setup()
+        try:
+            # Wait for the client to answer the option requests
+            if self.negotiating:
+                self.negotiated = asyncio.Event()
+                try:
+                    await asyncio.wait_for(self.negotiated.wait(), self.NEGOTIATION_TIMEOUT)
+                except asyncio.TimeoutError:
+                    pass
+                self.negotiated = None
+            await self.handle()
+        except EOFError:
+            pass
+        finally:
+            self.finish()
+
+    def negotiation_done(self):
+        TelnetHandlerBase.negotiation_done(self)
+        if self.negotiated is not None:
+            self.negotiated.set()
+
+    def lookup_terminfo(self, term, request):
+        """Read the terminal type on the loop's default executor"""
+        future = asyncio.get_running_loop().run_in_executor(None, self.read_terminfo, term)
+        future.add_done_callback(lambda future: self.terminfo_read(term, future.result(), request))
+
+    def get_timer_wheel(self):
+        loop = asyncio.get_running_loop()
+        if loop not in timer_wheels:
+            timer_wheels[loop] = TimerWheel(loop.call_later)
+        return timer_wheels[loop]
+
+    def disconnect(self):
+        """End the session from outside it.  Output already written is sent first."""
+        self.RUNSHELL = False
+        self.transport.close()
+
+    def finish(self):
+        """Called as the session is ending"""
+        log.debug("Session disconnected.")
+        self.session_registry.discard(self)
+        self.record_session()
+        if self.admission_ticket is not None:
+            self.admission_ticket.release()
+        self.timer_wheel = None
+        if self._history is not None:
+            self._history.flush()
+        self.flush()
+        self.transport.close()
+        self.session_end()
+
+    # -- Asynchronous input handling functions --
+
+    def _wake_getc(self):
+        if self.getc_waiter is not None and not self.getc_waiter.done():
+            self.getc_waiter.set_result(None)
+
+    async def getc(self, block=True):
+        """Return one character from the input buffer, refilled from the
+        input queue when it runs dry.
+        Raise EOFError once the connection is closed and the queue is empty."""
+        if self.cookedpos < len(self.cookedbuf):
+            c = self.cookedbuf[self.cookedpos]
+            self.cookedpos += 1
+            return chr_py3(c)
+        while not self.cookedq:
+            if not block:
+                return b''
+            if self.eof:
+                raise EOFError
+            self.getc_waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self.getc_waiter
+            finally:
+                self.getc_waiter = None
+        item = self.cookedq.popleft()
+        if type(item) is int:
+            # A key code
+            return item
+        self.cookedbuf = item
+        self.cookedpos = 1
+        return chr_py3(item[0])
+
+    def inputcooker_store_queue(self, char):
+        """Put the cooked data in the input queue (no locking needed)"""
+        if type(char) in [type(()), type([])]:
+            char = bytes(char)
+        if char:
+            self.cookedq.append(char)
+            self._wake_getc()
+
+    async def readline(self, echo=None, prompt='', use_history=True, use_completion=False):
+        """Return a line of text, see TelnetHandlerBase.readline"""
+        editor = self.readline_editor(echo, prompt, use_history, use_completion)
+        next(editor)
+        try:
+            while True:
+                c = await self.getc(block=False)
+                if not c:
+                    # Send the echo before waiting for more input
+                    self.flush()
+                    if self.OUTPUT_POLICY == 'block':
+                        await self.drain()
+                    waiting = self.input_wait_start()
+                    c = await self.getc(block=True)
+                    self.input_wait_done(waiting)
+                self.profiled(editor.send, c)
+        except StopIteration as stop:
+            return stop.value
+
+    # -- Asynchronous output handling functions --
+
+    async def writepaged(self, lines):
+        """Write out the lines from an iterable or an asynchronous iterable,
+        see TelnetHandlerBase.writepaged"""
+        page = self.page_rows()
+        rows = 0
+        iterator = _aiter(lines)
+        try:
+            async for line in iterator:
+                if page and rows >= page:
+                    self.write(self.MORE_PROMPT)
+                    self.flush()
+                    waiting = self.input_wait_start()
+                    try:
+                        c = await self.getc(block=True)
+                    except (asyncio.CancelledError, CommandInterrupted):
+                        # Erase MORE_PROMPT
+                        self.pager_key(telnetsrvlib.ETX, page)
+                        raise
+                    self.input_wait_done(waiting)
+                    rows = self.pager_key(c, page)
+                    if rows is None:
+                        break
+                self.writeline(line)
+                rows += self.line_rows(line)
+                if self.drain_waiter is not None and self.OUTPUT_POLICY == 'block':
+                    self.flush()
+                    await self.drain()
+        finally:
+            await iterator.aclose()
+            if hasattr(lines, 'aclose'):
+                await lines.aclose()
+            elif hasattr(lines, 'close'):
+                lines.close()
+
+    async def writestream(self, source):
+        """Write out the text from an iterable of strings or a file-like
+        object a chunk at a time, waiting for the client to keep up."""
+        for data in telnetsrvlib.cook_output_stream(source):
+            self.writecooked(data)
+            if self.OUTPUT_POLICY == 'block':
+                await self.drain()
+
+    async def drain(self):
+        """Wait until the output is down to OUTPUT_QUEUE_LOW"""
+        if self.drain_waiter is not None:
+            await asyncio.shield(self.drain_waiter)
+
+    def output_queued(self):
+        """Return how many bytes are waiting in the transport"""
+        return self.outq_bytes + self.transport.get_write_buffer_size()
+
+    def sendcooked(self, data):
+        """Hand cooked data straight to the transport, which queues it.
+        Once OUTPUT_QUEUE_HIGH bytes are waiting, output_overflow decides
+        what becomes of it."""
+        if self.output_queued() >= self.OUTPUT_QUEUE_HIGH and not self.output_overflow(data):
+            self.outq_dropped += len(data)
+            return
+        self.transport.write(data)
+        self.outq_sent += len(data)
+        self.outq_peak = max(self.outq_peak, self.output_queued())
+
+    def output_wait(self):
+        """Writers cannot block here; the session waits in drain() instead"""
+        pass
+
+    def output_disconnect(self):
+        """End a session whose client is not taking its output"""
+        self.RUNSHELL = False
+        self.transport.abort()
+
+    # -- Command line processor engine --
+
+    async def authentication_ok(self):
+        """Checks the authentication and sets the username of the currently connected terminal.
+        Returns True or False"""
+        username = None
+        password = None
+        if self.authCallback:
+            if self.authNeedUser:
+                username = await self.readline(prompt=str_to_bytes(self.PROMPT_USER), use_history=False)
+            if self.authNeedPass:
+                password = await self.readline(echo=False, prompt=str_to_bytes(self.PROMPT_PASS), use_history=False)
+                if self.DOECHO:
+                    self.write(b"\n")
+        return self.authenticate(username, password)
+
+    async def handle(self):
+        """The actual service to which the user has connected."""
+        if self.TELNET_ISSUE:
+            self.writeline(self.TELNET_ISSUE)
+        if not await self.authentication_ok():
+            return
+        if self.admission_ticket is not None:
+            self.admission_ticket.established()
+        if self.HISTORY_STORE is not None:
+            # Load the user's history off the loop
+            await asyncio.get_running_loop().run_in_executor(None, getattr, self, 'history')
+        if self.DOECHO:
+            self.writeline(self.WELCOME)
+
+        self.session_start()
+        while self.RUNSHELL:
+            raw_input = await self.readline(prompt=str_to_bytes(self.PROMPT), echo=True, use_completion=True)
+            self.parse_input(raw_input)
+            while not getattr(self.input, 'complete', True):
+                # Ask for more.
+                self.input.process_line(await self.readline(prompt=self.CONTINUE_PROMPT, echo=True))
+            cmd, params = self.input_command()
+            if cmd is None:
+                continue
+            started = self.command_begin()
+            error = False
+            self.command_task = asyncio.ensure_future(
+                self.profiled_await(self.call_command(self.COMMANDS[cmd], params), command=cmd))
+            try:
+                await self.command_task
+            except EOFError:
+                raise
+            except (CommandInterrupted, asyncio.CancelledError):
+                if not self.interrupted:
+                    raise
+            except Exception:
+                error = True
+                if self.command_error(cmd):
+                    break
+            finally:
+                self.command_task = None
+                self.command_end(cmd, started, error)
+            if self.interrupted:
+                self.writeline(self.INTERRUPT_MESSAGE)
+        log.debug("Exiting handler")
+
+    def profiled_await(self, awaitable, command=None):
+        """Return awaitable, awaited as a section of the running
+        profiling.Profile if it covers this session (and command)"""
+        profile = profiling.active
+        if profile is None or not profile.covers(self, command):
+            return awaitable
+        return profile.wrap(awaitable)
+
+    async def call_command(self, method, params):
+        """Run a command and write out the lines it returns, as the task of
+        the command.  A command marked executor='thread' is awaited on
+        the command executor, one marked executor='process' on the command
+        process pool."""
+        executor = getattr(method, 'executor', None)
+        if executor == 'thread':
+            run = telnetsrvlib.ThreadCommand(self, asyncio.get_running_loop().call_soon_threadsafe)
+            result = await self.run_in_thread(run, method, params)
+            if isinstance(result, types.GeneratorType):
+                result = self.thread_lines(run, result)
+        elif executor == 'process':
+            result = self.call_in_process(method, params)
+        else:
+            result = method(params)
+            if asyncio.iscoroutine(result):
+                result = await result
+        if is_lines(result):
+            # Lines yielded or returned by the command
+            await self.writepaged(result)
+
+    async def run_in_thread(self, run, fn, *args):
+        """Call fn(*args) for the ThreadCommand run on the command
+        executor and return the result"""
+        future = self.submit_command(run, fn, *args)
+        try:
+            return await asyncio.wrap_future(future)
+        finally:
+            run.finish(future)
+
+    async def thread_lines(self, run, lines):
+        """Yield the lines of a generator command, taken from it on the
+        command executor as they are paged"""
+        try:
+            while True:
+                batch = await self.run_in_thread(run, telnetsrvlib.next_lines, lines, self.COMMAND_BATCH)
+                if not batch:
+                    return
+                for line in batch:
+                    yield line
+        finally:
+            if not run.abandoned:
+                await self.run_in_thread(run, lines.close)
+
+    async def process_lines(self, task):
+        """Write out the output of a command running in the command process
+        pool as it arrives, yielding its lines, see
+        TelnetHandlerBase.process_lines"""
+        try:
+            while True:
+                message = task.take()
+                if message is None:
+                    await asyncio.wrap_future(task.waiter())
+                    continue
+                kind, payload = message
+                if kind == 'end':
+                    if payload is not None:
+                        raise payload
+                    return
+                for name, text in payload:
+                    if name is None:
+                        yield text
+                    elif name in telnetsrvlib.OUTPUT_METHODS:
+                        getattr(self, name)(text)
+                self.flush()
+        finally:
+            task.close()
+
+    def cancel_command(self):
+        """Cancel the task running the command"""
+        if self.command_task is not None:
+            self.command_task.cancel()
+
+    def message_relay(self):
+        """Written from a thread other than the loop's, such as a command
+        executor's, a message is handed over to the loop"""
+        if self.session_task is None:
+            return None
+        loop = self.session_task.get_loop()
+        try:
+            if asyncio.get_running_loop() is loop:
+                return None
+        except RuntimeError:
+            pass
+        return loop.call_soon_threadsafe
@@ -0,0 +1,228 @@
+"""
+Caching the output of commands.
+
+A command decorated with cached keeps the output it wrote, by whatever
+method, and the lines it returned or yielded for ttl seconds, in a
+CommandCache shared by the sessions of the process.  Calling it again with the same params (and,
+if keyed so, by the same user) writes the kept output again and pages
+the kept lines instead of running it.  While one session is running
+it, others calling it the same way wait for its output rather than run
+it too.  The cache holds at most max_entries outputs of at most
+max_bytes of text between them, dropping the least recently used.
+"""
+
+import functools
+import inspect
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from telnetsrv.utils import is_lines
+
+log = logging.getLogger(__name__)
+
+def text_size(text):
+    """Roughly the bytes taken by a line of output"""
+    if isinstance(text, (str, bytes)):
+        return len(text)
+    return len(str(text))
+
+
+class CacheEntry(object):
+    """The output of a cached command: the cooked data it wrote and the
+    lines it returned (None if it returned none)"""
+    __slots__ = ('data', 'lines', 'size', 'expires')
+
+    def __init__(self, data, lines, size, expires):
+        self.data = data
+        self.lines = lines
+        self.size = size
+        self.expires = expires
+
+    def replay(self, handler):
+        """Write the output again to handler, returning the lines"""
+        if self.data:
+            handler.writecooked(self.data)
+        return self.lines
+
+
+class OutputCapture(object):
+    """A copy of the cooked output written to a handler by one thread
+    while a cached command runs there, see TelnetHandlerBase.writecooked.
+    The output of a cached command run by another is kept by both."""
+    __slots__ = ('ident', 'chunks', 'outer')
+
+    def __init__(self, outer=None):
+        self.ident = threading.get_ident()
+        self.chunks = []
+        self.outer = outer
+
+    def take(self, data):
+        if self.ident == threading.get_ident():
+            self.chunks.append(bytes(data))
+            if self.outer is not None:
+                self.outer.take(data)
+
+    def data(self):
+        return b''.join(self.chunks)
+
+
+class CommandCache(object):
+    """The kept output of cached commands, shared by sessions.
+
+    max_entries = Outputs kept at most
+    max_bytes   = Text kept at most, over all outputs; an output larger
+                  than this is not kept at all
+
+    Keys are tuples starting with the command's function.
+    """
+    def __init__(self, max_entries=1024, max_bytes=16 << 20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        # Futures of the keys being run now, done with their CacheEntry,
+        # or None if the run failed
+        self.running = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.evictions = 0
+
+    def call(self, key, ttl, run, wait=None):
+        """Return the CacheEntry kept for key, running run() for it if
+        there is none.  run returns (data, lines, size).  If key is being
+        run already, wait(future) waits for that instead (future.result
+        by default).  Returns (entry, True) if this call ran it."""
+        while True:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is not None:
+                    if entry.expires > time.monotonic():
+                        self.entries.move_to_end(key)
+                        self.hits += 1
+                        return entry, False
+                    self.drop(key)
+                future = self.running.get(key)
+                if future is None:
+                    future = self.running[key] = Future()
+                    self.misses += 1
+                    break
+                self.shared += 1
+            # The same call is running in another session
+            (wait or Future.result)(future)
+            entry = future.result()
+            if entry is not None:
+                return entry, False
+            # It failed there; try it here
+        try:
+            data, lines, size = run()
+        except BaseException:
+            with self.lock:
+                del self.running[key]
+            future.set_result(None)
+            raise
+        entry = CacheEntry(data, lines, size, time.monotonic() + ttl)
+        with self.lock:
+            del self.running[key]
+            if size <= self.max_bytes:
+                self.entries[key] = entry
+                self.size += size
+                while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                    self.drop(next(iter(self.entries)))
+                    self.evictions += 1
+        future.set_result(entry)
+        return entry, True
+
+    def drop(self, key):
+        self.size -= self.entries.pop(key).size
+
+    def invalidate(self, command=None):
+        """Drop the output kept for a command (its function, or a method
+        bound to it), or for every command if None"""
+        command = getattr(command, '__func__', command)
+        with self.lock:
+            for key in list(self.entries):
+                if command is None or key[0] is command:
+                    self.drop(key)
+
+    def stats(self):
+        """Return the cache's metrics: the outputs kept and their size in
+        bytes now, and the hits, misses, calls that waited for the same
+        call in another session and outputs evicted so far"""
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'shared': self.shared,
+                'evictions': self.evictions,
+            }
+
+
+# The cache of a handler class with no COMMAND_CACHE of its own
+command_cache = CommandCache()
+
+
+class cached():
+    """Function decorator to keep the output of a command for ttl seconds.
+
+    The output is kept per command and params.  key='username' keeps it
+    per user as well; a function key is called as key(handler, params)
+    and its result, which must be hashable, is used instead of params.
+
+    Everything the command writes to the session while it runs is
+    kept, as the cooked data sent to the client, so it is written again
+    the same whichever method wrote it.  The command runs to the end
+    before its lines are paged, so a generator command's lines are all
+    taken at once.  Only plain functions can be cached, not coroutines,
+    and a command reading input should not be.  A command run in a
+    child process (executor='process') is not cached.
+    """
+    def __init__(self, ttl, key=None):
+        if key not in (None, 'username') and not callable(key):
+            raise ValueError("Unknown cache key %r" % (key, ))
+        self.ttl = ttl
+        self.key = key
+
+    def __call__(self, fn):
+        if inspect.iscoroutinefunction(fn) or inspect.isasyncgenfunction(fn):
+            raise TypeError("Cannot cache coroutine command %s" % fn.__name__)
+        ttl = self.ttl
+        key = self.key
+
+        @functools.wraps(fn)
+        def cached_command(handler, params):
+            if key is None:
+                cache_key = (cached_command, tuple(params))
+            elif key == 'username':
+                cache_key = (cached_command, handler.username, tuple(params))
+            else:
+                cache_key = (cached_command, key(handler, params))
+
+            def run():
+                capture = handler.output_capture = OutputCapture(handler.output_capture)
+                try:
+                    lines = fn(handler, params)
+                    lines = tuple(lines) if is_lines(lines) else None
+                finally:
+                    handler.output_capture = capture.outer
+                data = capture.data()
+                size = len(data)
+                if lines is not None:
+                    size += sum(text_size(line) for line in lines)
+                return data, lines, size
+
+            if not hasattr(handler, 'output_capture'):
+                # A ProcessSession, in a child process
+                return fn(handler, params)
+            cache = handler.COMMAND_CACHE or command_cache
+            entry, ran = cache.call(cache_key, ttl, run, getattr(handler, 'wait_command', None))
+            if ran:
+                # Written as it ran
+                return entry.lines
+            return entry.replay(handler)
+        return cached_command
@@ -2,54 +2,209 @@
 # Telnet handler concrete class using green threads
 """
 
+import socket
 import gevent
-from gevent import queue, select
+import gevent.threadpool
+from gevent import event, monkey, queue
 from telnetsrv.utils import chr_py3
-from telnetsrv.telnetsrvlib import TelnetHandlerBase, command
+from telnetsrv.telnetsrvlib import TelnetHandlerBase, CommandInterrupted, command
+from telnetsrv.timers import TimerWheel
+
+# The timer wheel shared by the green sessions of the process
+timer_wheel = None
+
+# The ident of the OS thread running, even under monkey patching
+thread_ident = monkey.get_original('_thread', 'get_ident')
 
 
 class TelnetHandler(TelnetHandlerBase):
-    """A telnet server handler using Gevent"""
-    def __init__(self, request, client_address, server):
-        # Create a green queue for input handling
+    """A telnet server handler using Gevent
+
+    An interrupted command has CommandInterrupted raised in it the next
+    time it waits on gevent.  A command marked executor='thread' runs on
+    gevent's thread pool, out of the way of the other greenlets, and is
+    left behind as soon as it is interrupted.
+    """
+    # Seconds to wait for queued output to be sent as the session ends
+    OUTPUT_CLOSE_TIMEOUT = 5
+    command_pool_class = gevent.threadpool.ThreadPoolExecutor
+    __slots__ = ('cookedq', 'cookedbuf', 'cookedpos', 'outq_waiting', 'outq_drained',
+                 'outq_closing', 'greenlet_ic', 'greenlet_oc', 'greenlet_session', 'hub', 'negotiated')
+
+    def init_session(self):
+        """Set up the per-session state, with green queues"""
+        TelnetHandlerBase.init_session(self)
+        # Create a green queue for input handling.  It carries runs of
+        # cooked bytes (and key codes), read out through a local buffer.
         self.cookedq = gevent.queue.Queue()
-        # Call the base class init method
-        TelnetHandlerBase.__init__(self, request, client_address, server)
-        
+        self.cookedbuf = b''
+        self.cookedpos = 0
+        # Output is sent by its own greenlet, so a slow client only holds
+        # up writers once OUTPUT_QUEUE_HIGH is reached
+        self.outq_waiting = gevent.event.Event()
+        self.outq_drained = gevent.event.Event()
+        self.outq_drained.set()
+        self.outq_closing = False
+        self.greenlet_oc = None
+        # The greenlet running the session, and its commands, and its hub
+        self.greenlet_session = None
+        self.hub = None
+        # Set once the client has answered the option requests, while
+        # the session waits for that
+        self.negotiated = None
+
     def setup(self):
         """Called after instantiation"""
         TelnetHandlerBase.setup(self)
-        # Spawn a greenlet to handle socket input
+        self.greenlet_session = gevent.getcurrent()
+        self.hub = gevent.get_hub()
+        # Spawn greenlets to handle socket input and output
         self.greenlet_ic = gevent.spawn(self.inputcooker)
+        self.greenlet_oc = gevent.spawn(self.outputsender)
         # Note that inputcooker exits on EOF
         
-        # Sleep for 0.5 second to allow options negotiation
-        gevent.sleep(0.5)
-        
+        # Wait for the client to answer the option requests
+        if self.negotiating:
+            self.negotiated = gevent.event.Event()
+            self.negotiated.wait(self.NEGOTIATION_TIMEOUT)
+            self.negotiated = None
+
+    def negotiation_done(self):
+        TelnetHandlerBase.negotiation_done(self)
+        if self.negotiated is not None:
+            self.negotiated.set()
+
+    def lookup_terminfo(self, term, request):
+        """Read the terminal type in a greenlet of its own, out of the way of the input"""
+        gevent.spawn(TelnetHandlerBase.lookup_terminfo, self, term, request)
+
+    def get_timer_wheel(self):
+        global timer_wheel
+        if timer_wheel is None:
+            timer_wheel = TimerWheel(gevent.spawn_later)
+        return timer_wheel
+
     def finish(self):
         """Called as the session is ending"""
         TelnetHandlerBase.finish(self)
-        # Ensure the greenlet is dead
+        # Ensure the greenlets are dead
         self.greenlet_ic.kill()
+        self.greenlet_oc.kill()
 
     # -- Green input handling functions --
 
+    def inputcooker(self):
+        """Cook the input, then mark the end of it in the input queue"""
+        TelnetHandlerBase.inputcooker(self)
+        self.cookedq.put(EOFError)
+
     def getc(self, block=True):
-        """Return one character from the input queue"""
+        """Return one character from the input buffer, refilled from the
+        input queue when it runs dry.
+        Raise EOFError once the connection is closed and the queue is empty."""
+        if self.cookedpos < len(self.cookedbuf):
+            c = self.cookedbuf[self.cookedpos]
+            self.cookedpos += 1
+            return chr_py3(c)
         try:
-            return self.cookedq.get(block)
+            item = self.cookedq.get(block)
         except gevent.queue.Empty:
             return ''
-
-    def inputcooker_socket_ready(self):
-        """Indicate that the socket is ready to be read"""
-        return gevent.select.select([self.sock.fileno()], [], [], 0) != ([], [], [])
+        if item is EOFError:
+            # Leave the mark for the next reader
+            self.cookedq.put(item)
+            raise EOFError
+        if type(item) is int:
+            # A key code
+            return item
+        self.cookedbuf = item
+        self.cookedpos = 1
+        return chr_py3(item[0])
 
     def inputcooker_store_queue(self, char):
         """Put the cooked data in the input queue (no locking needed)"""
-        if type(char) in [type(()), type([]), type(b"")]:
-            for v in char:
-                self.cookedq.put(chr_py3(v))
+        if type(char) in [type(()), type([])]:
+            char = bytes(char)
+        if char:
+            self.cookedq.put(char)
+
+
+    # -- Green command execution --
+
+    def cancel_command(self):
+        """Raise CommandInterrupted in the session's greenlet"""
+        gevent.get_hub().loop.run_callback(self.throw_interrupt)
+
+    def throw_interrupt(self):
+        if self.command_running and self.greenlet_session is not None:
+            self.greenlet_session.throw(CommandInterrupted)
+
+    def command_relay(self):
+        """Hand output over from a command executor thread to a greenlet of
+        the session's hub, where writing it out may wait"""
+        loop = self.hub.loop
+        return lambda fn: loop.run_callback_threadsafe(gevent.spawn, fn)
+
+    # -- Green output handling functions --
+
+    def outputsender(self):
+        """Output sender - Transfer from the output queue to the socket."""
+        try:
+            while True:
+                while not self.outq:
+                    if self.outq_closing:
+                        return
+                    self.outq_waiting.wait()
+                    self.outq_waiting.clear()
+                data = self.outq.popleft()
+                self.sock.sendall(data)
+                self.output_sent(len(data))
+                if self.outq_bytes <= self.OUTPUT_QUEUE_LOW:
+                    self.outq_drained.set()
+        except socket.error:
+            self.eof = 1
+        finally:
+            # Nothing more will be sent, release any blocked writer
+            self.outq_drained.set()
+
+    def writebroadcast(self, data):
+        """Write out a message broadcast to many sessions, from a greenlet of
+        its own so a session held up by its OUTPUT_POLICY does not hold up
+        the others"""
+        if self.on_hub():
+            gevent.spawn(self.writemessage_cooked, data)
         else:
-            self.cookedq.put(chr_py3(char))
+            self.hub.loop.run_callback_threadsafe(gevent.spawn, self.writemessage_cooked, data)
+
+    def on_hub(self):
+        """Is this the OS thread of the session's hub?"""
+        return self.hub is None or self.hub.thread_ident == thread_ident()
+
+    def message_relay(self):
+        """Written from a thread other than the hub's, such as a command
+        executor's, a message is handed over to a greenlet of the hub"""
+        if self.on_hub():
+            return None
+        return self.command_relay()
+
+    def output_discard(self):
+        """Throw away the output not yet sent, releasing any blocked writer"""
+        TelnetHandlerBase.output_discard(self)
+        self.outq_drained.set()
+
+    def output_ready(self):
+        """Wake up the output sender"""
+        self.outq_waiting.set()
+
+    def output_wait(self):
+        """Wait for the output sender to drain the queue to OUTPUT_QUEUE_LOW"""
+        if self.greenlet_oc and not self.greenlet_oc.dead:
+            self.outq_drained.clear()
+            self.outq_drained.wait()
 
+    def output_close(self):
+        """Give the output sender OUTPUT_CLOSE_TIMEOUT seconds to finish"""
+        if self.greenlet_oc:
+            self.outq_closing = True
+            self.outq_waiting.set()
+            self.greenlet_oc.join(timeout=self.OUTPUT_CLOSE_TIMEOUT)
@@ -0,0 +1,189 @@
+"""
+Command history.
+
+Each session keeps the lines typed at its prompt in a History, a ring
+buffer of the last HISTORY_SIZE lines.  With a HISTORY_STORE set on the
+handler class, the history of each user is kept across sessions too.
+"""
+
+import collections
+import logging
+import os
+import threading
+import time
+from collections.abc import MutableSequence
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+log = logging.getLogger(__name__)
+
+
+class History(MutableSequence):
+    """The last size lines typed at the prompt, oldest first.
+
+    A line the same as the one before it is not added again, nor is an
+    empty one.  With a store, the user's stored lines come first, and
+    lines added are passed on to the store.  Loading the stored lines
+    may wait on the store's I/O, so handlers create the History where
+    waiting is fine.
+    """
+    __slots__ = ('entries', 'dropped', 'store', 'user')
+
+    def __init__(self, size=1000, store=None, user=None):
+        self.entries = collections.deque(maxlen=size)
+        # Lines pushed out of the ring, so numbering stays put
+        self.dropped = 0
+        self.store = store
+        self.user = user
+        if store is not None and user is not None:
+            self.dropped, lines = store.load(user, size)
+            self.entries.extend(lines)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self.entries)[index]
+        return self.entries[index]
+
+    def __setitem__(self, index, line):
+        self.entries[index] = line
+
+    def __delitem__(self, index):
+        del self.entries[index]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def insert(self, index, line):
+        if len(self.entries) == self.entries.maxlen:
+            self.entries.popleft()
+            self.dropped += 1
+            index -= 1
+        self.entries.insert(max(index, 0), line)
+
+    def append(self, line):
+        """Add a line typed at the prompt"""
+        if not line or (self.entries and self.entries[-1] == line):
+            return
+        if len(self.entries) == self.entries.maxlen:
+            self.dropped += 1
+        self.entries.append(line)
+        if self.store is not None and self.user is not None:
+            self.store.add(self.user, line)
+
+    def clear(self):
+        self.entries.clear()
+
+    def search(self, text, start=None, prefix=False):
+        """Return the index of the newest line at or before start holding
+        text (starting with it, if prefix), or None"""
+        if start is None:
+            start = len(self.entries) - 1
+        for index in range(min(start, len(self.entries) - 1), -1, -1):
+            line = self.entries[index]
+            if line.startswith(text) if prefix else text in line:
+                return index
+        return None
+
+    def flush(self):
+        """Write out the lines the store holds back"""
+        if self.store is not None and self.user is not None:
+            self.store.flush(self.user)
+
+
+class FileHistoryStore(object):
+    """Keeps each user's history in a file of its own in directory.
+
+    Lines are written batch at a time, or once the oldest waiting is
+    flush_interval seconds old, and as each session ends, by a thread of
+    the store's own, so adding lines never waits on the disk.  Loading
+    waits for the writes before it, then reads the file.  A file that
+    has grown to twice the history size is cut back as it is loaded.
+    Shared by all sessions of the handler class, so thread safe.
+    """
+    def __init__(self, directory, batch=32, flush_interval=5.0):
+        self.directory = directory
+        self.batch = batch
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        # User: lines waiting to be written
+        self.pending = {}
+        self.oldest = None
+        # Writes and reads the files, in order
+        self.writer = ThreadPoolExecutor(1)
+
+    def path(self, user):
+        if isinstance(user, bytes):
+            user = user.decode('utf-8', 'replace')
+        return os.path.join(self.directory, quote(user, safe='') + '.history')
+
+    def load(self, user, size):
+        """Return the number of lines stored for user before the last
+        size, and those last size lines"""
+        return self.writer.submit(self.read, user, size).result()
+
+    def read(self, user, size):
+        path = self.path(user)
+        with self.lock:
+            try:
+                with open(path, 'rb') as f:
+                    lines = f.read().splitlines()
+            except FileNotFoundError:
+                lines = []
+            except OSError:
+                log.exception("Reading history %s" % (path, ))
+                lines = []
+            lines.extend(self.pending.get(user, ()))
+            dropped = max(len(lines) - size, 0)
+            if len(lines) > 2 * size:
+                lines = lines[-size:]
+                self.pending.pop(user, None)
+                self.rewrite(path, lines)
+        return dropped, lines[-size:]
+
+    def add(self, user, line):
+        """Store a line for user, some time soon"""
+        with self.lock:
+            self.pending.setdefault(user, []).append(line)
+            now = time.monotonic()
+            if self.oldest is None:
+                self.oldest = now
+            if sum(len(lines) for lines in self.pending.values()) < self.batch and \
+                    now - self.oldest < self.flush_interval:
+                return
+            pending, self.pending, self.oldest = self.pending, {}, None
+            for user, lines in pending.items():
+                self.writer.submit(self.write, user, lines)
+
+    def flush(self, user=None):
+        """Write out the lines waiting for user, or for everyone"""
+        with self.lock:
+            if user is None:
+                pending, self.pending = self.pending, {}
+            else:
+                pending = {user: self.pending.pop(user, [])}
+            if not self.pending:
+                self.oldest = None
+            for user, lines in pending.items():
+                self.writer.submit(self.write, user, lines)
+
+    def write(self, user, lines):
+        if not lines:
+            return
+        path = self.path(user)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path, 'ab') as f:
+                f.write(b''.join(line + b'\n' for line in lines))
+        except OSError:
+            log.exception("Writing history %s" % (path, ))
+
+    def rewrite(self, path, lines):
+        try:
+            with open(path + '.new', 'wb') as f:
+                f.write(b''.join(line + b'\n' for line in lines))
+            os.replace(path + '.new', path)
+        except OSError:
+            log.exception("Writing history %s" % (path, ))
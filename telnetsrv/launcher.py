@@ -0,0 +1,417 @@
+"""
+Serve a handler class from several worker processes.
+
+The Launcher starts a number of worker processes serving one address.
+By default they share a listening socket bound by the launcher and
+inherited through fork; with reuse_port, each worker binds its own
+socket with SO_REUSEPORT and the kernel spreads the connections
+between them.  Every worker reports its session counts to the launcher
+each heartbeat; the launcher replaces the workers that die or stop
+reporting, replaces them all one at a time on SIGHUP, and sums up
+their stats.
+
+The serving backend follows the handler class: the asyncio handler is
+served by an asyncio loop, the threaded handler by a TelnetServer, and
+anything else (the green handler, paramiko_ssh.SSHHandler) by a gevent
+StreamServer through its streamserver_handle class method.  For those,
+the program must call gevent's monkey.patch_all() before importing
+anything else, as when serving them without the launcher; a worker
+could only patch once socket, threading and ssl are imported.  The
+worker processes are forked, so this is for POSIX systems only.
+"""
+
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import socket
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+def listen(address, reuse_port=False):
+    """Return a socket bound to address, not yet listening"""
+    family = socket.AF_INET6 if ':' in address[0] else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(address)
+    return sock
+
+
+def session_registry(handler_class):
+    """Return the SessionRegistry of a handler class, or of the telnet
+    handler behind an SSHHandler, or None"""
+    handler_class = getattr(handler_class, 'telnet_handler', None) or handler_class
+    return getattr(handler_class, 'session_registry', None)
+
+
+def sessions_left(registry, deadline):
+    return registry is not None and len(registry) > 0 and time.monotonic() < deadline
+
+
+# -- Run by the worker processes --
+
+class Reporter(object):
+    """Sends the stats of a worker to the launcher every interval seconds.
+
+    With call_soon, the report is sent from the thread serving the
+    sessions, so a worker whose loop is stuck stops reporting."""
+    def __init__(self, conn, registry, interval):
+        self.conn = conn
+        self.registry = registry
+        self.interval = interval
+        self.call_soon = None
+
+    def start(self, call_soon=None):
+        """Start reporting; called by the serve function once it is serving"""
+        self.call_soon = call_soon
+        thread = threading.Thread(target=self.run, name='telnetsrv-reporter')
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        while self.conn is not None:
+            if self.call_soon is None:
+                self.send()
+            else:
+                self.call_soon(self.send)
+            time.sleep(self.interval)
+
+    def send(self):
+        if self.conn is None:
+            return
+        stats = self.registry.stats() if self.registry is not None else {}
+        stats['pid'] = os.getpid()
+        try:
+            self.conn.send(stats)
+        except (OSError, EOFError):
+            # The launcher is gone: stop gracefully
+            self.conn = None
+            os.kill(os.getpid(), signal.SIGTERM)
+
+
+def serve_aio(handler_class, sock, grace, reporter):
+    """Serve an asyncio handler until SIGTERM"""
+    import asyncio
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        stopping = asyncio.Event()
+        loop.add_signal_handler(signal.SIGTERM, stopping.set)
+        server = await loop.create_server(handler_class, sock=sock)
+        reporter.start(loop.call_soon_threadsafe)
+        await stopping.wait()
+        server.close()
+        deadline = time.monotonic() + grace
+        while sessions_left(reporter.registry, deadline):
+            await asyncio.sleep(0.1)
+
+    asyncio.run(main())
+
+
+def serve_threaded(handler_class, sock, grace, reporter):
+    """Serve a threaded handler until SIGTERM"""
+    from telnetsrv.threaded import TelnetServer
+    server = TelnetServer(None, handler_class, sock=sock)
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    thread = threading.Thread(target=server.serve_forever, name='telnetsrv-io')
+    thread.start()
+    reporter.start(server.call_soon)
+    stopping.wait()
+    server.stop_accepting()
+    deadline = time.monotonic() + grace
+    while sessions_left(reporter.registry, deadline):
+        time.sleep(0.1)
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def serve_green(handler_class, sock, grace, reporter):
+    """Serve a handler with a gevent StreamServer until SIGTERM.  The
+    process must have been monkey patched already."""
+    import gevent
+    import gevent.pool
+    import gevent.server
+    server = gevent.server.StreamServer(sock, handler_class.streamserver_handle, spawn=gevent.pool.Pool())
+    gevent.signal_handler(signal.SIGTERM, server.stop, grace)
+    server.start()
+    reporter.start()
+    server.serve_forever()
+
+
+def server_for(handler_class):
+    """Return the serve function for a handler class"""
+    modules = set(klass.__module__ for klass in handler_class.__mro__)
+    if 'telnetsrv.aio' in modules:
+        return serve_aio
+    if 'telnetsrv.threaded' in modules:
+        return serve_threaded
+    return serve_green
+
+
+def worker_main(serve, handler_class, sock, reuse_port, conn, heartbeat, grace):
+    # The launcher handles Ctrl-C and the control signals
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for signum in (signal.SIGTERM, signal.SIGHUP, signal.SIGUSR1):
+        signal.signal(signum, signal.SIG_DFL)
+    if reuse_port:
+        address = sock.getsockname()
+        sock.close()
+        sock = listen(address, reuse_port=True)
+        sock.listen(Launcher.backlog)
+    serve(handler_class, sock, grace, Reporter(conn, session_registry(handler_class), heartbeat))
+
+
+# -- Run by the launcher --
+
+class Worker(object):
+    """The launcher's record of a worker process"""
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        self.started = time.monotonic()
+        self.last_report = None
+        self.stats = {}
+        # When it was asked to stop
+        self.retired = None
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def report(self, stats):
+        self.stats = stats
+        self.last_report = time.monotonic()
+
+    def healthy(self, now, timeout):
+        """Started in the last timeout seconds, or reported in them"""
+        return now - (self.last_report or self.started) < timeout
+
+
+class Launcher(object):
+    """Runs a handler class in a number of worker processes.
+
+    workers defaults to the number of CPUs.  serve is the function run
+    by each worker, serve(handler_class, sock, grace, reporter); it
+    defaults to the one for the handler's backend.  A worker that is
+    stopped closes its listening socket and gives its sessions grace
+    seconds to end.  Workers report every heartbeat seconds; one that
+    has not reported for health_timeout seconds is killed and replaced.
+    """
+    backlog = 1024
+    # Stats summed over the workers
+    counters = ('sessions', 'started', 'queued', 'sent', 'dropped')
+
+    def __init__(self, handler_class, address, workers=None, serve=None, reuse_port=False,
+                 grace=30, heartbeat=1.0, health_timeout=10):
+        self.handler_class = handler_class
+        self.address = address
+        self.worker_count = workers or os.cpu_count() or 1
+        self.serve = serve or server_for(handler_class)
+        if self.serve is serve_green:
+            from gevent import monkey
+            if not monkey.is_module_patched('socket'):
+                raise RuntimeError("Call gevent's monkey.patch_all() before importing anything else "
+                                   "to serve %s" % handler_class.__name__)
+        self.reuse_port = reuse_port
+        self.grace = grace
+        self.heartbeat = heartbeat
+        self.health_timeout = health_timeout
+        self.context = multiprocessing.get_context('fork')
+        self.socket = None
+        self.server_address = None
+        self.workers = []
+        self.retiring = []
+        # Counters of the workers that have exited
+        self.exited = dict((key, 0) for key in self.counters if key != 'sessions' and key != 'queued')
+        self.running = False
+        self.restart_requested = False
+        self.stats_requested = False
+
+    def run(self):
+        """Start the workers and look after them until SIGTERM or SIGINT.
+        SIGHUP replaces the workers gracefully, SIGUSR1 logs the stats."""
+        handlers = {
+            signal.SIGTERM: self.signal_stop,
+            signal.SIGINT: self.signal_stop,
+            signal.SIGHUP: self.signal_restart,
+            signal.SIGUSR1: self.signal_stats,
+        }
+        previous = dict((signum, signal.signal(signum, handler)) for signum, handler in handlers.items())
+        try:
+            self.start()
+            while self.running:
+                self.poll(self.heartbeat)
+        finally:
+            self.stop()
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+
+    def start(self):
+        """Bind the address and start the workers"""
+        self.socket = listen(self.address, self.reuse_port)
+        if not self.reuse_port:
+            self.socket.listen(self.backlog)
+        self.server_address = self.socket.getsockname()
+        self.running = True
+        for _ in range(self.worker_count):
+            self.workers.append(self.spawn())
+        log.info("Serving %s on %s with %d workers" % (
+            self.handler_class.__name__, self.server_address, self.worker_count))
+
+    def stop(self):
+        """Stop the workers, waiting for their sessions to end"""
+        self.running = False
+        for worker in list(self.workers):
+            self.retire(worker)
+        deadline = time.monotonic() + self.grace + self.health_timeout
+        while self.retiring and time.monotonic() < deadline:
+            self.read_reports(0.1)
+            self.reap()
+        for worker in self.retiring:
+            log.warning("Worker %d did not stop, killing it" % worker.pid)
+            worker.process.kill()
+            worker.process.join()
+        self.retiring = []
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def restart(self):
+        """Replace the workers one at a time: start a new worker, wait for
+        its first report, then stop the old one gracefully.  Stops if a new
+        worker does not come up, leaving the old ones serving."""
+        for old in list(self.workers):
+            new = self.spawn()
+            self.workers.append(new)
+            deadline = time.monotonic() + self.health_timeout
+            while new.last_report is None and new.process.is_alive() and time.monotonic() < deadline:
+                self.read_reports(self.heartbeat)
+            if new.last_report is None:
+                log.error("Worker %d did not start, keeping the running workers" % new.pid)
+                self.workers.remove(new)
+                new.process.kill()
+                new.process.join()
+                return False
+            self.retire(old)
+        log.info("Restarted %d workers" % len(self.workers))
+        return True
+
+    def poll(self, timeout=None):
+        """Read the worker reports for up to timeout seconds, then replace
+        the workers that exited or stopped reporting"""
+        self.read_reports(timeout)
+        now = time.monotonic()
+        for worker in list(self.workers):
+            if not worker.process.is_alive():
+                log.warning("Worker %d exited with %s, restarting it" % (worker.pid, worker.process.exitcode))
+                self.replace(worker)
+            elif not worker.healthy(now, self.health_timeout):
+                log.warning("Worker %d stopped reporting, restarting it" % worker.pid)
+                worker.process.kill()
+                worker.process.join()
+                self.replace(worker)
+        self.reap()
+        if self.stats_requested:
+            self.stats_requested = False
+            log.info("Stats: %r" % (self.stats(), ))
+        if self.restart_requested and self.running:
+            self.restart_requested = False
+            self.restart()
+
+    def stats(self):
+        """Return the last report of each worker, and the totals"""
+        now = time.monotonic()
+        total = dict((key, 0) for key in self.counters)
+        for key, value in self.exited.items():
+            total[key] += value
+        workers = []
+        for worker in self.workers + self.retiring:
+            stats = dict(worker.stats)
+            stats.update(
+                pid=worker.pid,
+                healthy=worker.healthy(now, self.health_timeout),
+                retiring=worker.retired is not None,
+            )
+            workers.append(stats)
+            for key in self.counters:
+                total[key] += worker.stats.get(key, 0)
+        total['workers'] = len(self.workers)
+        return {'total': total, 'workers': workers}
+
+    # -- Internals --
+
+    def spawn(self):
+        reader, writer = self.context.Pipe(duplex=False)
+        process = self.context.Process(
+            target=worker_main,
+            args=(self.serve, self.handler_class, self.socket, self.reuse_port, writer,
+                  self.heartbeat, self.grace),
+            name='telnetsrv-worker',
+        )
+        process.start()
+        writer.close()
+        log.debug("Started worker %d" % process.pid)
+        return Worker(process, reader)
+
+    def replace(self, worker):
+        self.forget(worker)
+        self.workers[self.workers.index(worker)] = self.spawn()
+
+    def retire(self, worker):
+        self.workers.remove(worker)
+        worker.retired = time.monotonic()
+        self.retiring.append(worker)
+        if worker.process.is_alive():
+            worker.process.terminate()
+
+    def reap(self):
+        now = time.monotonic()
+        for worker in list(self.retiring):
+            if not worker.process.is_alive():
+                worker.process.join()
+                self.forget(worker)
+                self.retiring.remove(worker)
+            elif now - worker.retired > self.grace + self.health_timeout:
+                log.warning("Worker %d did not stop, killing it" % worker.pid)
+                worker.process.kill()
+
+    def forget(self, worker):
+        for key in self.exited:
+            self.exited[key] += worker.stats.get(key, 0)
+        worker.stats = {}
+        if worker.conn is not None:
+            worker.conn.close()
+            worker.conn = None
+
+    def read_reports(self, timeout):
+        conns = dict((worker.conn, worker) for worker in self.workers + self.retiring
+                     if worker.conn is not None)
+        if not conns:
+            time.sleep(timeout or 0)
+            return
+        for conn in multiprocessing.connection.wait(list(conns), timeout):
+            worker = conns[conn]
+            try:
+                while conn.poll():
+                    worker.report(conn.recv())
+            except (EOFError, OSError):
+                # It exited; poll or reap will notice
+                conn.close()
+                worker.conn = None
+
+    def signal_stop(self, signum, frame):
+        self.running = False
+
+    def signal_restart(self, signum, frame):
+        self.restart_requested = True
+
+    def signal_stats(self, signum, frame):
+        self.stats_requested = True
@@ -0,0 +1,122 @@
+"""
+The line being edited at the prompt.
+
+A LineEditor holds the line and the cursor position, and works out
+what to send to keep the client's screen in step as the line changes.
+"""
+
+import os
+
+
+def shortest(*choices):
+    """Return the shortest of the ways to send something, skipping those
+    the terminal has no codes for (None)"""
+    choices = [choice for choice in choices if choice is not None]
+    return min(choices, key=len) if choices else b''
+
+
+class LineEditor(object):
+    """A line being edited, in a bytearray, with the cursor position.
+
+    Each editing method changes the line and returns the bytes making
+    the same change on the terminal, the fewest the terminal's codes
+    allow: a counted cursor move rather than one code per column,
+    characters inserted and deleted in place rather than the rest of
+    the line written out again.
+
+    codes are the session's CODES.  CSRLEFTN, CSRRIGHTN, INSN and DELN
+    are the counted forms of CSRLEFT, CSRRIGHT, INS and DEL, with %p1%d
+    where the count goes.
+    """
+    __slots__ = ('codes', 'line', 'pos')
+
+    def __init__(self, codes, line=b''):
+        self.codes = codes
+        self.line = bytearray(line)
+        self.pos = len(self.line)
+
+    def __bytes__(self):
+        return bytes(self.line)
+
+    def __len__(self):
+        return len(self.line)
+
+    def repeat(self, name, count):
+        """Return the ways of doing code name count times: name repeated,
+        and name + 'N' with the count filled in.  None for those the
+        terminal lacks."""
+        single = self.codes.get(name)
+        counted = self.codes.get(name + 'N')
+        return (single * count if single else None,
+                counted.replace(b'%p1%d', b'%d' % count) if counted else None)
+
+    def cursor_left(self, count):
+        """Return the bytes moving the cursor count columns left"""
+        if not count:
+            return b''
+        return shortest(*self.repeat('CSRLEFT', count))
+
+    def cursor_right(self, count):
+        """Return the bytes moving the cursor count columns right, over
+        the line"""
+        if not count:
+            return b''
+        # Writing out the characters passed over works on any terminal
+        return shortest(bytes(self.line[self.pos:self.pos + count]), *self.repeat('CSRRIGHT', count))
+
+    def move(self, pos):
+        """Move the cursor to pos"""
+        pos = max(0, min(pos, len(self.line)))
+        if pos < self.pos:
+            out = self.cursor_left(self.pos - pos)
+        else:
+            out = self.cursor_right(pos - self.pos)
+        self.pos = pos
+        return out
+
+    def insert(self, text):
+        """Insert text at the cursor"""
+        text = bytes(text)
+        tail = bytes(self.line[self.pos:])
+        self.line[self.pos:self.pos] = text
+        self.pos += len(text)
+        if not tail:
+            return text
+        inserts = [code + text for code in self.repeat('INS', len(text)) if code is not None]
+        return shortest(text + tail + self.cursor_left(len(tail)), *inserts)
+
+    def delete(self, count=1):
+        """Delete count characters from the cursor on.  Returns None if
+        there are not that many."""
+        if self.pos + count > len(self.line):
+            return None
+        del self.line[self.pos:self.pos + count]
+        tail = bytes(self.line[self.pos:])
+        return shortest(tail + b' ' * count + self.cursor_left(len(tail) + count),
+                        *self.repeat('DEL', count))
+
+    def backspace(self):
+        """Delete the character left of the cursor.  Returns None if there
+        is none."""
+        if not self.pos:
+            return None
+        return self.move(self.pos - 1) + self.delete()
+
+    def replace(self, text):
+        """Replace the whole line, leaving the cursor at its end.  Only the
+        part after what the old and new lines start with is written."""
+        text = bytes(text)
+        same = len(os.path.commonprefix([bytes(self.line), text]))
+        out = self.move(same) + text[same:]
+        extra = len(self.line) - len(text)
+        if extra > 0:
+            deol = self.codes.get('DEOL')
+            out += shortest(deol or None, b' ' * extra + self.cursor_left(extra))
+        self.line = bytearray(text)
+        self.pos = len(self.line)
+        return out
+
+    def redraw(self):
+        """Return the bytes writing out the line again, after the prompt,
+        with the cursor back in place"""
+        return bytes(self.line) + self.cursor_left(len(self.line) - self.pos)
@@ -0,0 +1,196 @@
+"""
+Metrics of the sessions of a server.
+
+A handler class with METRICS set to a Metrics records, for each of its
+sessions, the commands run (counts, errors and a latency histogram per
+command), how long its client took to answer the option negotiation,
+how long authentication took, and the bytes received and sent.  The Metrics
+keeps them for snapshot() and prometheus(), and passes each on to its
+sinks as well, such as a StatsdSink.  With METRICS None, as by default,
+nothing is recorded or timed.
+"""
+
+import bisect
+import logging
+import socket
+import threading
+
+log = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# And in bytes
+BYTE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+# name: (kind, help, buckets)
+METRICS = {
+    'telnet_commands_total': ('counter', 'Commands run', None),
+    'telnet_command_errors_total': ('counter', 'Commands that raised an exception', None),
+    'telnet_command_seconds': ('histogram', 'Time taken by commands, less their waits for input',
+                               LATENCY_BUCKETS),
+    'telnet_negotiation_seconds': ('histogram', 'Time taken by clients to answer the option negotiation',
+                                   LATENCY_BUCKETS),
+    'telnet_auth_seconds': ('histogram', 'Time taken by the authentication callback',
+                            LATENCY_BUCKETS),
+    'telnet_sessions_total': ('counter', 'Sessions ended', None),
+    'telnet_session_received_bytes': ('histogram', 'Bytes received from the client per session',
+                                      BYTE_BUCKETS),
+    'telnet_session_sent_bytes': ('histogram', 'Bytes sent to the client per session', BYTE_BUCKETS),
+}
+
+
+class Histogram(object):
+    """Observations counted in buckets, with their count and sum"""
+    __slots__ = ('bounds', 'buckets', 'count', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # One more bucket, for those above every bound
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': dict(zip(self.bounds + (float('inf'), ), self.buckets)),
+        }
+
+
+def prometheus_labels(labels):
+    """Return labels as a Prometheus label set, empty if there are none"""
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for name, value in labels)
+
+
+def prometheus_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+
+class Metrics(object):
+    """The metrics of the sessions of the handler classes it is set on.
+
+    sinks = Objects also given each metric as it is recorded, with
+            sink.count(name, labels, value) and sink.observe(name,
+            labels, value), labels being a tuple of (name, value) pairs
+
+    Thread safe.
+    """
+    def __init__(self, sinks=()):
+        self.sinks = list(sinks)
+        self.lock = threading.Lock()
+        # (name, labels): value or Histogram
+        self.values = {}
+
+    def count(self, name, labels=(), value=1):
+        """Add value to a counter"""
+        with self.lock:
+            self.values[name, labels] = self.values.get((name, labels), 0) + value
+        for sink in self.sinks:
+            sink.count(name, labels, value)
+
+    def observe(self, name, labels=(), value=0):
+        """Add value to a histogram"""
+        with self.lock:
+            histogram = self.values.get((name, labels))
+            if histogram is None:
+                histogram = self.values[name, labels] = Histogram(METRICS[name][2])
+            histogram.observe(value)
+        for sink in self.sinks:
+            sink.observe(name, labels, value)
+
+    def command(self, name, seconds, error=False):
+        """Record a command run by a session"""
+        labels = (('command', name), )
+        self.count('telnet_commands_total', labels)
+        if error:
+            self.count('telnet_command_errors_total', labels)
+        self.observe('telnet_command_seconds', labels, seconds)
+
+    def negotiation(self, seconds):
+        """Record the time a client took to answer the option negotiation"""
+        self.observe('telnet_negotiation_seconds', (), seconds)
+
+    def auth(self, seconds, ok):
+        """Record an authentication"""
+        self.observe('telnet_auth_seconds', (('result', 'ok' if ok else 'failed'), ), seconds)
+
+    def session(self, received, sent):
+        """Record the bytes received and sent by a session that has ended"""
+        self.count('telnet_sessions_total')
+        self.observe('telnet_session_received_bytes', (), received)
+        self.observe('telnet_session_sent_bytes', (), sent)
+
+    def snapshot(self):
+        """Return the metrics so far: a dict of name to a dict of labels
+        to the value of a counter, or to a histogram's count, sum and
+        buckets (upper bound to count)"""
+        snapshot = {}
+        with self.lock:
+            for (name, labels), value in self.values.items():
+                if isinstance(value, Histogram):
+                    value = value.snapshot()
+                snapshot.setdefault(name, {})[labels] = value
+        return snapshot
+
+    def prometheus(self):
+        """Return the metrics so far in the Prometheus text format"""
+        lines = []
+        snapshot = self.snapshot()
+        for name in sorted(snapshot):
+            kind, help, bounds = METRICS[name]
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in sorted(snapshot[name].items()):
+                if kind == 'counter':
+                    lines.append('%s%s %s' % (name, prometheus_labels(labels), value))
+                    continue
+                total = 0
+                for bound, count in sorted(value['buckets'].items()):
+                    total += count
+                    lines.append('%s_bucket%s %d' % (
+                        name, prometheus_labels(labels + (('le', prometheus_bound(bound)), )), total))
+                lines.append('%s_sum%s %s' % (name, prometheus_labels(labels), value['sum']))
+                lines.append('%s_count%s %d' % (name, prometheus_labels(labels), value['count']))
+        return ''.join(line + '\n' for line in lines)
+
+
+class StatsdSink(object):
+    """Sends each metric to a StatsD server over UDP as it is recorded:
+    counters as counts, seconds as timings in milliseconds, and bytes as
+    histograms.  A label's value is added to the name.  Packets that
+    cannot be sent are dropped."""
+    def __init__(self, host='127.0.0.1', port=8125, prefix='telnetsrv.'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+    def name(self, name, labels):
+        return '.'.join([self.prefix + name] + [str(value) for label, value in labels])
+
+    def send(self, data):
+        try:
+            self.sock.sendto(data.encode('utf-8'), self.address)
+        except (socket.error, UnicodeError):
+            pass
+
+    def count(self, name, labels, value):
+        self.send('%s:%d|c' % (self.name(name, labels), value))
+
+    def observe(self, name, labels, value):
+        if name.endswith('_seconds'):
+            self.send('%s:%.3f|ms' % (self.name(name, labels), value * 1000))
+        else:
+            self.send('%s:%d|h' % (self.name(name, labels), value))
+
+    def close(self):
+        self.sock.close()
@@ -1,6 +1,6 @@
 import logging
 #from binascii import hexlify
-from threading import Thread
+from threading import Lock, Thread
 from socketserver import BaseRequestHandler
 
 from paramiko import Transport, ServerInterface, RSAKey, DSSKey, SSHException, \
@@ -11,6 +11,11 @@ from paramiko import Transport, ServerInterface, RSAKey, DSSKey, SSHException, \
 
 log = logging.getLogger(__name__)
 
+# The PTY handler classes mixed so far, by (SSH handler class, telnet
+# handler class), so each is built (and its commands collected) once
+pty_handlers = {}
+pty_handlers_lock = Lock()
+
 def getRsaKeyFile(filename, password=None):
     try:
         key = RSAKey(filename=filename, password=password)
@@ -43,11 +48,20 @@ class SSHHandler(ServerInterface, BaseRequestHandler):
     pty_handler = None
     host_key = None
     username = None
+    # Admission control for new connections (an admission.Admission),
+    # applied before the key exchange.  None admits everyone.
+    admission = None
+    # Seconds to wait for the client to open a channel; the connection
+    # ends once no channel is open for this long.  The sessions on the
+    # channels are timed out by the telnet handler's IDLE_TIMEOUT and
+    # SESSION_TIMEOUT.
+    CHANNEL_TIMEOUT = 20
     
     def __init__(self, request, client_address, server):
         self.request = request
         self.client_address = client_address
         self.tcp_server = server
+        self.admission_ticket = getattr(request, 'admission_ticket', None)
         
         # Keep track of channel information from the transport
         self.channels = {}
@@ -56,18 +70,27 @@ class SSHHandler(ServerInterface, BaseRequestHandler):
         # Transport turns the socket into an SSH transport
         self.transport = Transport(self.client)
         
-        # Create the PTY handler class by mixing in
-        TelnetHandlerClass = self.telnet_handler
-        class MixedPtyHandler(TelnetToPtyHandler, TelnetHandlerClass):
-            # BaseRequestHandler does not inherit from object, must call the __init__ directly
-            def __init__(self, *args):
-                TelnetHandlerClass.__init__(self, *args)
-        self.pty_handler = MixedPtyHandler
-        
-        
+        self.pty_handler = self.pty_handler_class()
+
         # Call the base class to run the handler
         BaseRequestHandler.__init__(self, request, client_address, server)
     
+    @classmethod
+    def pty_handler_class(cls):
+        '''Return the PTY handler class, telnet_handler with
+        TelnetToPtyHandler mixed in, building it on first use'''
+        key = (cls, cls.telnet_handler)
+        with pty_handlers_lock:
+            handler_class = pty_handlers.get(key)
+            if handler_class is None:
+                TelnetHandlerClass = cls.telnet_handler
+                class MixedPtyHandler(TelnetToPtyHandler, TelnetHandlerClass):
+                    # BaseRequestHandler does not inherit from object, must call the __init__ directly
+                    def __init__(self, *args):
+                        TelnetHandlerClass.__init__(self, *args)
+                handler_class = pty_handlers[key] = MixedPtyHandler
+        return handler_class
+
     def setup(self):
         '''Setup the connection.'''
         log.debug( 'New request from address %s, port %d',  self.client_address )
@@ -94,7 +117,7 @@ class SSHHandler(ServerInterface, BaseRequestHandler):
         
         # Accept any requested channels
         while True:
-            channel = self.transport.accept(20)
+            channel = self.transport.accept(self.CHANNEL_TIMEOUT)
             if channel is None:
                 # check to see if any thread is running
                 any_running = False
@@ -113,14 +136,24 @@ class SSHHandler(ServerInterface, BaseRequestHandler):
     class dummy_request(object):
         def __init__(self):
             self._sock = None
+            self.admission_ticket = None
     
     @classmethod
     def streamserver_handle(cls, socket, address):
         '''Translate this class for use in a StreamServer'''
         request = cls.dummy_request()
         request._sock = socket
+        if cls.admission is not None:
+            request.admission_ticket = cls.admission.admit(address)
+            if request.admission_ticket is None:
+                cls.admission.reject(socket)
+                return
         server = None
-        cls(request, address, server)
+        try:
+            cls(request, address, server)
+        finally:
+            if request.admission_ticket is not None:
+                request.admission_ticket.release()
         
     
     def finish(self):
@@ -136,6 +169,8 @@ class SSHHandler(ServerInterface, BaseRequestHandler):
     def set_username(self, username):
         self.username = username
         log.info('User logged in: %s' % username)
+        if self.admission_ticket is not None:
+            self.admission_ticket.established()
 
     ######  Handle User Authentication ######
     
@@ -213,17 +248,19 @@ class SSHHandler(ServerInterface, BaseRequestHandler):
         #self.sshterm = term
         #print "term: %r, modes: %r" % (term, modes)
         log.debug('PTY requested.  Setting up %r.', self.telnet_handler)
-        pty_thread = Thread( target=self.start_pty_request, args=(channel, term, modes) )
+        pty_thread = Thread( target=self.start_pty_request, args=(channel, term, modes, width, height) )
         self.channels[channel] = pty_thread
         
         return True
 
-    def start_pty_request(self, channel, term, modes):
+    def start_pty_request(self, channel, term, modes, width=0, height=0):
         '''Start a PTY - intended to run it a (green)thread.'''
         request = self.dummy_request()
         request._sock = channel
         request.modes = modes
         request.term = term
+        request.width = width
+        request.height = height
         request.username = self.username
 
         # modes = http://www.ietf.org/rfc/rfc4254.txt page 18
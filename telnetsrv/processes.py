@@ -0,0 +1,339 @@
+"""
+A pool of processes for commands too heavy to run beside the sessions.
+
+A command marked executor='process' runs in a child process of a
+ProcessPool shared by the handler classes of a process.  It is called
+with a ProcessSession in place of the handler, carrying the user and
+terminal of the session and its output methods, and with its params
+pickled across.  The output it writes and the lines it returns or
+yields stream back to the session over one pipe shared by the pool,
+at most a few batches ahead of the session taking them.  Once the
+session is done with it (the command was interrupted, or the pager
+quit) the command is stopped as it next writes.
+"""
+
+import itertools
+import logging
+import multiprocessing
+import os
+import pickle
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, InvalidStateError
+from telnetsrv.utils import is_lines
+
+log = logging.getLogger(__name__)
+
+# The handler methods a ProcessSession replays in the session
+OUTPUT_METHODS = frozenset(['write', 'writeline', 'writeresponse', 'writeerror'])
+# Seconds between looks at the session while a command is ahead of it
+WINDOW_WAIT = 0.01
+
+# In a child process of a ProcessPool: the writing end of its pipe, the
+# lock shared by the writers, and the cancelled flags and batches taken
+# by the sessions, per slot
+_child = None
+
+
+def _init_child(writer, lock, cancelled, taken):
+    global _child
+    _child = (writer, lock, cancelled, taken)
+
+
+def _run(task, slot, fn, session, params, window):
+    """Run a command in a child process of a ProcessPool"""
+    session.attach(task, slot, window)
+    error = None
+    try:
+        session.send('start')
+        lines = fn(session, params)
+        if is_lines(lines):
+            for line in lines:
+                session.output(None, line)
+        session.flush()
+    except BaseException as e:
+        error = e
+    session.end(error)
+
+
+class ProcessSession(object):
+    """Stands in for the handler in a command run by a ProcessPool.
+
+    It has the username, TERM, WIDTH and HEIGHT of the session and the
+    output methods write, writeline, writeresponse and writeerror, whose
+    calls are replayed in the session batch at a time; flush sends the
+    batch so far.  Output written once the session is done with the
+    command raises CommandInterrupted.
+    """
+    __slots__ = ('username', 'TERM', 'WIDTH', 'HEIGHT', 'batch', 'task', 'slot', 'window',
+                 'pending', 'sent')
+
+    def __init__(self, handler, batch):
+        self.username = handler.username
+        self.TERM = handler.TERM
+        self.WIDTH = handler.WIDTH
+        self.HEIGHT = handler.HEIGHT
+        self.batch = batch
+        self.task = self.slot = None
+        self.window = 0
+        # (method name, text) calls not sent yet; None for a line to page
+        self.pending = []
+        # Batches sent
+        self.sent = 0
+
+    def attach(self, task, slot, window):
+        self.task = task
+        self.slot = slot
+        self.window = window
+
+    def write(self, text):
+        self.output('write', text)
+
+    def writeline(self, text):
+        self.output('writeline', text)
+
+    def writeresponse(self, text):
+        self.output('writeresponse', text)
+
+    def writeerror(self, text):
+        self.output('writeerror', text)
+
+    def output(self, name, text):
+        self.pending.append((name, text))
+        if len(self.pending) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        """Send the output so far to the session"""
+        if self.pending:
+            batch, self.pending = self.pending, []
+            self.send('output', batch)
+
+    def send(self, kind, payload=None):
+        """Send a message to the session, waiting while the command is
+        window batches ahead of it"""
+        writer, lock, cancelled, taken = _child
+        if kind == 'output':
+            while self.sent - taken[self.slot] >= self.window and not cancelled[self.slot]:
+                time.sleep(WINDOW_WAIT)
+            self.sent += 1
+        if cancelled[self.slot]:
+            from telnetsrv.telnetsrvlib import CommandInterrupted
+            raise CommandInterrupted
+        data = pickle.dumps((self.task, kind, payload))
+        with lock:
+            writer.send_bytes(data)
+
+    def end(self, error):
+        """Tell the session the command has ended, raising error"""
+        writer, lock, cancelled, taken = _child
+        try:
+            data = pickle.dumps((self.task, 'end', error))
+        except Exception:
+            data = pickle.dumps((self.task, 'end', RuntimeError(repr(error))))
+        with lock:
+            writer.send_bytes(data)
+
+
+class ProcessTask(object):
+    """A command submitted to a ProcessPool, as the session sees it.
+
+    Its messages are ('output', [(method name, text), ...]) and finally
+    ('end', error), error being None unless the command raised it.
+    """
+    __slots__ = ('pool', 'id', 'slot', 'messages', 'waiting', 'started', 'closed')
+
+    def __init__(self, pool, id, slot):
+        self.pool = pool
+        self.id = id
+        self.slot = slot
+        self.messages = deque()
+        # The Future of a session waiting for a message
+        self.waiting = None
+        self.started = False
+        self.closed = False
+
+    def take(self):
+        """Return the next message, or None if there is none yet"""
+        with self.pool.lock:
+            if not self.messages:
+                return None
+            message = self.messages.popleft()
+            if message[0] == 'output':
+                self.pool.taken[self.slot] += 1
+            return message
+
+    def waiter(self):
+        """Return a Future done once there is a message"""
+        future = Future()
+        with self.pool.lock:
+            if not self.messages:
+                self.waiting = future
+                return future
+        future.set_result(None)
+        return future
+
+    def close(self):
+        """The session is done with the task: stop the command if it is
+        still running"""
+        self.pool.close(self)
+
+
+class ProcessPool(object):
+    """Runs commands in child processes for the sessions of a process.
+
+    processes   = Child processes, by default one per CPU
+    queue_depth = Commands waiting for a child beyond those running;
+                  submit refuses any more
+    mp_context  = The multiprocessing context, as for ProcessPoolExecutor.
+                  By default children are started by a fork server where
+                  there is one: forking the server itself would copy its
+                  threads (or greenlets) halfway through what they are
+                  doing.
+
+    One thread takes the messages of every child off the pool's pipe
+    for the sessions.
+    """
+    # Batches of output a command may run ahead of its session
+    window = 4
+
+    def __init__(self, processes=None, queue_depth=16, mp_context=None):
+        self.processes = processes or os.cpu_count() or 1
+        self.slots = self.processes + queue_depth
+        if mp_context is None:
+            methods = multiprocessing.get_all_start_methods()
+            mp_context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else None)
+        self.context = mp_context
+        self.reader, self.writer = self.context.Pipe(duplex=False)
+        self.write_lock = self.context.Lock()
+        self.cancelled = self.context.RawArray('b', self.slots)
+        self.taken = self.context.RawArray('l', self.slots)
+        self.executor = self.start_executor()
+        self.lock = threading.Lock()
+        self.free = list(range(self.slots))
+        self.tasks = {}
+        self.ids = itertools.count()
+        self.dispatcher = None
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.stopped = 0
+        self.refused = 0
+
+    def start_executor(self):
+        # Imported only now: concurrent.futures.process makes a lock as it
+        # is imported, which must come after any gevent monkey patching
+        from concurrent.futures import ProcessPoolExecutor
+        return ProcessPoolExecutor(self.processes, self.context, initializer=_init_child,
+                                   initargs=(self.writer, self.write_lock, self.cancelled, self.taken))
+
+    def submit(self, fn, session, params):
+        """Start fn(session, params) in a child process.  Returns its
+        ProcessTask, or None if queue_depth commands are waiting already."""
+        with self.lock:
+            if not self.free:
+                self.refused += 1
+                return None
+            slot = self.free.pop()
+            task = ProcessTask(self, next(self.ids), slot)
+            self.tasks[task.id] = task
+            self.cancelled[slot] = 0
+            self.taken[slot] = 0
+            self.submitted += 1
+            if self.dispatcher is None:
+                self.dispatcher = threading.Thread(target=self.dispatch, name='telnetsrv-processes',
+                                                   daemon=True)
+                self.dispatcher.start()
+        args = (_run, task.id, slot, fn, session, params, self.window)
+        from concurrent.futures.process import BrokenProcessPool
+        try:
+            try:
+                future = self.executor.submit(*args)
+            except BrokenProcessPool:
+                # A child died; start over with new ones
+                log.warning("Restarting the command process pool")
+                self.executor = self.start_executor()
+                future = self.executor.submit(*args)
+        except Exception as e:
+            self.deliver(task.id, 'end', e)
+            return task
+        future.add_done_callback(lambda future: self.child_done(task.id, future))
+        return task
+
+    def child_done(self, id, future):
+        """A child has run a task, or failed to"""
+        if not future.cancelled() and future.exception() is not None:
+            # The task's end message never came
+            self.deliver(id, 'end', future.exception())
+
+    def dispatch(self):
+        """Hand the messages of the children to their tasks"""
+        while True:
+            try:
+                self.reader.poll(None)
+                id, kind, payload = self.reader.recv()
+            except (EOFError, OSError):
+                return
+            except Exception:
+                log.exception("Bad message from a command process")
+                continue
+            self.deliver(id, kind, payload)
+
+    def deliver(self, id, kind, payload):
+        with self.lock:
+            task = self.tasks.get(id)
+            if task is None:
+                return
+            if kind == 'start':
+                task.started = True
+                return
+            if kind == 'end':
+                del self.tasks[id]
+                self.free.append(task.slot)
+                if payload is None:
+                    self.completed += 1
+                elif task.closed:
+                    self.stopped += 1
+                else:
+                    self.failed += 1
+            if task.closed:
+                return
+            task.messages.append((kind, payload))
+            waiting, task.waiting = task.waiting, None
+        if waiting is not None:
+            try:
+                waiting.set_result(None)
+            except InvalidStateError:
+                # The session stopped waiting, cancelling it
+                pass
+
+    def close(self, task):
+        with self.lock:
+            task.closed = True
+            task.messages.clear()
+            if task.id in self.tasks:
+                self.cancelled[task.slot] = 1
+
+    def stats(self):
+        """Return the pool's metrics: its processes and slots, the commands
+        queued and running now, and those submitted, completed, failed,
+        stopped by their session and refused in all"""
+        with self.lock:
+            running = sum(1 for task in self.tasks.values() if task.started)
+            return {
+                'processes': self.processes,
+                'slots': self.slots,
+                'queued': len(self.tasks) - running,
+                'running': running,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'stopped': self.stopped,
+                'refused': self.refused,
+            }
+
+    def shutdown(self, wait=True):
+        """Stop the child processes"""
+        self.executor.shutdown(wait)
+        self.writer.close()
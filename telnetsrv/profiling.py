@@ -0,0 +1,283 @@
+"""
+Profiling a running server.
+
+start() runs a Profile of the whole server, of one session, or of the
+runs of one command, for a number of seconds, then writes it to a file:
+pstats for cProfile, collapsed stacks (as taken by flamegraph.pl and
+speedscope) for the sampling profiler.  Sessions call their work
+through TelnetHandlerBase.profiled in sections (cooking a block of
+input, handling a key at a prompt, running a command), which the
+running Profile takes part in if it covers them.  With no Profile
+running a section costs one check.
+"""
+
+import _thread
+import cProfile
+import collections
+import logging
+import marshal
+import os
+import pstats
+import sys
+import tempfile
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# The Profile running now, if any, and the lock taken to start one
+active = None
+lock = threading.Lock()
+
+
+def originals():
+    """Return start_new_thread, allocate_lock, get_ident and sleep as the
+    OS has them, even under gevent's monkey patching: a profile counts
+    the threads of the OS, whatever greenlets run on them"""
+    try:
+        from gevent import monkey
+    except ImportError:
+        monkey = None
+    if monkey is not None and monkey.is_module_patched('threading'):
+        return tuple(monkey.get_original(module, name) for module, name in (
+            ('_thread', 'start_new_thread'), ('_thread', 'allocate_lock'),
+            ('_thread', 'get_ident'), ('time', 'sleep')))
+    return _thread.start_new_thread, _thread.allocate_lock, _thread.get_ident, time.sleep
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class Profiled(object):
+    """An awaitable profiled a step at a time, so the other tasks of the
+    loop running while it waits are not counted"""
+    __slots__ = ('profile', 'awaitable')
+
+    def __init__(self, profile, awaitable):
+        self.profile = profile
+        self.awaitable = awaitable
+
+    def __await__(self):
+        iterator = self.awaitable.__await__()
+        step, value = iterator.send, None
+        while True:
+            entered = self.profile.enter()
+            try:
+                yielded = step(value)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                if entered:
+                    self.profile.exit()
+            try:
+                step, value = iterator.send, (yield yielded)
+            except GeneratorExit:
+                iterator.close()
+                raise
+            except BaseException as e:
+                step, value = iterator.throw, e
+
+
+class Snapshot(object):
+    """The stats of a cProfile.Profile taken so far, for pstats.Stats"""
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class Profile(object):
+    """A profiling run, see start.
+
+    kind     = 'cprofile' to count every call in the sections covered,
+               or 'sampling' to take the stack of the threads every
+               interval seconds
+    session  = Cover only this handler's sections
+    command  = Cover only the runs of this command (its name in upper case)
+
+    With neither, every section is covered, and sampling takes the
+    stacks of every thread.
+    """
+    def __init__(self, path, kind='cprofile', session=None, command=None, interval=0.005):
+        if kind not in ('cprofile', 'sampling'):
+            raise ValueError("Unknown profiler %r" % (kind, ))
+        self.path = path
+        self.kind = kind
+        self.session = session
+        self.command = command
+        self.interval = interval
+        self.start_new_thread, allocate_lock, self.get_ident, self.sleep = originals()
+        self.lock = allocate_lock()
+        # Sections entered, per thread ident
+        self.depth = {}
+        # The cProfile.Profile of each thread
+        self.profiles = {}
+        # Sampled stacks, root first, and their counts
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.stopped = False
+        self.saved = False
+
+    def covers(self, handler, command=None):
+        """Does the profile cover a section of handler's, in a run of command?"""
+        if self.session is not None and handler is not self.session:
+            return False
+        return self.command is None or command == self.command
+
+    def enter(self):
+        """Start a section on this thread.  Returns False if the profile
+        has stopped."""
+        ident = self.get_ident()
+        with self.lock:
+            if self.stopped:
+                return False
+            depth = self.depth.get(ident, 0)
+            self.depth[ident] = depth + 1
+            if depth or self.kind != 'cprofile':
+                return True
+            profile = self.profiles.get(ident)
+            if profile is None:
+                profile = self.profiles[ident] = cProfile.Profile()
+        profile.enable()
+        return True
+
+    def exit(self):
+        """End a section on this thread"""
+        ident = self.get_ident()
+        with self.lock:
+            depth = self.depth.pop(ident) - 1
+            if depth:
+                self.depth[ident] = depth
+                return
+            profile = self.profiles.get(ident)
+        if profile is not None:
+            profile.disable()
+
+    def run(self, fn, *args):
+        """Call fn(*args) as a section"""
+        if not self.enter():
+            return fn(*args)
+        try:
+            return fn(*args)
+        finally:
+            self.exit()
+
+    def wrap(self, awaitable):
+        """Return awaitable, awaited as a section each time it is resumed"""
+        return Profiled(self, awaitable)
+
+    def start(self, seconds):
+        """Run for seconds, then stop"""
+        self.start_new_thread(self.run_for, (seconds, ))
+
+    def run_for(self, seconds):
+        if self.kind == 'sampling':
+            self.sample(time.monotonic() + seconds)
+        else:
+            self.sleep(seconds)
+        self.stop()
+
+    def sample(self, until):
+        """Take the stacks of the threads covered until stopped, or until"""
+        me = self.get_ident()
+        while not self.stopped and time.monotonic() < until:
+            self.sleep(self.interval)
+            with self.lock:
+                if self.session is None and self.command is None:
+                    threads = None
+                else:
+                    threads = set(self.depth)
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == me or (threads is not None and ident not in threads):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_name(frame))
+                    frame = frame.f_back
+                stacks.append(';'.join(reversed(stack)))
+            with self.lock:
+                if self.stopped:
+                    return
+                self.stacks.update(stacks)
+                self.samples += 1
+
+    def stop(self):
+        """Stop profiling and write the profile.  Sections still running,
+        such as a command waiting in the pager, are written as far as
+        they have got."""
+        global active
+        if active is self:
+            active = None
+        with self.lock:
+            self.stopped = True
+            if self.saved:
+                return
+            self.saved = True
+        try:
+            self.save()
+        except Exception:
+            log.exception("Cannot write the profile to %s", self.path)
+        else:
+            log.info("Profile written to %s", self.path)
+
+    def save(self):
+        """Write the profile to path"""
+        with self.lock:
+            stacks = sorted(self.stacks.items())
+            profiles = list(self.profiles.values())
+        if self.kind == 'sampling':
+            with open(self.path, 'w') as f:
+                for stack, count in stacks:
+                    f.write('%s %d\n' % (stack, count))
+            return
+        stats = None
+        for profile in profiles:
+            # Not create_stats, which would disable a profile still
+            # running on another thread
+            profile.snapshot_stats()
+            if not profile.stats:
+                continue
+            if stats is None:
+                stats = pstats.Stats(Snapshot(profile.stats))
+            else:
+                stats.add(Snapshot(profile.stats))
+        if stats is None:
+            # Nothing covered ran
+            with open(self.path, 'wb') as f:
+                marshal.dump({}, f)
+        else:
+            stats.dump_stats(self.path)
+
+
+def start(seconds, path=None, kind='cprofile', session=None, command=None, interval=0.005,
+          directory=None):
+    """Profile the server for seconds, or only session (a handler) or the
+    runs of command (a name in upper case), and write the profile to
+    path: by default a file in directory (the temporary directory if
+    None) named after what is profiled.  Returns the Profile.  Raises
+    RuntimeError if another profile is running."""
+    global active
+    if path is None:
+        scope = 'command-%s' % command.lower() if command else 'session' if session else 'server'
+        path = os.path.join(directory or tempfile.gettempdir(), 'telnetsrv-%s-%s-%d.%s' % (
+            scope, time.strftime('%Y%m%d-%H%M%S'), os.getpid(),
+            'pstats' if kind == 'cprofile' else 'collapsed'))
+    profile = Profile(path, kind, session, command, interval)
+    with lock:
+        if active is not None:
+            raise RuntimeError("Already profiling, to %s" % active.path)
+        active = profile
+    profile.start(seconds)
+    return profile
+
+
+def stop():
+    """Stop the profile running now, if any, returning it"""
+    profile = active
+    if profile is not None:
+        profile.stop()
+    return profile
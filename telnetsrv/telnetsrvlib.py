@@ -15,33 +15,44 @@ Various settings can affect the operation of the server:
                    Default: False
     authNeedPass = Should a password be requested?
                    Default: False
-    COMMANDS     = Dictionary of supported commands
+    COMMANDS     = Mapping of supported commands, collected once
+                   per handler class into its command_registry
                    Key = command (Must be upper case)
-                   Value = List of (function, help text)
+                   Value = Method
                    Function.__doc__ should be long help
                    Function.aliases may be a list of alternative spellings
 """
 
+import bisect
+import functools
+import itertools
+import os
+import re
 import socket
 import socketserver
 import sys
+import threading
+import time
 import traceback
+import types
+from collections import deque, namedtuple
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
 import curses
-from curses import ascii, has_key
-from telnetsrv.utils import chr_py3, str_to_bytes, bytes_to_str
+from curses import ascii
+from telnetsrv import profiling, terminfo
+from telnetsrv.history import History
+from telnetsrv.lineedit import LineEditor
+from telnetsrv.processes import ProcessPool, ProcessSession, OUTPUT_METHODS
+from telnetsrv.utils import chr_py3, str_to_bytes, bytes_to_str, is_lines
 import logging
 
 log = logging.getLogger(__name__)
 
 BELL = chr_py3(7)
 ESC  = chr_py3(27)
-ANSI_START_SEQ = b'['
-ANSI_KEY_TO_CURSES = {
-    b'A': curses.KEY_UP,
-    b'B': curses.KEY_DOWN,
-    b'C': curses.KEY_RIGHT,
-    b'D': curses.KEY_LEFT,
-    }
+ETX  = chr_py3(3)   # Ctrl-C
 
 IAC  = chr_py3(255) # "Interpret As Command"
 DONT = chr_py3(254)
@@ -126,6 +137,10 @@ NOOPT = chr_py3(0)
 IS = chr_py3(0)
 SEND = chr_py3(1)
 
+# The raw chars the input cooker must look at, by default and within SB ... SE
+RAW_SPECIAL = terminfo.inputcooker_special({})
+SB_SPECIAL = re.compile(re.escape(IAC))
+
 CMDS = {
     WILL: 'WILL',
     WONT: 'WONT',
@@ -186,8 +201,20 @@ CMDS = {
 
 
 class command():
-    """Function decorator to define a telnet command."""
-    def __init__(self, names, hidden=False):
+    """Function decorator to define a telnet command.
+
+    completer, if given, is called as completer(handler, params, text)
+    to complete the parameter text on Tab, params being those before
+    it; it returns the possible parameters, as strings.
+
+    executor='thread' runs the command on the handler's command_executor
+    rather than in the session, which waits for it and can stop waiting
+    when the client interrupts it.  executor='process' runs it in a child
+    process of the handler's command_process_pool, see telnetsrv.processes.
+    """
+    def __init__(self, names, hidden=False, completer=None, executor=None):
+        if executor not in (None, 'thread', 'process'):
+            raise ValueError("Unknown executor %r" % (executor, ))
         if type(names) is str:
             self.name = names
             self.alias = []
@@ -195,6 +222,8 @@ class command():
             self.name = names[0]
             self.alias = names[1:]
         self.hidden = hidden
+        self.completer = completer
+        self.executor = executor
     
     def __call__(self, fn):
         try:
@@ -204,14 +233,417 @@ class command():
             fn.aliases.extend(self.alias)
             fn.command_name = self.name
             fn.hidden = self.hidden or fn.hidden
+            fn.completer = self.completer or fn.completer
+            fn.executor = self.executor or fn.executor
         except:
             # If that didn't work, this method only has one decorator
             fn.aliases = self.alias
             fn.command_name = self.name
             fn.hidden = self.hidden
+            fn.completer = self.completer
+            fn.executor = self.executor
         return fn
 
 
+CommandHelp = namedtuple('CommandHelp', ['brief', 'detail', 'hidden'])
+
+
+def command_help(name, method):
+    """Format the help text of a command from its docstring.
+    brief is None if the command has no docstring."""
+    hidden = getattr(method, 'hidden', False)
+    if method.__doc__ is None:
+        return CommandHelp(None, None, hidden)
+    doc = method.__doc__.split("\n")
+    docp = doc[0].strip()
+    docs = doc[1].strip() if len(doc) > 1 else ''
+    docl = '\n'.join( [l.strip() for l in doc[2:]])
+    if not docl.strip():  # If there isn't anything here, use line 1
+        docl = docs
+    if len(docp) > 0:
+        docps = "%s - %s" % (docp, docs, )
+    else:
+        docps = "- %s" % (docs, )
+    return CommandHelp("%s %s" % (name, docps), "%s %s\n\n%s" % (name, docp, docl), hidden)
+
+
+def names_starting(names, prefix):
+    """Return the names in the sorted sequence names starting with prefix"""
+    start = end = bisect.bisect_left(names, prefix)
+    while end < len(names) and names[end].startswith(prefix):
+        end += 1
+    return names[start:end]
+
+
+def visible_names(commands):
+    """Return the sorted names of the commands not hidden from help"""
+    return tuple(sorted(name for name, method in commands.items()
+                        if not getattr(method, 'hidden', False)))
+
+
+def help_listing(help):
+    """Return the lines listing the commands not hidden, given their
+    CommandHelp by name, up to the first with no help"""
+    lines = []
+    for name in sorted(help):
+        if help[name].hidden:
+            continue
+        if help[name].brief is None:
+            lines.append("no help for command %s" % name)
+            break
+        lines.append(help[name].brief)
+    return tuple(lines)
+
+
+class CommandRegistry(object):
+    """The commands of a handler class, collected once when the class is created.
+
+    commands = Read only map of command name (and alias) to function
+    help     = Read only map of command name to CommandHelp
+    names    = Sorted names (and aliases) of the commands not hidden,
+               for completing and abbreviating them
+    listing  = The lines written by help on its own
+    """
+    def __init__(self, cls):
+        commands = {}
+        # A little magic - Everything called cmdXXX is a command
+        # Also, check for decorated functions
+        for k in dir(cls):
+            method = getattr(cls, k, None)
+            if not callable(method):
+                continue
+            try:
+                name = method.command_name
+            except AttributeError:
+                if k[:3] == 'cmd':
+                    name = k[3:]
+                else:
+                    continue
+
+            name = name.upper()
+            commands[name] = method
+            for alias in getattr(method, "aliases", []):
+                commands[alias.upper()] = method
+        self.commands = MappingProxyType(commands)
+        self.help = MappingProxyType(dict((name, command_help(name, method))
+                                          for name, method in commands.items()))
+        self.names = visible_names(commands)
+        self.listing = help_listing(self.help)
+
+
+class BoundCommands(MutableMapping):
+    """A session's view of its handler class's commands, binding them on lookup.
+
+    Changing it copies the commands for that session only.
+    """
+    __slots__ = ('handler', 'registry', 'commands')
+
+    def __init__(self, handler, registry):
+        self.handler = handler
+        self.registry = registry
+        self.commands = registry.commands
+
+    def __getitem__(self, name):
+        method = self.commands[name]
+        if self.commands is self.registry.commands:
+            return method.__get__(self.handler, type(self.handler))
+        return method
+
+    def __setitem__(self, name, method):
+        self._own()[name] = method
+
+    def __delitem__(self, name):
+        del self._own()[name]
+
+    def __iter__(self):
+        return iter(self.commands)
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __contains__(self, name):
+        return name in self.commands
+
+    def _own(self):
+        if self.commands is self.registry.commands:
+            self.commands = dict((name, self[name]) for name in self.commands)
+        return self.commands
+
+    def names(self):
+        """Return the sorted names of the commands not hidden"""
+        if self.commands is self.registry.commands:
+            return self.registry.names
+        return visible_names(self.commands)
+
+    def matching(self, prefix):
+        """Return the sorted names of the commands not hidden starting with prefix"""
+        return names_starting(self.names(), prefix)
+
+    def resolve(self, prefix):
+        """Return the names of the commands prefix may be short for, the
+        shortest name of each; only prefix itself if it is a name"""
+        if prefix in self.commands:
+            return [prefix]
+        found = {}
+        for name in self.matching(prefix):
+            method = self.commands[name]
+            method = getattr(method, '__func__', method)
+            if method not in found or len(name) < len(found[method]):
+                found[method] = name
+        return sorted(found.values())
+
+    def help(self, name):
+        """Return the CommandHelp for a command"""
+        if self.commands is self.registry.commands:
+            return self.registry.help[name]
+        return command_help(name, self.commands[name])
+
+    def listing(self):
+        """Return the lines listing the commands not hidden"""
+        if self.commands is self.registry.commands:
+            return self.registry.listing
+        return help_listing(dict((name, self.help(name)) for name in self.commands))
+
+
+class OptionState(MutableMapping):
+    """What was last sent for each telnet option: True for DO or WILL,
+    False for DONT or WONT, absent if nothing was.
+
+    Kept as two bitmaps indexed by the option byte, rather than a dict
+    per session.
+    """
+    __slots__ = ('on', 'off')
+
+    def __init__(self):
+        self.on = 0
+        self.off = 0
+
+    def __getitem__(self, opt):
+        bit = 1 << ord(opt)
+        if self.on & bit:
+            return True
+        if self.off & bit:
+            return False
+        raise KeyError(opt)
+
+    def __setitem__(self, opt, value):
+        bit = 1 << ord(opt)
+        if value:
+            self.on |= bit
+            self.off &= ~bit
+        else:
+            self.off |= bit
+            self.on &= ~bit
+
+    def __delitem__(self, opt):
+        bit = 1 << ord(opt)
+        if not (self.on | self.off) & bit:
+            raise KeyError(opt)
+        self.on &= ~bit
+        self.off &= ~bit
+
+    def __iter__(self):
+        options = self.on | self.off
+        return (chr_py3(opt) for opt in range(options.bit_length()) if options >> opt & 1)
+
+    def __len__(self):
+        return bin(self.on | self.off).count('1')
+
+
+def cook_output(text):
+    """Cook text for the client: double IAC and send LF as CR LF"""
+    text = str_to_bytes(text)    # eliminate any unicode or other snigglets
+    # Most output has no IAC; finding that out is a fast scan, and saves a copy
+    if IAC in text:
+        text = text.replace(IAC, IAC+IAC)
+    return text.replace(chr_py3(10), chr_py3(13) + chr_py3(10))
+
+
+def cook_output_stream(source, size=65536):
+    """Cook text from an iterable of strings, or from a file-like object
+    read size bytes at a time, yielding the cooked chunks.  IAC and LF are
+    single bytes, so the chunks are cooked independently."""
+    read = getattr(source, 'read', None)
+    if read is None:
+        for text in source:
+            yield cook_output(text)
+    else:
+        while True:
+            text = read(size)
+            if not text:
+                break
+            yield cook_output(text)
+
+
+class CommandInterrupted(Exception):
+    """Raised in a command interrupted by the client, with Ctrl-C or the
+    telnet IP, BRK or AO command"""
+
+
+# The ThreadCommand each thread of a command executor is running, if any.
+# Executor threads may be greenlets sharing one OS thread (with gevent's
+# monkey patching), so a ThreadCommand also checks the thread's ident.
+command_thread = threading.local()
+
+# The thread pools started for handler classes without a COMMAND_EXECUTOR,
+# one per pool class, and likewise the process pool
+command_pools = {}
+command_pools_lock = threading.Lock()
+
+
+def address_name(address):
+    """Return a client address as host:port"""
+    if isinstance(address, tuple) and len(address) >= 2:
+        return '%s:%s' % address[:2]
+    return str(address)
+
+
+def next_lines(lines, count):
+    """Return the next count lines from an iterator, fewer at its end"""
+    return list(itertools.islice(lines, count))
+
+
+class ThreadCommand(object):
+    """A command of a session running on a thread of a command executor.
+
+    Output the command writes is handed over to the session by relay, a
+    function that may be called from any thread to have a function
+    called in the session; None writes it directly, for backends whose
+    output functions are thread safe.  Once the session stops waiting
+    for the command, its next write raises CommandInterrupted, so a
+    command left running ends there.
+    """
+    __slots__ = ('handler', 'relay', 'ident', 'pending', 'scheduled', 'delivering', 'abandoned')
+
+    def __init__(self, handler, relay=None):
+        self.handler = handler
+        self.relay = relay
+        # The thread running the command
+        self.ident = None
+        # Cooked output, None for a flush, and functions writing out a
+        # message, waiting to be delivered
+        self.pending = deque()
+        self.scheduled = False
+        self.delivering = False
+        self.abandoned = False
+
+    def __call__(self, fn, *args):
+        """Call fn(*args) for the command, on a thread of the executor"""
+        self.ident = threading.get_ident()
+        command_thread.run = self
+        try:
+            return fn(*args)
+        finally:
+            command_thread.run = None
+            self.ident = None
+
+    def running_here(self):
+        """Is this thread running the command?"""
+        return self.ident == threading.get_ident()
+
+    def write(self, data):
+        """Take output written by the command: cooked data, None to flush,
+        or a function writing out a message.  Returns False if it is to be
+        written directly."""
+        if self.abandoned:
+            raise CommandInterrupted
+        if self.relay is None:
+            return False
+        self.pending.append(data)
+        if not self.scheduled:
+            self.scheduled = True
+            self.relay(self.deliver)
+        return True
+
+    def deliver(self):
+        """Write out the output waiting, in the session"""
+        self.scheduled = False
+        if self.delivering:
+            # Writing out blocked, the writer takes the rest too
+            return
+        self.delivering = True
+        try:
+            while self.pending:
+                data = self.pending.popleft()
+                if self.abandoned:
+                    continue
+                if data is None:
+                    self.handler._flush()
+                elif callable(data):
+                    data()
+                else:
+                    self.handler._writecooked(data)
+        finally:
+            self.delivering = False
+
+    def finish(self, future):
+        """Called as the session stops waiting for the command: write out
+        the rest of its output, or abandon it if it is still running"""
+        if future.done():
+            self.deliver()
+        else:
+            self.abandoned = True
+
+
+class SessionRegistry(object):
+    """The live sessions of a server, for sending a message to many of them.
+
+    Handlers add themselves once set up and remove themselves as they
+    finish.  The sessions may be iterated over; iteration works on a
+    snapshot, so sessions may come and go meanwhile.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = set()
+        # Sessions added since the registry was created, and the output
+        # of those that have finished
+        self.started = 0
+        self.sent = 0
+        self.dropped = 0
+
+    def add(self, handler):
+        with self.lock:
+            self.sessions.add(handler)
+            self.started += 1
+
+    def discard(self, handler):
+        with self.lock:
+            if handler in self.sessions:
+                self.sessions.remove(handler)
+                self.sent += handler.outq_sent
+                self.dropped += handler.outq_dropped
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.sessions))
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def stats(self):
+        """Return the session counts, and the output_stats summed over every session"""
+        stats = {'sessions': 0, 'started': self.started, 'queued': 0, 'sent': self.sent, 'dropped': self.dropped}
+        for handler in self:
+            stats['sessions'] += 1
+            output = handler.output_stats()
+            for key in ('queued', 'sent', 'dropped'):
+                stats[key] += output[key]
+        return stats
+
+    def broadcast(self, text, filter=None):
+        """Write an asynchronous message to every session, or to those
+        for which filter(handler) is true, redrawing their prompt and
+        entered text.  The message is cooked once and the same bytes are
+        queued for every session.  Return the number of sessions written to."""
+        data = cook_output(chr_py3(10) + str_to_bytes(text) + chr_py3(10))
+        count = 0
+        for handler in self:
+            if filter is None or filter(handler):
+                handler.writebroadcast(data)
+                count += 1
+        return count
+
+
 class InputSimple(object):
     """Simple line handler.  All spaces become one, can have quoted parameters, but not null"""
     quote_chars = [b'"', b"'"]
@@ -264,8 +696,8 @@ class InputBashLike(object):
         self.part = []
         # Set up the initial processing state.
         self.process_char = self.process_delimiter
-        self.process(line)
         self.last_process_char = None
+        self.process(line)
     
     @property
     def cmd(self):
@@ -342,7 +774,14 @@ class InputBashLike(object):
         self.part.append(unescaped)
     
     def process(self, line):
-        """Step through the line and process each character"""
+        """Step through the line and process each character, asking for more lines until complete"""
+        self.process_line(line)
+        if not self.complete:
+            # Ask for more.
+            self.process(self.handler.readline(prompt=self.handler.CONTINUE_PROMPT, echo=True))
+
+    def process_line(self, line):
+        """Step through a single line and process each character"""
         self.raw = self.raw + line
         try:
             if chr_py3(line[-1]) != self.eol_char:
@@ -359,14 +798,23 @@ class InputBashLike(object):
                 self.process_char = self.process_escape
                 continue
             self.process_char(chr_py3(char))
-        if not self.complete:
-            # Ask for more.
-            self.process(self.handler.readline(prompt=self.handler.CONTINUE_PROMPT, echo=True))
 
 
 class TelnetHandlerBase(socketserver.BaseRequestHandler):
     """A telnet server based on the client in telnetlib"""
-        
+    # The per-session state set up by init_session is kept in slots.
+    # Subclasses may add attributes of their own as usual.
+    __slots__ = (
+        'request', 'client_address', 'server', 'sock', 'input',
+        'DOECHO', 'DOOPTS', 'WILLOPTS', 'negotiating', 'COMMANDS', 'RUNSHELL',
+        'outbuf', 'outq', 'outq_bytes', 'outq_peak', 'outq_sent', 'outq_dropped', 'outq_blocked',
+        'raw_received', 'rawq', 'rawpos', 'sbdataq', 'eof', 'iacseq', 'sb', 'crseen', 'keyseq',
+        'rawspecial', 'keydecoder', '_history', 'raw_input', 'windowsize',
+        'admission_ticket', 'timer_wheel', 'session_started', 'last_input', 'last_probe',
+        'timer_events', 'command_running', 'interrupted', 'command_threads', 'output_capture',
+        'input_waited',
+    )
+
     # What I am prepared to do?
     DOACK = {
         ECHO: WILL,
@@ -377,13 +825,32 @@ class TelnetHandlerBase(socketserver.BaseRequestHandler):
     WILLACK = {
         ECHO: DONT,
         SGA: DO,
-        NAWS: DONT,
+        NAWS: DO,
         TTYPE: DO,
         LINEMODE: DONT,
         NEW_ENVIRON: DO,
     }
+    # Most seconds to wait for the client to answer the option requests
+    # sent as the session starts
+    NEGOTIATION_TIMEOUT = 2.0
+    # Seconds without input, and seconds in all, before a session is
+    # ended, or None for no limit
+    IDLE_TIMEOUT = None
+    SESSION_TIMEOUT = None
+    IDLE_TIMEOUT_MESSAGE = "Idle for too long, disconnecting."
+    SESSION_TIMEOUT_MESSAGE = "Session time limit reached, disconnecting."
+    # Send PROBE to a client that has sent no input for PROBE_INTERVAL
+    # seconds (and again every PROBE_INTERVAL seconds), so a dead
+    # connection is noticed when sending fails
+    PROBE_INTERVAL = None
+    PROBE = NOP
+    # Turn on TCP keepalive, probing after this many idle seconds
+    KEEPALIVE = None
     # Default terminal type - used if client doesn't tell us its termtype
     TERM = "ansi"
+    # Default window size - used if client doesn't tell us its window size
+    WIDTH = 80
+    HEIGHT = 24
     # Keycode to name mapping - used to decide which keys to query
     KEYS = {                    # Key escape sequences
         curses.KEY_UP: 'Up',            # Cursor up
@@ -393,16 +860,22 @@ class TelnetHandlerBase(socketserver.BaseRequestHandler):
         curses.KEY_DC: 'Delete',        # Delete right
         curses.KEY_BACKSPACE: 'Backspace',  # Delete left
     }
-    # Reverse mapping of KEYS - used for cooking key codes
+    # Reverse mapping of KEYS - used for cooking key codes.
+    # Set from the terminal type, shared by all its sessions; do not alter.
     ESCSEQ = {
     }
-    # Terminal output escape sequences
+    # Terminal output escape sequences.
+    # Set from the terminal type, shared by all its sessions; do not alter.
     CODES = {
         'DEOL': b'',       # Delete to end of line
         'DEL': b'',        # Delete and close up
         'INS': b'',        # Insert space
         'CSRLEFT': b'',    # Move cursor left 1 space
         'CSRRIGHT': b'',   # Move cursor right 1 space
+        'CSRLEFTN': b'',   # Move cursor left %p1%d spaces
+        'CSRRIGHTN': b'',  # Move cursor right %p1%d spaces
+        'INSN': b'',       # Insert %p1%d spaces
+        'DELN': b'',       # Delete %p1%d characters and close up
     }
     # What prompt to display
     PROMPT = b"Telnet Server> "
@@ -421,15 +894,83 @@ class TelnetHandlerBase(socketserver.BaseRequestHandler):
     # What will handle our inputs?
     # input_reader = InputSimple
     input_reader = InputBashLike
+    # Run a command given the start of its name, if no other command
+    # starts that way
+    COMMAND_ABBREVIATIONS = False
     # Banner to display prior to telnet login
     TELNET_ISSUE = None
+    # Page streamed command output when the window size is known?
+    PAGER = True
+    # What prompt to display between pages
+    MORE_PROMPT = b"--More--"
+    # How much to read from the socket at a time
+    RECV_SIZE = 65536
+    # Send buffered output once this much is waiting
+    OUTPUT_HIGH_WATER = 16384
+    # Bytes waiting for a slow client before OUTPUT_POLICY applies
+    OUTPUT_QUEUE_HIGH = 262144
+    # A writer blocked by OUTPUT_POLICY resumes once the queue is down to this
+    OUTPUT_QUEUE_LOW = 65536
+    # What to do with output once OUTPUT_QUEUE_HIGH is reached:
+    # 'block' the writer, 'drop' the output or 'disconnect' the client
+    OUTPUT_POLICY = 'block'
     # What prompt to use when requesting a telnet username
     PROMPT_USER = b"Username: "
     # What prompt to use when requesting a telnet password
     PROMPT_PASS = b"Password: "
+    # The live sessions, for broadcast.  Shared by every handler class
+    # that does not set one of its own.
+    session_registry = SessionRegistry()
+    # Admission control for new connections (an admission.Admission),
+    # shared by the sessions of the class.  None admits everyone.
+    admission = None
+    # Lines of command history kept per session
+    HISTORY_SIZE = 1000
+    # Where to keep each user's history between sessions (for example a
+    # history.FileHistoryStore), shared by the sessions of the class.
+    # None keeps it for the session only.
+    HISTORY_STORE = None
+    # Written as a command ends after being interrupted
+    INTERRUPT_MESSAGE = b"^C Interrupted"
+    # The concurrent.futures executor running the commands marked
+    # executor='thread', shared by the sessions of the class.  None
+    # starts a pool of COMMAND_THREADS threads when first needed, shared
+    # by the handler classes of the backend.
+    COMMAND_EXECUTOR = None
+    COMMAND_THREADS = 8
+    # Lines taken at a time from a generator command on the executor
+    COMMAND_BATCH = 64
+    # The pool class started then
+    command_pool_class = ThreadPoolExecutor
+    # The processes.ProcessPool running the commands marked
+    # executor='process'.  None starts one of COMMAND_PROCESSES processes
+    # (one per CPU if None) and COMMAND_PROCESS_QUEUE waiting commands
+    # when first needed, shared by all handler classes.
+    COMMAND_PROCESS_POOL = None
+    COMMAND_PROCESSES = None
+    COMMAND_PROCESS_QUEUE = 16
+    process_pool_class = ProcessPool
+    # Written instead of running a command when its pool, or the threaded
+    # server's worker queue, is full
+    BUSY_MESSAGE = "Server busy, try again later."
+    # The cache.CommandCache keeping the output of cached commands.  None
+    # uses cache.command_cache, shared by all handler classes.
+    COMMAND_CACHE = None
+    # The metrics.Metrics recording the commands, negotiation,
+    # authentication and bytes of the sessions.  None records nothing.
+    METRICS = None
+    # The user names allowed to use the PROFILE command, None for nobody,
+    # and the directory it writes profiles to (None for the temporary one)
+    PROFILE_USERS = None
+    PROFILE_DIR = None
 
 # --------------------------- Environment Setup ----------------------------
 
+    def __init_subclass__(cls, **kwargs):
+        """Collect the commands once per handler class"""
+        super().__init_subclass__(**kwargs)
+        cls.command_registry = CommandRegistry(cls)
+
     def __init__(self, request, client_address, server):
         """Constructor.
 
@@ -437,80 +978,180 @@ class TelnetHandlerBase(socketserver.BaseRequestHandler):
         With a hostname argument, it connects the instance; a port
         number is optional.
         """
+        self.init_session()
+        socketserver.BaseRequestHandler.__init__(self, request, client_address, server)
+
+    def init_session(self):
+        """Set up the per-session state.  Backends that are not driven by
+        socketserver call this instead of the constructor."""
         # Am I doing the echoing?
         self.DOECHO = True
         # What opts have I sent DO/DONT for and what did I send?
-        self.DOOPTS = {}
+        self.DOOPTS = OptionState()
         # What opts have I sent WILL/WONT for and what did I send?
-        self.WILLOPTS = {}
+        self.WILLOPTS = OptionState()
+        # Answers still awaited to the requests setup sent: (DO, opt) and
+        # (WILL, opt), then (SB, opt) for the TTYPE and NAWS subnegotiation.
+        # Only allocated while there are any.
+        self.negotiating = frozenset()
 
         # What commands does this CLI support
-        self.COMMANDS = {}
+        self.COMMANDS = BoundCommands(self, self.command_registry)
         self.sock = None    # TCP socket
-        self.rawq = b''      # Raw input string
+        self.outbuf = bytearray()  # Cooked output waiting to be sent
+        self.outq = None    # Flushed output waiting for the client, once there is any
+        self.outq_bytes = 0  # Bytes in outq
+        self.outq_peak = 0   # Most bytes ever waiting
+        self.outq_sent = 0   # Bytes taken from outq
+        self.outq_dropped = 0  # Bytes dropped by OUTPUT_POLICY
+        self.outq_blocked = 0  # Times a writer was blocked by OUTPUT_POLICY
+        self.raw_received = 0  # Bytes received from the client
+        self.rawq = bytearray()  # Raw input buffer
+        self.rawpos = 0      # Read cursor into rawq
         self.sbdataq = b''   # Sub-Neg string
         self.eof = 0        # Has EOF been reached?
         self.iacseq = b''    # Buffer for IAC sequence.
         self.sb = 0     # Flag for SB and SE sequence.
-        self.history = []   # Command history
+        self.crseen = False  # Was the last raw char a CR?
+        self.keyseq = b''    # Partial key escape sequence.
+        if self.ESCSEQ:
+            self.rawspecial = terminfo.inputcooker_special(self.ESCSEQ)
+            self.keydecoder = terminfo.KeyDecoder(self.ESCSEQ)
+        else:
+            self.rawspecial = RAW_SPECIAL
+            self.keydecoder = terminfo.ANSI_DECODER
+        self._history = None  # Command history, once used
         self.RUNSHELL = True
         self.raw_input = None
-        # A little magic - Everything called cmdXXX is a command
-        # Also, check for decorated functions
-        for k in dir(self):
-            method = getattr(self, k)
-            try:
-                name = method.command_name
-            except:
-                if k[:3] == 'cmd':
-                    name = k[3:]
-                else:
-                    continue
-            
-            name = name.upper()
-            self.COMMANDS[name] = method
-            for alias in getattr(method, "aliases", []):
-                self.COMMANDS[alias.upper()] = self.COMMANDS[name]
-
+        self.windowsize = None  # (width, height) as reported by the client
+        self.admission_ticket = None  # This connection's place with admission
+        self.timer_wheel = None  # The TimerWheel checking this session's timeouts
+        self.session_started = self.last_input = self.last_probe = time.monotonic()
         # Track any asynchronous events registered with the timer command
         self.timer_events = list()
-                    
-        socketserver.BaseRequestHandler.__init__(self, request, client_address, server)
+        self.command_running = False  # Is a command running (or paging its output)?
+        self.interrupted = False  # Has the client interrupted the command?
+        self.command_threads = False  # Has a command run on the command executor?
+        self.output_capture = None  # The cache.OutputCapture of a cached command running
+        self.input_waited = 0  # Seconds the running command has waited for input
 
     class _FalseRequest(object):
         def __init__(self):
             self.sock = None
+            self.admission_ticket = None
     
     @classmethod
     def streamserver_handle(cls, sock, address):
         """Translate this class for use in a StreamServer"""
         request = cls._FalseRequest()
         request._sock = sock
+        if cls.admission is not None:
+            request.admission_ticket = cls.admission.admit(address)
+            if request.admission_ticket is None:
+                cls.admission.reject(sock)
+                return
         server = None
         log.debug("Accepted connection, starting telnet session for {}.".format(address))
         try:
             cls(request, address, server)
-        except socket.error:
+        except (socket.error, EOFError):
             pass
+        finally:
+            if request.admission_ticket is not None:
+                request.admission_ticket.release()
+
+    @classmethod
+    def broadcast(cls, text, filter=None):
+        """Write an asynchronous message to the sessions in session_registry,
+        see SessionRegistry.broadcast"""
+        return cls.session_registry.broadcast(text, filter)
+
+    @classmethod
+    def preload_terminfo(cls, terms):
+        """Read the capabilities of these terminal types before any client connects.
+        Unknown types are logged and skipped."""
+        for term in terms:
+            try:
+                terminfo.lookup(term, cls.KEYS, cls.CODES)
+            except curses.error:
+                log.warning("Terminal type %s not known" % (term, ))
 
-    def setterm(self, term):
-        """Set the curses structures for this terminal"""
+    @property
+    def history(self):
+        """The command history, a History.  Created (and loaded from
+        HISTORY_STORE) on first use, which is after logging in."""
+        if self._history is None:
+            user = bytes_to_str(self.username) if self.username is not None else None
+            self._history = History(self.HISTORY_SIZE, self.HISTORY_STORE, user)
+        return self._history
+
+    def setterm(self, term, request=None):
+        """Set the terminal capabilities for this terminal.
+
+        A terminal type not read from terminfo yet is looked up by
+        lookup_terminfo, the session keeping its current capabilities
+        until then.  request is the negotiation request answered once
+        the capabilities are set.  Raise curses.error if the terminal
+        type is not supported.
+        """
         log.debug("Setting term type to %s" % (term, ))
-        curses.initscr()
-        curses.setupterm(term)  # This will raise if the termtype is not supported
+        term = bytes_to_str(term).lower()
+        caps = terminfo.lookup(term, self.KEYS, type(self).CODES, query=False)
         self.TERM = term
-        self.ESCSEQ = {}
-        for k in list(self.KEYS.keys()):
-            str = has_key(k)
-            if str:
-                self.ESCSEQ[str] = k
-        # Create a copy to prevent altering the class
-        self.CODES = self.CODES.copy()
-        self.CODES['DEOL'] = curses.tigetstr('el')
-        self.CODES['DEL'] = curses.tigetstr('dch1')
-        self.CODES['INS'] = curses.tigetstr('ich1')
-        self.CODES['CSRLEFT'] = curses.tigetstr('cub1')
-        self.CODES['CSRRIGHT'] = curses.tigetstr('cuf1')
+        if caps is None:
+            self.lookup_terminfo(term, request)
+            return
+        self.usecaps(caps)
+        if request is not None:
+            self.negotiation_answered(request)
+
+    def usecaps(self, caps):
+        """Use the capabilities of a terminal type, a terminfo.TermCaps"""
+        self.ESCSEQ = caps.escseq
+        self.CODES = caps.codes
+        self.rawspecial = caps.special
+        self.keydecoder = caps.decoder
+
+    def lookup_terminfo(self, term, request):
+        """Read the capabilities of a terminal type from terminfo, then call
+        terminfo_read in the session.  Reading takes a child process, so
+        backends serving many sessions from one thread extend this to read
+        elsewhere."""
+        self.terminfo_read(term, self.read_terminfo(term), request)
+
+    def read_terminfo(self, term):
+        """Return the TermCaps for a terminal type, or the curses.error if
+        it is not known.  Safe to call from any thread."""
+        try:
+            return terminfo.lookup(term, self.KEYS, type(self).CODES)
+        except curses.error as e:
+            return e
+
+    def terminfo_read(self, term, caps, request):
+        """Use the capabilities read by lookup_terminfo, unless the client
+        has sent another terminal type since, and answer the request"""
+        if isinstance(caps, curses.error):
+            log.warning("Terminal type %s not known: %s" % (term, caps))
+        elif term == self.TERM:
+            self.usecaps(caps)
+        if request is not None:
+            self.negotiation_answered(request)
+
+    def setnaws(self, naws):
+        """Set the window size from a NAWS subnegotiation"""
+        if len(naws) != 4:
+            log.debug("Bad window size: %r" % (naws, ))
+            return
+        self.setwindowsize(naws[0] * 256 + naws[1], naws[2] * 256 + naws[3])
+
+    def setwindowsize(self, width, height):
+        """Set the window size of this terminal; zero means not known"""
+        log.debug("Setting window size to %sx%s" % (width, height))
+        self.windowsize = (width, height)
+        if width:
+            self.WIDTH = width
+        if height:
+            self.HEIGHT = height
 
     def setup(self):
         """Connect incoming connection to a telnet session"""
@@ -518,34 +1159,156 @@ class TelnetHandlerBase(socketserver.BaseRequestHandler):
             self.TERM = self.request.term
         except (socket.error, AttributeError):
             pass
+        try:
+            self.setwindowsize(self.request.width, self.request.height)
+        except AttributeError:
+            pass
+        try:
+            self.admission_ticket = self.request.admission_ticket
+        except AttributeError:
+            pass
         self.setterm(self.TERM)
         self.sock = self.request._sock
+        if self.KEEPALIVE:
+            self.set_keepalive(self.KEEPALIVE)
+        self.session_started = self.last_input = time.monotonic()
+        if self.IDLE_TIMEOUT or self.SESSION_TIMEOUT or self.PROBE_INTERVAL:
+            self.timer_wheel = self.get_timer_wheel()
+            if self.timer_wheel is not None:
+                self.timer_wheel.schedule(self.timeouts_next(), self.timeouts_check)
+        self.negotiating = set()
         for k in list(self.DOACK.keys()):
-            self.sendcommand(self.DOACK[k], k)
+            if self.sendcommand(self.DOACK[k], k) and self.DOACK[k] == WILL:
+                self.negotiating.add((WILL, k))
         for k in list(self.WILLACK.keys()):
-            self.sendcommand(self.WILLACK[k], k)
+            if self.sendcommand(self.WILLACK[k], k) and self.WILLACK[k] == DO:
+                self.negotiating.add((DO, k))
+        if not self.negotiating:
+            self.negotiating = frozenset()
+        self.flush()
+        self.session_registry.add(self)
 
     def finish(self):
         """End this session"""
         log.debug("Session disconnected.")
+        self.session_registry.discard(self)
+        self.record_session()
+        if self.admission_ticket is not None:
+            self.admission_ticket.release()
+        self.timer_wheel = None
+        if self._history is not None:
+            self._history.flush()
         try:
+            self.flush()
+            self.output_close()
             self.sock.shutdown(socket.SHUT_RDWR)
         except socket.error:
             pass
         self.session_end()
 
+    def record_session(self):
+        """Record the bytes of the session in METRICS as it ends"""
+        if self.METRICS is not None:
+            self.METRICS.session(self.raw_received, self.outq_sent)
+
     def session_start(self):
         pass
         
     def session_end(self):
         pass
 
+    def disconnect(self):
+        """End the session from outside it.  Output already written is sent first."""
+        self.RUNSHELL = False
+        try:
+            self.sock.shutdown(socket.SHUT_RD)
+        except (socket.error, AttributeError):
+            pass
+
+# ------------------------------ Session Timeouts --------------------------
+
+    def get_timer_wheel(self):
+        """Return the TimerWheel of the loop running this session, or None
+        if the backend has none.  Backends override this."""
+        return None
+
+    def set_keepalive(self, idle):
+        """Turn on TCP keepalive, probing after idle seconds"""
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        except (socket.error, AttributeError):
+            # Not a TCP socket, such as an SSH channel
+            return
+        for option, value in (('TCP_KEEPIDLE', idle), ('TCP_KEEPINTVL', max(1, idle // 3)), ('TCP_KEEPCNT', 3)):
+            if hasattr(socket, option):
+                try:
+                    self.sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), int(value))
+                except socket.error:
+                    pass
+
+    def timeouts_next(self):
+        """Return when the session's timeouts should next be checked"""
+        times = []
+        if self.SESSION_TIMEOUT:
+            times.append(self.session_started + self.SESSION_TIMEOUT)
+        if self.IDLE_TIMEOUT:
+            times.append(self.last_input + self.IDLE_TIMEOUT)
+        if self.PROBE_INTERVAL:
+            times.append(max(self.last_input, self.last_probe) + self.PROBE_INTERVAL)
+        return min(times)
+
+    def timeouts_check(self, now):
+        """Called by the timer wheel: end the session if it is out of
+        time, send a probe if it is due, and check again later"""
+        if self.timer_wheel is None:
+            # The session has ended
+            return
+        if self.SESSION_TIMEOUT and now >= self.session_started + self.SESSION_TIMEOUT:
+            self.timeout(self.SESSION_TIMEOUT_MESSAGE)
+            return
+        if self.IDLE_TIMEOUT and now >= self.last_input + self.IDLE_TIMEOUT:
+            self.timeout(self.IDLE_TIMEOUT_MESSAGE)
+            return
+        if self.PROBE_INTERVAL and now >= max(self.last_input, self.last_probe) + self.PROBE_INTERVAL:
+            self.last_probe = now
+            # Skipped while the client is not taking its output
+            if self.output_room(2):
+                try:
+                    self.sendcommand(self.PROBE)
+                    self.flush()
+                except socket.error:
+                    self.disconnect()
+                    return
+        self.timer_wheel.schedule(self.timeouts_next(), self.timeouts_check)
+
+    def timeout(self, message):
+        """End a session that is out of time, telling the client why.
+        A client not taking its output is cut off without being told:
+        the timer wheel, shared by the sessions, never waits for one."""
+        log.debug("Session timed out: %s" % (message, ))
+        self.timer_wheel = None
+        data = cook_output(chr_py3(10) + str_to_bytes(message) + chr_py3(10))
+        if not self.output_room(len(data)):
+            self.output_disconnect()
+            return
+        try:
+            self.writecooked(data)
+            self.flush()
+        except socket.error:
+            pass
+        self.disconnect()
+
 # ------------------------- Telnet Options Engine --------------------------
 
     def options_handler(self, sock, cmd, opt):
         """Negotiate options"""
         if cmd == NOP:
             self.sendcommand(NOP)
+        elif cmd == AYT:
+            self.writecooked(b"\r\n[Yes]\r\n")
+            self.flush()
+        elif cmd in (IP, BRK, AO):
+            self.interrupt(cmd)
         elif cmd == WILL or cmd == WONT:
             if opt in self.WILLACK:
                 self.sendcommand(self.WILLACK[opt], opt)
@@ -553,6 +1316,10 @@ class TelnetHandlerBase(socketserver.BaseRequestHandler):
                 self.sendcommand(DONT, opt)
             if cmd == WILL and opt == TTYPE:
                 self.writecooked(IAC + SB + TTYPE + SEND + IAC + SE)
+            if cmd == WILL and opt in (TTYPE, NAWS) and (DO, opt) in self.negotiating:
+                # Wait for the terminal type or window size too
+                self.negotiating.add((SB, opt))
+            self.negotiation_answered((DO, opt))
         elif cmd == DO or cmd == DONT:
             if opt in self.DOACK:
                 self.sendcommand(self.DOACK[opt], opt)
@@ -560,37 +1327,56 @@ class TelnetHandlerBase(socketserver.BaseRequestHandler):
                 self.sendcommand(WONT, opt)
             if opt == ECHO:
                 self.DOECHO = (cmd == DO)
+            self.negotiation_answered((WILL, opt))
         elif cmd == SE:
             subreq = self.read_sb_data()
-            if subreq[0] == TTYPE and subreq[1] == IS:
+            if subreq[0:1] == TTYPE and subreq[1:2] == IS:
                 try:
-                    self.setterm(subreq[2:])
-                except (AttributeError, socket.error):
+                    self.setterm(subreq[2:], (SB, TTYPE))
+                except (AttributeError, socket.error, curses.error):
                     log.exception("Terminal type not known")
-            elif subreq[0] == NAWS:
-                # FIXME: check setnaws attribute
+                    self.negotiation_answered((SB, TTYPE))
+            elif subreq[0:1] == NAWS:
                 self.setnaws(subreq[1:])
+                self.negotiation_answered((SB, NAWS))
         elif cmd == SB:
             pass
         else:
-            log.debug("Unhandled option: %s %s" % (cmdtxt, opttxt, ))
+            log.debug("Unhandled option: %r %r" % (cmd, opt))
 
     def sendcommand(self, cmd, opt=None):
-        """Send a telnet command (IAC)"""
+        """Send a telnet command (IAC).  Returns True if it was sent,
+        False if the option was already in the state asked for."""
         if cmd in [DO, DONT]:
-            if opt not in self.DOOPTS:
-                self.DOOPTS[opt] = None
-            if (cmd == DO and self.DOOPTS[opt] != True) or (cmd == DONT and self.DOOPTS[opt] != False):
+            if self.DOOPTS.get(opt) != (cmd == DO):
                 self.DOOPTS[opt] = (cmd == DO)
                 self.writecooked(IAC + cmd + opt)
+                return True
         elif cmd in [WILL, WONT]:
-            if opt not in self.WILLOPTS:
-                self.WILLOPTS[opt] = ''
-            if (cmd == WILL and self.WILLOPTS[opt] != True) or (cmd == WONT and self.WILLOPTS[opt] != False):
+            if self.WILLOPTS.get(opt) != (cmd == WILL):
                 self.WILLOPTS[opt] = (cmd == WILL)
                 self.writecooked(IAC + cmd + opt)
+                return True
         else:
             self.writecooked(IAC + cmd)
+            return True
+        return False
+
+    def negotiation_answered(self, request):
+        """Note the client's answer to a request sent by setup"""
+        if request in self.negotiating:
+            self.negotiating.discard(request)
+            if not self.negotiating:
+                self.negotiation_done()
+
+    def negotiation_done(self):
+        """Called once the client has answered every request sent by setup,
+        or has started typing regardless.  Backends that wait for the
+        negotiation (up to NEGOTIATION_TIMEOUT) extend this to stop waiting."""
+        # Still the set made by setup, unless done already
+        if self.METRICS is not None and not isinstance(self.negotiating, frozenset):
+            self.METRICS.negotiation(time.monotonic() - self.session_started)
+        self.negotiating = frozenset()
 
     def read_sb_data(self):
         """Return any data available in the SB ... SE queue.
@@ -612,105 +1398,111 @@ class TelnetHandlerBase(socketserver.BaseRequestHandler):
 
     def _readline_echo(self, char, echo):
         """Echo a recieved character, move cursor etc..."""
-        if self._readline_do_echo(echo):
+        if char and self._readline_do_echo(echo):
             self.write(char)
     
-    def _readline_insert(self, char, echo, insptr, line):
-        """Deal properly with inserted chars in a line."""
-        if not self._readline_do_echo(echo):
-            return
-        # Write out the remainder of the line
-        self.write(char + b''.join([chr_py3(i) for i in line[insptr:]]))
-        # Cursor Left to the current insert point
-        char_count = len(line) - insptr
-        self.write(self.CODES['CSRLEFT'] * char_count)
-    
-    _current_line = ''
-    _current_prompt = ''
+    # The prompt and the line being edited, redrawn after a writemessage
+    _current_prompt = b''
+    _current_editor = None
     
-    def ansi_to_curses(self, char):
-        """Handles reading ANSI escape sequences"""
-        # ANSI sequences are:
-        # ESC [ <key>
-        # If we see ESC, read a char
-        if char != ESC:
-            return char
-        # If we see [, read another char
-        if self.getc(block=True) != ANSI_START_SEQ:
-            self._readline_echo(BELL, True)
-            return theNULL
-        key = self.getc(block=True)
-        # Translate the key to curses
-        try:
-            return ANSI_KEY_TO_CURSES[key]
-        except:
-            self._readline_echo(BELL, True)
-            return theNULL     
-    
-    def readline(self, echo=None, prompt='', use_history=True):
+    def readline(self, echo=None, prompt='', use_history=True, use_completion=False):
         """Return a line of text, including the terminating LF
            If echo is true always echo, if echo is false never echo
            If echo is None follow the negotiated setting.
            prompt is the current prompt to write (and rewrite if needed)
            use_history controls if this current line uses (and adds to) the command history.
+           use_completion completes command names and parameters on Tab.
         """
-        
-        line = []
-        insptr = 0
-        ansi = 0
-        histptr = len(self.history)
+        editor = self.readline_editor(echo, prompt, use_history, use_completion)
+        next(editor)
+        try:
+            while True:
+                c = self.getc(block=False)
+                if not c:
+                    # Send the echo before waiting for more input
+                    self.flush()
+                    waiting = self.input_wait_start()
+                    c = self.getc(block=True)
+                    self.input_wait_done(waiting)
+                self.profiled(editor.send, c)
+        except StopIteration as stop:
+            return stop.value
+
+    def readline_editor(self, echo=None, prompt='', use_history=True, use_completion=False):
+        """The line editor behind readline.
+        A generator: each input character is sent in, the line is the return value.
+        This lets blocking and asynchronous backends share the same editing logic.
+        """
+        line = LineEditor(self.CODES)
+        histptr = len(self.history) if use_history else 0
+        typed = b''
+        # Tab pressed twice in a row lists the completions
+        tabbed = False
+        # A key that ended a history search, to be handled as typed
+        pending = None
         prompt = str_to_bytes(prompt) if isinstance(prompt, str) else prompt
         if self.DOECHO:
             self.write(prompt)
             self._current_prompt = prompt
         else:
             self._current_prompt = b''
-        self._current_line = b''
-        
+        # What writemessage redraws; never a line that is not echoed
+        self._current_editor = line if self._readline_do_echo(echo) else None
+
         while True:
-            c = self.getc(block=True)
-            c = self.ansi_to_curses(c)
+            if pending is None:
+                c = yield
+            else:
+                c, pending = pending, None
+            # What the key does on the terminal, written in one go;
+            # None rings the bell
+            out = b''
             if c == theNULL:
                 continue
-            
-            elif c == curses.KEY_LEFT:
-                if insptr > 0:
-                    insptr = insptr - 1
-                    self._readline_echo(self.CODES['CSRLEFT'], echo)
+            again, tabbed = tabbed, c == chr_py3(9)
+
+            if c == chr_py3(9) and use_completion:
+                before = bytes(line.line[:line.pos])
+                word = b'' if not before or before[-1:].isspace() else before.split()[-1]
+                matches = self.complete(before)
+                common = os.path.commonprefix(matches) if matches else b''
+                if len(matches) == 1:
+                    common += b' '
+                if len(common) > len(word):
+                    out = line.insert(common[len(word):])
+                elif len(matches) > 1 and again:
+                    out = b'\n' + self.completions_text(matches) + b'\n' + self._current_prompt + line.redraw()
                 else:
-                    self._readline_echo(BELL, echo)
-                continue
+                    out = None
+            elif c == curses.KEY_LEFT:
+                out = line.move(line.pos - 1) if line.pos > 0 else None
             elif c == curses.KEY_RIGHT:
-                if insptr < len(line):
-                    insptr = insptr + 1
-                    self._readline_echo(self.CODES['CSRRIGHT'], echo)
-                else:
-                    self._readline_echo(BELL, echo)
-                continue
+                out = line.move(line.pos + 1) if line.pos < len(line) else None
+            elif c == curses.KEY_HOME:
+                out = line.move(0)
+            elif c == curses.KEY_END:
+                out = line.move(len(line))
             elif c == curses.KEY_UP or c == curses.KEY_DOWN:
+                if not use_history:
+                    out = None
+                elif c == curses.KEY_UP and histptr == 0:
+                    out = None
+                elif c == curses.KEY_DOWN and histptr >= len(self.history):
+                    out = None
+                else:
+                    if histptr == len(self.history):
+                        # Back to the line being typed at the bottom
+                        typed = bytes(line)
+                    histptr += -1 if c == curses.KEY_UP else 1
+                    out = line.replace(self.history[histptr] if histptr < len(self.history) else typed)
+            elif c == chr_py3(18):
+                # Ctrl-R
                 if not use_history:
                     self._readline_echo(BELL, echo)
                     continue
-                if c == curses.KEY_UP:
-                    if histptr > 0:
-                        histptr = histptr - 1
-                    else:
-                        self._readline_echo(BELL, echo)
-                        continue
-                elif c == curses.KEY_DOWN:
-                    if histptr < len(self.history):
-                        histptr = histptr + 1
-                    else:
-                        self._readline_echo(BELL, echo)
-                        continue
-                line = []
-                if histptr < len(self.history):
-                    line.extend(self.history[histptr])
-                for char in range(insptr):
-                    self._readline_echo(self.CODES['CSRLEFT'], echo)
-                self._readline_echo(self.CODES['DEOL'], echo)
-                self._readline_echo(b''.join([chr_py3(i) for i in line]), echo)
-                insptr = len(line)
+                found, pending = yield from self.readline_search(bytes(line), echo)
+                line.replace(found)
+                histptr = len(self.history)
                 continue
             elif c == chr_py3(3):
                 self._readline_echo(b'\n' + str_to_bytes(curses.ascii.unctrl(ord(c))) + b' ABORT\n', echo)
@@ -723,7 +1515,7 @@ class TelnetHandlerBase(socketserver.BaseRequestHandler):
                 return b'QUIT'
             elif c == chr_py3(10):
                 self._readline_echo(c, echo)
-                result = b''.join([chr_py3(i) for i in line])
+                result = bytes(line)
                 if use_history:
                     self.history.append(result)
                 if echo is False:
@@ -734,32 +1526,88 @@ class TelnetHandlerBase(socketserver.BaseRequestHandler):
                     log.debug('readline: %s%r', bytes_to_str(prompt), bytes_to_str(result))
                 return result
             elif c == curses.KEY_BACKSPACE or c == chr_py3(127) or c == chr_py3(8):
-                if insptr > 0:
-                    self._readline_echo(self.CODES['CSRLEFT'] + self.CODES['DEL'], echo)
-                    insptr = insptr - 1
-                    del line[insptr]
-                else:
-                    self._readline_echo(BELL, echo)
-                continue
+                out = line.backspace()
             elif c == curses.KEY_DC:
-                if insptr < len(line):
-                    self._readline_echo(self.CODES['DEL'], echo)
-                    del line[insptr]
-                else:
-                    self._readline_echo(BELL, echo)
-                continue
+                out = line.delete()
+            elif type(c) is int or c == ESC:
+                # Keys without a line editing function
+                out = None
             else:
                 if ord(c) < 32:
-                    c = curses.ascii.unctrl(ord(c))
-                if len(line) > insptr:
-                    self._readline_insert(c, echo, insptr, line)
-                else:
-                    self._readline_echo(c, echo)
-            line[insptr:insptr] = c
-            insptr = insptr + len(c)
-            if self._readline_do_echo(echo):
-                self._current_line = line
-    
+                    c = str_to_bytes(curses.ascii.unctrl(ord(c)))
+                out = line.insert(c)
+            self._readline_echo(BELL if out is None else out, echo)
+
+    def complete(self, line):
+        """Return the ways of completing the last word of line, the command
+        line up to the cursor: the names of the commands starting with it,
+        or for a parameter those from the command's completer"""
+        words = line.split()
+        if not words or line[-1:].isspace():
+            words.append(b'')
+        text = words[-1]
+        if len(words) == 1:
+            names = self.COMMANDS.matching(bytes_to_str(text).upper())
+            if text == text.lower():
+                names = [name.lower() for name in names]
+            return [str_to_bytes(name) for name in names]
+        cmd = bytes_to_str(words[0]).upper()
+        names = self.COMMANDS.resolve(cmd) if self.COMMAND_ABBREVIATIONS else [cmd]
+        if len(names) != 1 or names[0] not in self.COMMANDS:
+            return []
+        completer = getattr(self.COMMANDS[names[0]], 'completer', None)
+        if completer is None:
+            return []
+        text = bytes_to_str(text)
+        params = [bytes_to_str(word) for word in words[1:-1]]
+        return sorted(str_to_bytes(param) for param in completer(self, params, text)
+                      if param.startswith(text))
+
+    def completions_text(self, matches):
+        """Return the completions listed in columns across the window"""
+        width = max(len(match) for match in matches) + 2
+        columns = max(1, self.WIDTH // width)
+        rows = [matches[i:i + columns] for i in range(0, len(matches), columns)]
+        return b'\n'.join(b''.join(match.ljust(width) for match in row).rstrip() for row in rows)
+
+    def readline_search(self, line, echo):
+        """Search the history backwards as the text to look for is typed,
+        for Ctrl-R in readline_editor.  Ctrl-R again finds an older line;
+        any other key takes the line found, Ctrl-G gives up the search.
+        A generator like readline_editor, returning the line and the key
+        that ended the search (to be handled as typed) or None."""
+        history = self.history
+        text = b''
+        index = len(history)
+        found = line
+        failed = False
+        while True:
+            self._readline_echo(b'\r' + self.CODES['DEOL'] + (b"(failed reverse-i-search)'" if failed else
+                                b"(reverse-i-search)'") + text + b"': " + found, echo)
+            c = yield
+            if c == chr_py3(18):
+                start = index - 1
+            elif c == curses.KEY_BACKSPACE or c == chr_py3(127) or c == chr_py3(8):
+                text = text[:-1]
+                start = len(history) - 1
+            elif type(c) is bytes and b' ' <= c < chr_py3(127):
+                text += c
+                start = min(index, len(history) - 1)
+            else:
+                if c == chr_py3(7):
+                    # Ctrl-G
+                    found, c = line, None
+                self._readline_echo(b'\r' + self.CODES['DEOL'] + self._current_prompt + found, echo)
+                return found, c
+            if not text:
+                index, found, failed = len(history), line, False
+                continue
+            match = history.search(text, start) if start >= 0 else None
+            failed = match is None
+            if not failed:
+                index = match
+                found = history[index]
+
     def getc(self, block=True):
         """Return one character from the input queue"""
         # This is very different between green threads and real threads.
@@ -776,61 +1624,267 @@ class TelnetHandlerBase(socketserver.BaseRequestHandler):
         self.writeline(text)
 
     def writeline(self, text):
-        """Send a packet with line ending."""
+        """Send a packet with line ending.  An interrupted command is
+        stopped here, with CommandInterrupted."""
+        if self.interrupted and self.command_running:
+            raise CommandInterrupted
         text = str_to_bytes(text) if isinstance(text, str) else text
-        log.debug('writing line %r' % text)
+        log.debug('writing line %r', text)
         self.write(text + chr_py3(10))
 
     def writemessage(self, text):
         """Write out an asynchr_py3onous message, then reconstruct the prompt and entered text."""
         log.debug('writing message %r', text)
-        self.write(chr_py3(10) + str_to_bytes(text) + chr_py3(10))
-        self.write(self._current_prompt + b''.join([chr_py3(i) for i in self._current_line]))
+        self.writemessage_cooked(cook_output(chr_py3(10) + str_to_bytes(text) + chr_py3(10)))
+
+    def writemessage_cooked(self, data):
+        """Write out an asynchronous message cooked already, then reconstruct
+        the prompt and entered text.  The data is queued as it is, so one
+        message may be shared by many sessions.  Written from another
+        thread, such as a command executor's, it is handed over to the
+        session by message_relay."""
+        if self.output_capture is not None:
+            self.output_capture.take(data)
+        write = functools.partial(self._writemessage_cooked, data)
+        if self.command_threads and self._command_thread_write(write):
+            # In order with the rest of the command's output
+            return
+        relay = self.message_relay()
+        if relay is not None:
+            relay(write)
+            return
+        write()
+
+    def _writemessage_cooked(self, data):
+        self.flush()
+        self.sendcooked(data)
+        redraw = self._current_prompt
+        if self._current_editor is not None:
+            redraw += self._current_editor.redraw()
+        self.write(redraw)
+        self.flush()
+
+    def writebroadcast(self, data):
+        """Write out a message broadcast to many sessions"""
+        self.writemessage_cooked(data)
 
     def write(self, text):
         """Send a packet to the socket. This function cooks output."""
-        text = str_to_bytes(text)    # eliminate any unicode or other snigglets
-        text = text.replace(IAC, IAC+IAC)
-        text = text.replace(chr_py3(10), chr_py3(13) + chr_py3(10))
-        self.writecooked(text)
+        self.writecooked(cook_output(text))
+
+    def writepaged(self, lines):
+        """Write out the lines from an iterable, taking each only as it is
+        written.  Once the window is full, MORE_PROMPT asks for a key:
+        Enter shows one more line, q ends the output, others the next page."""
+        page = self.page_rows()
+        rows = 0
+        try:
+            for line in lines:
+                if page and rows >= page:
+                    self.write(self.MORE_PROMPT)
+                    self.flush()
+                    waiting = self.input_wait_start()
+                    try:
+                        c = self.getc(block=True)
+                    except CommandInterrupted:
+                        # Erase MORE_PROMPT
+                        self.pager_key(ETX, page)
+                        raise
+                    self.input_wait_done(waiting)
+                    rows = self.pager_key(c, page)
+                    if rows is None:
+                        break
+                self.writeline(line)
+                rows += self.line_rows(line)
+        finally:
+            if hasattr(lines, 'close'):
+                lines.close()
+
+    def page_rows(self):
+        """Return how many rows make a page, None to not page output"""
+        if self.PAGER and self.windowsize and self.HEIGHT > 1:
+            return self.HEIGHT - 1
+        return None
+
+    def line_rows(self, line):
+        """Return how many rows a line takes up in the window"""
+        return max(1, (len(line) + self.WIDTH - 1) // self.WIDTH)
+
+    def pager_key(self, c, page):
+        """Erase MORE_PROMPT and act on the key pressed there.
+        Return the rows already shown on the new page, None to stop."""
+        if self.CODES['DEOL']:
+            self.writecooked(b'\r' + self.CODES['DEOL'])
+        else:
+            self.writecooked(b'\r' + b' ' * len(self.MORE_PROMPT) + b'\r')
+        if c in (b'q', b'Q', b'\x03'):
+            return None
+        if c in (b'\n', b'\r'):
+            return page - 1
+        return 0
+
+    def writestream(self, source):
+        """Write out the text from an iterable of strings or a file-like
+        object, cooking it a chunk at a time instead of all at once."""
+        for data in cook_output_stream(source):
+            self.writecooked(data)
 
     def writecooked(self, text):
-        """Put data directly into the output queue (bypass output cooker)"""
-        self.sock.sendall(str_to_bytes(text))
+        """Put data directly into the output buffer (bypass output cooker).
+        It is sent by flush, once OUTPUT_HIGH_WATER is reached, and before
+        waiting for input.  A cached command running keeps a copy."""
+        if self.output_capture is not None:
+            self.output_capture.take(str_to_bytes(text))
+        if self.command_threads and self._command_thread_write(text):
+            return
+        self._writecooked(text)
+
+    def _writecooked(self, text):
+        text = str_to_bytes(text)
+        if len(text) >= self.OUTPUT_HIGH_WATER:
+            # Large writes are queued as they are, without copying
+            self._flush()
+            self.sendcooked(bytes(text) if type(text) is not bytes else text)
+            return
+        self.outbuf += text
+        if len(self.outbuf) >= self.OUTPUT_HIGH_WATER:
+            self._flush()
+
+    def flush(self):
+        """Send the buffered output.  Call this from a command to show
+        partial output before a long running step."""
+        if self.command_threads and self._command_thread_write(None):
+            return
+        self._flush()
+
+    def _flush(self):
+        if self.outbuf:
+            data = bytes(self.outbuf)
+            del self.outbuf[:]
+            self.sendcooked(data)
+
+    def _command_thread_write(self, data):
+        """Hand output written by a command on a command executor thread to
+        its ThreadCommand.  Returns True if it took it."""
+        run = getattr(command_thread, 'run', None)
+        if run is None or run.handler is not self or not run.running_here():
+            return False
+        return run.write(data)
+
+    def sendcooked(self, data):
+        """Queue cooked data for the client.  Once OUTPUT_QUEUE_HIGH bytes
+        are waiting, output_overflow decides what becomes of it."""
+        if self.output_queued() >= self.OUTPUT_QUEUE_HIGH and not self.output_overflow(data):
+            self.outq_dropped += len(data)
+            return
+        if self.outq is None:
+            self.outq = deque()
+        self.outq.append(data)
+        self.outq_bytes += len(data)
+        self.outq_peak = max(self.outq_peak, self.output_queued())
+        self.output_ready()
+
+    def output_queued(self):
+        """Return how many bytes are waiting to be sent"""
+        return self.outq_bytes
+
+    def output_room(self, size):
+        """Can size more bytes be written, and the output buffered so far
+        flushed, without OUTPUT_POLICY applying?"""
+        return self.output_queued() + len(self.outbuf) + size < self.OUTPUT_QUEUE_HIGH
+
+    def output_stats(self):
+        """Return the output queue metrics of this session"""
+        return {
+            'queued': self.output_queued(),
+            'peak': self.outq_peak,
+            'sent': self.outq_sent,
+            'dropped': self.outq_dropped,
+            'blocked': self.outq_blocked,
+        }
+
+    def output_overflow(self, data):
+        """Apply OUTPUT_POLICY to data written while the output queue is full.
+        Return True to queue it anyway.  Override for a policy of your own."""
+        if self.OUTPUT_POLICY == 'block':
+            self.outq_blocked += 1
+            self.output_wait()
+            return not self.eof
+        if self.OUTPUT_POLICY == 'disconnect' and not self.eof:
+            log.warning("Client %s is not reading its output, disconnecting." % (self.client_address, ))
+            self.output_disconnect()
+        else:
+            log.debug("Output queue full, dropping %d bytes.", len(data))
+        return False
+
+    def output_discard(self):
+        """Throw away the output not yet sent, for the telnet AO command"""
+        dropped = len(self.outbuf)
+        del self.outbuf[:]
+        while self.outq:
+            size = len(self.outq.popleft())
+            self.outq_bytes -= size
+            dropped += size
+        self.outq_dropped += dropped
+
+    def output_ready(self):
+        """Send the queued output.  This blocks until the client takes it,
+        backends with a sender of their own override this."""
+        while self.outq:
+            data = self.outq.popleft()
+            self.sock.sendall(data)
+            self.output_sent(len(data))
+
+    def output_sent(self, size):
+        """Account for size bytes taken from the output queue"""
+        self.outq_bytes -= size
+        self.outq_sent += size
+
+    def output_wait(self):
+        """Wait for the output queue to drain to OUTPUT_QUEUE_LOW"""
+        pass
+
+    def output_close(self):
+        """Send what is left in the output queue as the session ends"""
+        pass
+
+    def output_disconnect(self):
+        """End a session whose client is not taking its output"""
+        self.RUNSHELL = False
+        self.eof = 1
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
 
 # ------------------------------- Input Cooker -----------------------------
-    def _inputcooker_getc(self, block=True):
-        """Get one character from the raw queue. Optionally blocking.
-        Raise EOFError on end of stream. SHOULD ONLY BE CALLED FROM THE
-        INPUT COOKER."""
-        if self.rawq:
-            ret = self.rawq[0]
-            self.rawq = self.rawq[1:]
+    def _inputcooker_getc(self):
+        """Get one character from the raw queue, b'' if it is empty.
+        SHOULD ONLY BE CALLED FROM THE INPUT COOKER."""
+        if self.rawpos < len(self.rawq):
+            ret = self.rawq[self.rawpos]
+            self.rawpos += 1
             return chr_py3(ret)
-        if not block:
-            if not self.inputcooker_socket_ready():
-                return b''
-        ret = self.sock.recv(20)
-        self.eof = not ret
-        self.rawq = self.rawq + ret
-        if self.eof:
-            raise EOFError
-        return self._inputcooker_getc(block)
-
-    def inputcooker_socket_ready(self):
-        """Indicate that the socket is ready to be read"""
-        raise NotImplementedError("Please Implement the inputcooker_socket_ready method")
+        return b''
 
     def _inputcooker_ungetc(self, char):
         """Put characters back onto the head of the rawq. SHOULD ONLY
         BE CALLED FROM THE INPUT COOKER."""
-        self.rawq = char + self.rawq
+        self.rawq[self.rawpos:self.rawpos] = char
 
     def _inputcooker_store(self, char):
         """Put the cooked data in the correct queue"""
         if self.sb:
             self.sbdataq = self.sbdataq + char
         else:
+            if self.negotiating:
+                # A client typing away is not answering
+                self.negotiation_done()
+            self.last_input = time.monotonic()
+            if self.command_running and type(char) is bytes and ETX in char:
+                # Ctrl-C interrupts the command rather than being read by it
+                char = char.replace(ETX, b'')
+                self.interrupt()
             self.inputcooker_store_queue(char)
 
     def inputcooker_store_queue(self, char):
@@ -838,67 +1892,151 @@ class TelnetHandlerBase(socketserver.BaseRequestHandler):
         raise NotImplementedError("Please Implement the inputcooker_store_queue method")
 
     def inputcooker(self):
-        """Input Cooker - Transfer from raw queue to cooked queue.
+        """Input Cooker - Transfer from the socket to the cooked queue.
 
-        Set self.eof when connection is closed.  Don't block unless in
-        the midst of an IAC sequence.
+        Reads until the connection is closed, then sets self.eof.
         """
         try:
             while True:
-                c = self._inputcooker_getc()
-                if not self.iacseq:
-                    if c == IAC:
-                        self.iacseq += c
-                        continue
-                    elif c == chr_py3(13) and not self.sb:
-                        c2 = self._inputcooker_getc(block=False)
-                        if c2 == theNULL or c2 == b'':
-                            c = chr_py3(10)
-                        elif c2 == chr_py3(10):
-                            c = c2
-                        else:
-                            self._inputcooker_ungetc(c2)
-                            c = chr_py3(10)
-                    elif c in [x[0] for x in list(self.ESCSEQ.keys())]:
-                        'Looks like the begining of a key sequence'
-                        codes = c
-                        for keyseq in list(self.ESCSEQ.keys()):
-                            if len(keyseq) == 0:
-                                continue
-                            while codes == keyseq[:len(codes)] and len(codes) <= keyseq:
-                                if codes == keyseq:
-                                    c = self.ESCSEQ[keyseq]
-                                    break
-                                codes = codes + self._inputcooker_getc()
-                            if codes == keyseq:
-                                break
-                            self._inputcooker_ungetc(codes[1:])
-                            codes = codes[0]
-                    self._inputcooker_store(c)
-                elif len(self.iacseq) == 1:
-                    'IAC: IAC CMD [OPTION only for WILL/WONT/DO/DONT]'
-                    if c in (DO, DONT, WILL, WONT):
-                        self.iacseq += c
-                        continue
-                    self.iacseq = b''
-                    if c == IAC:
-                        self._inputcooker_store(c)
-                    else:
-                        if c == SB:  # SB ... SE start.
-                            self.sb = 1
-                            self.sbdataq = b''
-                        elif c == SE: # SB ... SE end.
-                            self.sb = 0
-                        # Callback is supposed to look into
-                        # the sbdataq
-                        self.options_handler(self.sock, c, NOOPT)
-                elif len(self.iacseq) == 2:
-                    cmd = self.iacseq[1]
-                    self.iacseq = b''
-                    if cmd in (DO, DONT, WILL, WONT):
-                        self.options_handler(self.sock, cmd, c)
-        except (EOFError, socket.error):
+                data = self.sock.recv(self.RECV_SIZE)
+                if not data:
+                    break
+                self.inputcooker_feed(data)
+                # Send any negotiation replies
+                self.flush()
+        except socket.error:
             pass
+        self.eof = 1
+
+    def inputcooker_feed(self, data):
+        """Cook a block of raw data received from the client, see
+        _inputcooker_feed"""
+        self.profiled(self._inputcooker_feed, data)
+
+    def _inputcooker_feed(self, data):
+        """Cook a block of raw data received from the client.
+
+        Never blocks.  An unfinished IAC or key sequence is kept and
+        completed by the next block, so the data may be fed in whatever
+        pieces the transport delivers; but a key sequence that is a key
+        already, and only starts a longer one, is taken as that key.
+        Runs of plain data between the chars that need cooking are passed
+        on with a single store.
+        """
+        rawq = self.rawq
+        rawq += data
+        self.raw_received += len(data)
+        try:
+            self._inputcooker_block()
+            while self.keyseq:
+                # No more is coming for now, take the pending key if the
+                # sequence so far is one
+                match = self.keydecoder.resolve(self.keyseq)
+                if match is self.keydecoder.INCOMPLETE:
+                    break
+                self._inputcooker_key(*match)
+                self._inputcooker_block()
+        finally:
+            # Drop the consumed data
+            del rawq[:self.rawpos]
+            self.rawpos = 0
+
+    def _inputcooker_block(self):
+        """Cook the raw queue up to its end"""
+        rawq = self.rawq
+        while self.rawpos < len(rawq):
+            if self.iacseq or self.keyseq or self.crseen:
+                # In the middle of a sequence, go char by char
+                self._inputcooker_char(self._inputcooker_getc())
+                continue
+            pattern = SB_SPECIAL if self.sb else self.rawspecial
+            run = []
+            while True:
+                special = pattern.search(rawq, self.rawpos)
+                end = special.start() if special else len(rawq)
+                run.append(rawq[self.rawpos:end])
+                self.rawpos = end
+                if not special:
+                    break
+                pair = bytes(rawq[end:end + 2])
+                if pair == IAC + IAC:
+                    # An escaped IAC is plain data, keep going
+                    run.append(IAC)
+                    self.rawpos = end + 2
+                elif pair[:1] == chr_py3(13) and len(pair) == 2:
+                    # So is an end of line: CR LF, CR NUL or a bare CR
+                    run.append(chr_py3(10))
+                    self.rawpos = end + (2 if pair[1:] in (theNULL, chr_py3(10)) else 1)
+                else:
+                    break
+            run = b''.join(run)
+            if run:
+                self._inputcooker_store(run)
+            if special:
+                self._inputcooker_char(self._inputcooker_getc())
+
+    def _inputcooker_keyseq(self, c):
+        """Decode key sequences, storing the key code once a sequence is complete."""
+        self.keyseq += c
+        match = self.keydecoder.match(self.keyseq)
+        if match is not self.keydecoder.INCOMPLETE:
+            self._inputcooker_key(*match)
+
+    def _inputcooker_key(self, key, length):
+        """Store the key decoded from the first length chars of the key
+        sequence, and put the rest back onto the raw queue."""
+        codes, self.keyseq = self.keyseq, b''
+        if not length:
+            # Not a key sequence after all, pass on the first char
+            key, length = codes[:1], 1
+        if key is not None:
+            self._inputcooker_store(key)
+        else:
+            log.debug('Unknown key sequence %r', codes[:length])
+        self._inputcooker_ungetc(codes[length:])
+
+    def _inputcooker_char(self, c):
+        """Cook one raw character"""
+        crseen = self.crseen
+        self.crseen = False
+        if not self.iacseq:
+            if self.keyseq:
+                self._inputcooker_keyseq(c)
+            elif c == IAC:
+                self.iacseq += c
+            elif crseen and c in (theNULL, chr_py3(10)):
+                # CR NUL and CR LF are both a single end of line
+                pass
+            elif c == chr_py3(13) and not self.sb:
+                self.crseen = True
+                self._inputcooker_store(chr_py3(10))
+            elif c in self.keydecoder.starts and not self.sb:
+                'Looks like the begining of a key sequence'
+                self._inputcooker_keyseq(c)
+            else:
+                self._inputcooker_store(c)
+        elif len(self.iacseq) == 1:
+            'IAC: IAC CMD [OPTION only for WILL/WONT/DO/DONT]'
+            if c in (DO, DONT, WILL, WONT):
+                self.iacseq += c
+                return
+            self.iacseq = b''
+            if c == IAC:
+                self._inputcooker_store(c)
+            else:
+                if c == SB:  # SB ... SE start.
+                    self.sb = 1
+                    self.sbdataq = b''
+                elif c == SE: # SB ... SE end.
+                    self.sb = 0
+                # Callback is supposed to look into
+                # the sbdataq
+                self.options_handler(self.sock, c, NOOPT)
+        elif len(self.iacseq) == 2:
+            cmd = self.iacseq[1:2]
+            self.iacseq = b''
+            if cmd in (DO, DONT, WILL, WONT):
+                self.options_handler(self.sock, cmd, c)
 
 # ------------------------------- Basic Commands ---------------------------
 
@@ -916,45 +2054,15 @@ class TelnetHandlerBase(socketserver.BaseRequestHandler):
         if params:
             cmd = params[0].upper()
             if cmd in self.COMMANDS:
-                method = self.COMMANDS[cmd]
-                doc = method.__doc__.split("\n")
-                docp = doc[0].strip()
-                docl = '\n'.join( [l.strip() for l in doc[2:]])
-                if not docl.strip():  # If there isn't anything here, use line 1
-                    docl = doc[1].strip()
-                self.writeline(
-                    "%s %s\n\n%s" % (
-                        cmd,
-                        docp,
-                        docl,
-                    )
-                )
+                help = self.COMMANDS.help(cmd)
+                self.writeline(help.detail or "no help for command %s" % cmd)
                 return
             else:
                 self.writeline("Command '%s' not known" % cmd)
         else:
             self.writeline("Help on built in commands\n")
-        keys = sorted(self.COMMANDS.keys())
-        for cmd in keys:
-            method = self.COMMANDS[cmd]
-            if getattr(method, 'hidden', False):
-                continue
-            if method.__doc__ is None:
-                self.writeline("no help for command %s" % method)
-                return
-            doc = method.__doc__.split("\n")
-            docp = doc[0].strip()
-            docs = doc[1].strip()
-            if len(docp) > 0:
-                docps = "%s - %s" % (docp, docs, )
-            else:
-                docps = "- %s" % (docs, )
-            self.writeline(
-                "%s %s" % (
-                    cmd,
-                    docps,
-                )
-            )
+        for line in self.COMMANDS.listing():
+            self.writeline(line)
     cmdHELP.aliases = ['?']
 
     def cmdEXIT(self, params):
@@ -969,14 +2077,72 @@ class TelnetHandlerBase(socketserver.BaseRequestHandler):
         """
         Display the command history
         """
-        cnt = 0
         self.writeline('Command history\n')
-        for line in self.history:
-            cnt = cnt + 1
-            self.writeline("%-5d : %s" % (cnt, ''.join(line)))
+        # Numbered from the oldest line ever typed, paged as it is written
+        return ("%-5d : %s" % (number, bytes_to_str(line))
+                for number, line in enumerate(self.history, self.history.dropped + 1))
+
+    def cmdPROFILE(self, params):
+        """server|session <user or address>|command <name>|stop [<seconds>] [cprofile|sampling]
+        Profile the server
+        Profile the whole server, one session (of a user name or a client
+        address as host:port) or the runs of one command, for 10 seconds
+        unless given, with cProfile unless asked for sampling.  The profile
+        is written to a file in PROFILE_DIR.  Only for the PROFILE_USERS.
+        """
+        if self.PROFILE_USERS is None or self.username not in self.PROFILE_USERS:
+            self.writeerror("Not allowed to profile")
+            return
+        scope = params[0].lower() if params else ''
+        args = params[1:]
+        if scope == 'stop':
+            profile = profiling.stop()
+            self.writeresponse("Writing %s" % profile.path if profile else "Not profiling")
+            return
+        session = command = None
+        if scope == 'session' and args:
+            target = args.pop(0)
+            sessions = [handler for handler in self.session_registry
+                        if target in (handler.username, address_name(handler.client_address))]
+            if len(sessions) != 1:
+                self.writeerror("%s sessions of '%s'" % ('No' if not sessions else 'Several', target))
+                return
+            session = sessions[0]
+        elif scope == 'command' and args:
+            command = args.pop(0).upper()
+        elif scope != 'server':
+            self.writeerror("Usage: PROFILE %s" % self.cmdPROFILE.__doc__.split('\n')[0])
+            return
+        seconds = 10
+        kind = 'cprofile'
+        for arg in args:
+            if arg.lower() in ('cprofile', 'sampling'):
+                kind = arg.lower()
+                continue
+            try:
+                seconds = float(arg)
+            except ValueError:
+                self.writeerror("Not a number of seconds: %s" % arg)
+                return
+        try:
+            profile = profiling.start(seconds, kind=kind, session=session, command=command,
+                                      directory=self.PROFILE_DIR)
+        except RuntimeError as e:
+            self.writeerror(str(e))
+            return
+        self.writeresponse("Profiling for %g seconds to %s" % (seconds, profile.path))
+    cmdPROFILE.hidden = True
 
 # ----------------------- Command Line Processor Engine --------------------
 
+    def profiled(self, fn, *args, command=None):
+        """Call fn(*args), as a section of the running profiling.Profile if
+        it covers this session (and command)"""
+        profile = profiling.active
+        if profile is None or not profile.covers(self, command):
+            return fn(*args)
+        return profile.run(fn, *args)
+
     def handleException(self, exc_type, exc_param, exc_tb):
         "Exception handler (False to abort)"
         self.writeline(''.join(traceback.format_exception(exc_type, exc_param, exc_tb)))
@@ -994,19 +2160,32 @@ class TelnetHandlerBase(socketserver.BaseRequestHandler):
                 password = self.readline(echo=False, prompt=str_to_bytes(self.PROMPT_PASS), use_history=False)
                 if self.DOECHO:
                     self.write(b"\n")
-            try:
-                self.authCallback(username, password)
-            except:
-                self.username = None
-                return False
-            else:
-                # Successful authentication
-                self.username = username
-                return True
-        else:
+        return self.authenticate(username, password)
+
+    def authenticate(self, username, password):
+        """Check the username and password read with authCallback, if
+        any, and set the username.  Returns True or False"""
+        if not self.authCallback:
             # No authentication desired
             self.username = None
             return True
+        started = time.monotonic()
+        try:
+            self.authCallback(username, password)
+        except:
+            self.record_auth(started, False)
+            self.username = None
+            return False
+        else:
+            # Successful authentication
+            self.record_auth(started, True)
+            self.username = username
+            return True
+
+    def record_auth(self, started, ok):
+        """Record in METRICS an authentication callback called at started"""
+        if self.METRICS is not None:
+            self.METRICS.auth(time.monotonic() - started, ok)
 
     def handle(self):
         """The actual service to which the user has connected."""
@@ -1014,26 +2193,261 @@ class TelnetHandlerBase(socketserver.BaseRequestHandler):
             self.writeline(self.TELNET_ISSUE)
         if not self.authentication_ok():
             return
+        if self.admission_ticket is not None:
+            self.admission_ticket.established()
         if self.DOECHO:
             self.writeline(self.WELCOME)
 
         self.session_start()
         while self.RUNSHELL:
-            raw_input = self.readline(prompt=str_to_bytes(self.PROMPT), echo=True)
-            raw_input = raw_input.strip()
-            self.input = self.input_reader(self, raw_input)
-            self.raw_input = self.input.raw
-            if self.input.cmd:
-                cmd = bytes_to_str(self.input.cmd.upper())
-                params = [bytes_to_str(i) for i in self.input.params]
-                if cmd in self.COMMANDS:
-                    try:
-                        self.COMMANDS[cmd](params)
-                    except:
-                        log.exception('Error calling %s.' % cmd)
-                        (t, p, tb) = sys.exc_info()
-                        if self.handleException(t, p, tb):
-                            break
-                else:
-                    self.writeerror("Unknown command '%s'" % cmd)
-        log.debug("Exiting handler")
\ No newline at end of file
+            raw_input = self.readline(prompt=str_to_bytes(self.PROMPT), echo=True, use_completion=True)
+            if not self.run_command(raw_input):
+                break
+        log.debug("Exiting handler")
+
+    def run_command(self, raw_input):
+        """Parse a line of input and run its command.
+        Returns False if the session should end."""
+        self.parse_input(raw_input)
+        cmd, params = self.input_command()
+        if cmd is None:
+            return True
+        started = self.command_begin()
+        error = False
+        try:
+            self.profiled(self.call_paged, self.COMMANDS[cmd], params, command=cmd)
+        except CommandInterrupted:
+            pass
+        except:
+            error = True
+            if self.command_error(cmd):
+                return False
+        finally:
+            self.command_end(cmd, started, error)
+        if self.interrupted:
+            self.writeline(self.INTERRUPT_MESSAGE)
+        return True
+
+    def parse_input(self, raw_input):
+        """Parse a line of input into self.input"""
+        self.input = self.input_reader(self, raw_input.strip())
+
+    def input_command(self):
+        """Return the name of the command to run for the line parsed, and
+        its params; None for the name if there is none"""
+        self.raw_input = self.input.raw
+        if not self.input.cmd:
+            return None, None
+        cmd = self.find_command(bytes_to_str(self.input.cmd.upper()))
+        return cmd, [bytes_to_str(i) for i in self.input.params]
+
+    def command_begin(self):
+        """Mark a command as running.  Returns the time it started at, if
+        METRICS is timing commands."""
+        self.command_running = True
+        self.interrupted = False
+        self.input_waited = 0
+        return time.monotonic() if self.METRICS is not None else None
+
+    def command_error(self, cmd):
+        """Log the exception a command raised and hand it to
+        handleException.  Returns True if the session should end."""
+        log.exception('Error calling %s.' % cmd)
+        (t, p, tb) = sys.exc_info()
+        return self.handleException(t, p, tb)
+
+    def command_end(self, cmd, started, error):
+        """Mark the command as no longer running, and record it in METRICS,
+        less the time it waited for input"""
+        self.command_running = False
+        if started is not None:
+            self.METRICS.command(cmd, time.monotonic() - started - self.input_waited, error)
+
+    def input_wait_start(self):
+        """Note that a command is about to wait for input.  Returns the
+        time, if METRICS is timing the command."""
+        if self.METRICS is not None and self.command_running:
+            return time.monotonic()
+        return None
+
+    def input_wait_done(self, started):
+        """Count the wait for input noted by input_wait_start"""
+        if started is not None:
+            self.input_waited += time.monotonic() - started
+
+    def find_command(self, cmd):
+        """Return the name of the command to run for cmd (in upper case):
+        cmd itself, or with COMMAND_ABBREVIATIONS the one command whose
+        name starts with it.  Writes an error and returns None if there
+        is no such command."""
+        if cmd in self.COMMANDS:
+            return cmd
+        names = self.COMMANDS.resolve(cmd) if self.COMMAND_ABBREVIATIONS else []
+        if len(names) == 1:
+            return names[0]
+        if names:
+            self.writeerror("Ambiguous command '%s': %s" % (cmd, ', '.join(names)))
+        else:
+            self.writeerror("Unknown command '%s'" % cmd)
+        return None
+
+# ---------------------------- Command Execution ---------------------------
+
+    def call_paged(self, method, params):
+        """Call the method of a command and page the lines it returns"""
+        result = self.call_command(method, params)
+        if is_lines(result):
+            # Lines yielded or returned by the command
+            self.writepaged(result)
+
+    def call_command(self, method, params):
+        """Call the method of a command, on the command executor if it is
+        marked executor='thread' or the command process pool if marked
+        executor='process'.  Returns what the method returned."""
+        executor = getattr(method, 'executor', None)
+        if executor == 'thread':
+            return self.call_in_thread(method, params)
+        if executor == 'process':
+            return self.call_in_process(method, params)
+        return method(params)
+
+    def call_in_thread(self, method, params):
+        """Call the method of a command on the command executor, waiting
+        for it with wait_command.  The lines of a generator are taken
+        from it on the executor too, COMMAND_BATCH at a time."""
+        run = ThreadCommand(self, self.command_relay())
+        result = self.run_in_thread(run, method, params)
+        if isinstance(result, types.GeneratorType):
+            return self.thread_lines(run, result)
+        return result
+
+    def run_in_thread(self, run, fn, *args):
+        """Call fn(*args) for the ThreadCommand run on the command
+        executor and return the result"""
+        future = self.submit_command(run, fn, *args)
+        try:
+            return self.wait_command(future)
+        finally:
+            run.finish(future)
+
+    def thread_lines(self, run, lines):
+        """Yield the lines of a generator command, taken from it on the
+        command executor as they are paged"""
+        try:
+            while True:
+                batch = self.run_in_thread(run, next_lines, lines, self.COMMAND_BATCH)
+                if not batch:
+                    return
+                yield from batch
+        finally:
+            if not run.abandoned:
+                self.run_in_thread(run, lines.close)
+
+    def submit_command(self, run, fn, *args):
+        """Start fn(*args) for the ThreadCommand run on the command
+        executor.  Returns its future."""
+        self.command_threads = True
+        return self.command_executor().submit(run, fn, *args)
+
+    def wait_command(self, future):
+        """Wait for a command running on the command executor and return
+        its result.  Backends able to stop waiting when the command is
+        interrupted override this."""
+        return future.result()
+
+    def command_relay(self):
+        """Return the function handing output over to the session from a
+        command executor thread, see ThreadCommand.  None writes it
+        directly."""
+        return None
+
+    def message_relay(self):
+        """Return the function handing an asynchronous message over to the
+        session when it is written from a thread the session may not write
+        from, or None to write it here.  Backends whose output functions
+        are thread safe write it here."""
+        return None
+
+    def command_executor(self):
+        """Return the executor running the commands marked executor='thread'"""
+        if self.COMMAND_EXECUTOR is not None:
+            return self.COMMAND_EXECUTOR
+        with command_pools_lock:
+            pool = command_pools.get(self.command_pool_class)
+            if pool is None:
+                pool = command_pools[self.command_pool_class] = self.command_pool_class(self.COMMAND_THREADS)
+        return pool
+
+    def call_in_process(self, method, params):
+        """Start the method of a command in the command process pool.
+        Returns the lines it returns or yields, or None if the pool is full."""
+        task = self.submit_process(method, params)
+        if task is None:
+            return None
+        return self.process_lines(task)
+
+    def submit_process(self, method, params):
+        """Start the method of a command in the command process pool,
+        returning its processes.ProcessTask.  Writes BUSY_MESSAGE and
+        returns None if the pool is full."""
+        task = self.command_process_pool().submit(
+            getattr(method, '__func__', method), ProcessSession(self, self.COMMAND_BATCH), params)
+        if task is None:
+            self.writeerror(self.BUSY_MESSAGE)
+        return task
+
+    def process_lines(self, task):
+        """Write out the output of a command running in the command process
+        pool as it arrives, yielding the lines it returns or yields.  The
+        command is stopped once they are no longer wanted."""
+        try:
+            while True:
+                message = task.take()
+                if message is None:
+                    self.wait_command(task.waiter())
+                    continue
+                kind, payload = message
+                if kind == 'end':
+                    if payload is not None:
+                        raise payload
+                    return
+                for name, text in payload:
+                    if name is None:
+                        yield text
+                    elif name in OUTPUT_METHODS:
+                        getattr(self, name)(text)
+                self.flush()
+        finally:
+            task.close()
+
+    @classmethod
+    def command_process_pool(cls):
+        """Return the processes.ProcessPool running the commands marked
+        executor='process', whose stats() are its metrics"""
+        if cls.COMMAND_PROCESS_POOL is not None:
+            return cls.COMMAND_PROCESS_POOL
+        with command_pools_lock:
+            pool = command_pools.get(cls.process_pool_class)
+            if pool is None:
+                pool = command_pools[cls.process_pool_class] = cls.process_pool_class(
+                    cls.COMMAND_PROCESSES, cls.COMMAND_PROCESS_QUEUE)
+        return pool
+
+    def interrupt(self, cmd=IP):
+        """Interrupt the running command, for Ctrl-C or the telnet IP, BRK
+        or AO command.  AO also throws away the output not yet sent."""
+        if cmd == AO:
+            self.output_discard()
+        if self.command_running and not self.interrupted:
+            log.debug("Interrupting the command: %s" % (CMDS.get(cmd, cmd), ))
+            self.interrupted = True
+            self.cancel_command()
+
+    def cancel_command(self):
+        """Stop the interrupted command, or at least stop waiting for it.
+        Left to itself, a command stops the next time it writes a line.
+        Backends that can do better override this."""
+        pass
+
+
+TelnetHandlerBase.command_registry = CommandRegistry(TelnetHandlerBase)
@@ -0,0 +1,300 @@
+"""
+# Process-wide cache of terminal capabilities
+"""
+
+import ast
+import curses
+import re
+import subprocess
+import sys
+import threading
+from collections import namedtuple, OrderedDict
+from curses.has_key import _capability_names as KEY_CAPABILITIES
+from types import MappingProxyType
+from telnetsrv.utils import chr_py3, bytes_to_str
+import logging
+
+log = logging.getLogger(__name__)
+
+# Terminal output codes used by the line editor, and their terminfo names
+CODE_CAPABILITIES = {
+    'DEOL': 'el',        # Delete to end of line
+    'DEL': 'dch1',       # Delete and close up
+    'INS': 'ich1',       # Insert space
+    'CSRLEFT': 'cub1',   # Move cursor left 1 space
+    'CSRRIGHT': 'cuf1',  # Move cursor right 1 space
+    'CSRLEFTN': 'cub',   # Move cursor left %p1%d spaces
+    'CSRRIGHTN': 'cuf',  # Move cursor right %p1%d spaces
+    'INSN': 'ich',       # Insert %p1%d spaces
+    'DELN': 'dch',       # Delete %p1%d characters and close up
+}
+# Padding (delays) in a capability string, which a telnet client has no use for
+PADDING = re.compile(br'\$<[0-9.]*[*/]*>')
+# What a terminal type name looks like; others are not looked up
+TERM_NAME = re.compile(r'[a-z0-9][a-z0-9+._-]{0,63}\Z')
+# Unknown terminal types remembered, the least recently sent forgotten first
+UNKNOWN_MAX = 256
+# Child processes reading terminfo at once, at most; other lookups of new
+# terminal types wait their turn, so a flood of them cannot fork a flood
+QUERY_MAX = 2
+
+# The terminfo database is read by a child process: curses sets up one
+# terminal per process and silently ignores any later setupterm call.
+_QUERY = '''
+import curses, os, sys
+curses.setupterm(sys.argv[1], os.open(os.devnull, os.O_WRONLY))
+print(repr([curses.tigetstr(name) for name in sys.argv[2:]]))
+'''
+
+
+ESC = chr_py3(27)
+
+# ANSI key sequences: CSI (ESC [) <params> <final> and SS3 (ESC O) <final>
+CSI_KEYS = {
+    b'A': curses.KEY_UP,
+    b'B': curses.KEY_DOWN,
+    b'C': curses.KEY_RIGHT,
+    b'D': curses.KEY_LEFT,
+    b'H': curses.KEY_HOME,
+    b'F': curses.KEY_END,
+    b'P': curses.KEY_F1,
+    b'Q': curses.KEY_F2,
+    b'R': curses.KEY_F3,
+    b'S': curses.KEY_F4,
+    b'Z': curses.KEY_BTAB,
+}
+# CSI <number> ~
+CSI_TILDE_KEYS = {
+    1: curses.KEY_HOME,
+    2: curses.KEY_IC,
+    3: curses.KEY_DC,
+    4: curses.KEY_END,
+    5: curses.KEY_PPAGE,
+    6: curses.KEY_NPAGE,
+    7: curses.KEY_HOME,
+    8: curses.KEY_END,
+}
+for _n, _f in enumerate([11, 12, 13, 14, 15, 17, 18, 19, 20, 21, 23, 24]):
+    CSI_TILDE_KEYS[_f] = curses.KEY_F1 + _n
+# Longest CSI sequence to wait for
+CSI_MAX = 16
+
+
+def inputcooker_special(escseq):
+    """Compile a pattern finding the next raw char that needs cooking:
+    IAC, CR or the start of a key sequence."""
+    starts = set([chr_py3(255), chr_py3(13), ESC] + [k[:1] for k in escseq if k])
+    return re.compile(b'[' + b''.join(re.escape(c) for c in sorted(starts)) + b']')
+
+
+class KeyDecoder(object):
+    """Decodes key escape sequences with bounded lookahead.
+
+    The terminal's own sequences are matched with a prefix trie; any
+    other ANSI CSI or SS3 sequence is decoded generically.  A key whose
+    sequence starts another's is kept on the trie's inner node, under
+    None, and taken once the next byte does not go on to the longer
+    sequence, or by resolve once no more bytes are coming.
+    """
+    # match() result while the sequence is not complete yet
+    INCOMPLETE = None
+    # match() result when no key sequence starts here
+    NOMATCH = (None, 0)
+
+    def __init__(self, escseq):
+        # Nested dicts keyed by byte, the leaves are key codes
+        self.trie = {}
+        for seq, key in escseq.items():
+            node = self.trie
+            for b in seq[:-1]:
+                child = node.get(b)
+                if child is None:
+                    child = node[b] = {}
+                elif not isinstance(child, dict):
+                    # A shorter key ends here
+                    child = node[b] = {None: child}
+                node = child
+            child = node.get(seq[-1])
+            if child is None:
+                node[seq[-1]] = key
+            elif isinstance(child, dict):
+                child.setdefault(None, key)
+        self.starts = frozenset(chr_py3(b) for b in self.trie) | frozenset([ESC])
+
+    def match(self, seq):
+        """Match the start of seq against the key sequences.
+
+        Return (key, length) for a complete sequence, where key is None
+        for a well formed but unknown sequence, INCOMPLETE if more bytes
+        are needed, or NOMATCH.
+        """
+        node = self.trie
+        shorter = None
+        for i, b in enumerate(seq):
+            node = node.get(b)
+            if node is None:
+                break
+            if not isinstance(node, dict):
+                return (node, i + 1)
+            if None in node:
+                shorter = (node[None], i + 1)
+        else:
+            return self.INCOMPLETE
+        if shorter is not None:
+            return shorter
+        return self._match_ansi(seq)
+
+    def resolve(self, seq):
+        """Match seq, an incomplete sequence no more bytes are coming for,
+        against the keys whose sequences start longer ones.  Return (key,
+        length) for the longest it starts with, or INCOMPLETE."""
+        node = self.trie
+        shorter = self.INCOMPLETE
+        for i, b in enumerate(seq):
+            node = node.get(b)
+            if not isinstance(node, dict):
+                break
+            if None in node:
+                shorter = (node[None], i + 1)
+        return shorter
+
+    def _match_ansi(self, seq):
+        if seq[:1] != ESC:
+            return self.NOMATCH
+        if len(seq) < 3:
+            return self.INCOMPLETE if seq[1:2] in (b'', b'[', b'O') else self.NOMATCH
+        if seq[1:2] == b'O':
+            return (CSI_KEYS.get(seq[2:3]), 3)
+        if seq[1:2] != b'[':
+            return self.NOMATCH
+        for i in range(2, min(len(seq), CSI_MAX)):
+            b = seq[i]
+            if 0x40 <= b <= 0x7e:
+                # The final byte
+                if b == ord('~'):
+                    number = seq[2:i].split(b';')[0]
+                    return (CSI_TILDE_KEYS.get(int(number) if number.isdigit() else 0), i + 1)
+                return (CSI_KEYS.get(seq[i:i + 1]), i + 1)
+            if not 0x20 <= b <= 0x3f:
+                return self.NOMATCH
+        return self.INCOMPLETE if len(seq) < CSI_MAX else self.NOMATCH
+
+
+# Used until the terminal type is known
+ANSI_DECODER = KeyDecoder({})
+
+
+class TermCaps(namedtuple('TermCaps', ['term', 'codes', 'escseq', 'special', 'decoder'])):
+    """The capabilities of a terminal type, shared by all its sessions.
+
+    term    = The terminal type
+    codes   = Read only map of output code name to escape sequence
+    escseq  = Read only map of key escape sequence to curses key code
+    special = Compiled pattern matching the raw chars the input cooker
+              must look at: IAC, CR and the start of a key sequence
+    decoder = KeyDecoder for the key sequences
+    """
+
+
+_lock = threading.Lock()
+_queries = threading.BoundedSemaphore(QUERY_MAX)
+_capstrings = {}
+_unknown = OrderedDict()
+# Set as the terminal types being read from terminfo are done
+_reading = {}
+_caps = {}
+
+
+def _query(term):
+    """Read the capability strings for a terminal type from terminfo.
+    Raise curses.error if the terminal type is not known."""
+    names = sorted(set(CODE_CAPABILITIES.values()) | set(KEY_CAPABILITIES.values()))
+    with _queries:
+        log.debug("Reading terminfo for %s" % (term, ))
+        proc = subprocess.run([sys.executable, '-c', _QUERY, term] + names,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode:
+        message = bytes_to_str(proc.stderr).strip().splitlines()
+        raise curses.error(message[-1] if message else 'setupterm failed for %s' % (term, ))
+    return dict(zip(names, ast.literal_eval(bytes_to_str(proc.stdout))))
+
+
+def capstrings(term, query=True):
+    """Return the capability strings for a terminal type, reading terminfo once per type.
+    With query False, return None rather than read terminfo.
+    Raise curses.error if the terminal type is not known."""
+    while True:
+        with _lock:
+            strings = _capstrings.get(term)
+            if strings is not None:
+                return strings
+            error = _unknown.get(term)
+            if error is not None:
+                _unknown.move_to_end(term)
+                raise error
+            if not query:
+                return None
+            done = _reading.get(term)
+            if done is None:
+                done = _reading[term] = threading.Event()
+                break
+        # Another thread is reading it
+        done.wait()
+    try:
+        strings = _query(term)
+    except curses.error as e:
+        with _lock:
+            # Remember unknown types too, clients may keep sending them
+            _unknown[term] = e
+            while len(_unknown) > UNKNOWN_MAX:
+                _unknown.popitem(last=False)
+        raise
+    else:
+        with _lock:
+            _capstrings[term] = strings
+        return strings
+    finally:
+        with _lock:
+            del _reading[term]
+        done.set()
+
+
+def lookup(term, keys, codes, query=True):
+    """Return the TermCaps for a terminal type.
+
+    keys  = The curses key codes to decode
+    codes = Default output codes, overridden by terminfo where it has them
+    query = Read terminfo if need be, which takes a child process.  If
+            False, return None for a type not read yet.
+    Raise curses.error if the terminal type is not known.
+    """
+    term = bytes_to_str(term).lower()
+    keys = frozenset(keys)
+    codes = frozenset(codes.items())
+    try:
+        return _caps[term, keys, codes]
+    except KeyError:
+        pass
+    if not TERM_NAME.match(term):
+        raise curses.error('Bad terminal type %r' % (term[:64], ))
+    strings = capstrings(term, query)
+    if strings is None:
+        return None
+    with _lock:
+        caps = _caps.get((term, keys, codes))
+        if caps is None:
+            escseq = {}
+            for k in KEY_CAPABILITIES:
+                if k in keys and strings.get(KEY_CAPABILITIES[k]):
+                    escseq[strings[KEY_CAPABILITIES[k]]] = k
+            outcodes = dict(codes)
+            for name, capname in CODE_CAPABILITIES.items():
+                code = PADDING.sub(b'', strings.get(capname) or b'')
+                if code and b'%' in code.replace(b'%p1%d', b''):
+                    # Only a plain %p1%d parameter is filled in
+                    code = None
+                outcodes[name] = code or outcodes.get(name, b'')
+            caps = TermCaps(term, MappingProxyType(outcodes), MappingProxyType(escseq),
+                            inputcooker_special(escseq), KeyDecoder(escseq))
+            _caps[term, keys, codes] = caps
+    return caps
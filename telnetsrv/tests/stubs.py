@@ -0,0 +1,23 @@
+from telnetsrv.telnetsrvlib import TelnetHandlerBase
+
+
+class RecordingHandler(TelnetHandlerBase):
+    """A handler with no connection, recording the output queued for the
+    client and reading keys from a list."""
+    def __init__(self, keys=()):
+        self.init_session()
+        self.sock = None
+        self.keys = list(keys)
+        self.output = b''
+
+    def output_ready(self):
+        while self.outq:
+            data = self.outq.popleft()
+            self.output += data
+            self.output_sent(len(data))
+
+    def getc(self, block=True):
+        return self.keys.pop(0)
+
+    def inputcooker_store_queue(self, char):
+        pass
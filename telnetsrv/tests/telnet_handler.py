@@ -1,4 +1,5 @@
 from gevent import monkey; monkey.patch_all()
+import hashlib
 import logging
 import gevent
 import curses
@@ -47,6 +48,7 @@ class DummyTelnetHandler(TelnetHandler):
 
     WELCOME = b'You have connected to the test server.'
     PROMPT = b"TestServer> "
+    NEGOTIATION_TIMEOUT = 0.1
     authNeedUser = True
     authNeedPass = False
 
@@ -91,10 +93,10 @@ class DummyTelnetHandler(TelnetHandler):
         for (v, k) in list(self.ESCSEQ.items()):
             line = '%-10s : ' % (self.KEYS[k], )
             for c in v:
-                if ord(c) < 32 or ord(c) > 126:
+                if c < 32 or c > 126:
                     line = line + curses.ascii.unctrl(c)
                 else:
-                    line = line + c
+                    line = line + chr(c)
             self.writeresponse(line)
 
     @command('params')
@@ -158,6 +160,29 @@ class DummyTelnetHandler(TelnetHandler):
         else:
             self.writeerror(b'Passwords don\'t match.')
 
+    @command('sleep')
+    def command_sleep(self, params):
+        """[<seconds>]
+        Sleep, unless interrupted.
+        Sleep for a while, 10 seconds unless given.
+        Ctrl-C interrupts it.
+        """
+        self.writeresponse(b"Sleeping...")
+        self.flush()
+        gevent.sleep(float(params[0]) if params else 10)
+        self.writeresponse(b"Done")
+
+    @command('hash', executor='thread')
+    def command_hash(self, params):
+        """<text> [<rounds>]
+        Hash text, on a thread.
+        Hash text with PBKDF2-SHA256, 100000 rounds unless given.
+        The hashing runs on a thread, holding up no other session.
+        """
+        rounds = int(params[1]) if len(params) > 1 else 100000
+        digest = hashlib.pbkdf2_hmac('sha256', params[0].encode(), b'telnetsrv', rounds)
+        self.writeresponse(digest.hex())
+
     # Older method of defining a command
     # must start with "cmd" and end wtih the command name.
     # Aliases may be attached after the method definitions.
@@ -0,0 +1,97 @@
+import socket
+import threading
+import unittest
+from unittest import mock
+from telnetsrv.admission import Admission
+from telnetsrv.threaded import TelnetServer
+from telnetsrv.tests.test_threaded import ThreadedTelnetHandler
+
+
+class TestAdmission(unittest.TestCase):
+    def test_max_sessions(self):
+        admission = Admission(max_sessions=2)
+        first = admission.admit(('10.0.0.1', 1000))
+        second = admission.admit(('10.0.0.2', 1000))
+        second.established()
+        self.assertIsNone(admission.admit(('10.0.0.3', 1000)))
+        second.release()
+        second.release()
+        self.assertIsNotNone(admission.admit(('10.0.0.3', 1000)))
+        first.release()
+        stats = admission.stats()
+        self.assertEqual((stats['pending'], stats['sessions']), (1, 0))
+        self.assertEqual(stats['rejected'], {'sessions': 1})
+
+    def test_max_pending(self):
+        admission = Admission(max_pending=1)
+        ticket = admission.admit(('10.0.0.1', 1000))
+        self.assertIsNone(admission.admit(('10.0.0.1', 1001)))
+        # Logged in sessions do not count against max_pending
+        ticket.established()
+        self.assertIsNotNone(admission.admit(('10.0.0.1', 1002)))
+
+    def test_rate(self):
+        admission = Admission(rate=2, burst=3)
+        with mock.patch('time.monotonic', return_value=100.0):
+            results = [admission.admit(('10.0.0.1', port)) is not None for port in range(5)]
+            self.assertEqual(results, [True, True, True, False, False])
+            # Other addresses have buckets of their own
+            self.assertIsNotNone(admission.admit(('10.0.0.2', 1000)))
+        with mock.patch('time.monotonic', return_value=100.5):
+            self.assertIsNotNone(admission.admit(('10.0.0.1', 1000)))
+            self.assertIsNone(admission.admit(('10.0.0.1', 1001)))
+        self.assertEqual(admission.stats()['rejected'], {'rate': 3})
+
+    def test_sources_bounded(self):
+        admission = Admission(rate=1)
+        admission.max_sources = 10
+        for i in range(100):
+            admission.admit(('10.0.0.%d' % i, 1000))
+        self.assertEqual(len(admission.buckets), 10)
+
+
+class AdmittedHandler(ThreadedTelnetHandler):
+    admission = Admission(max_sessions=1, banner=b"Go away.\r\n")
+
+
+class TestAdmittedServer(unittest.TestCase):
+    def setUp(self):
+        self.server = TelnetServer(('127.0.0.1', 0), AdmittedHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def read_all(self, s):
+        data = b''
+        while True:
+            chunk = s.recv(1024)
+            if not chunk:
+                return data
+            data += chunk
+
+    def test_turned_away(self):
+        s = socket.create_connection(self.server.server_address, timeout=5)
+        data = b''
+        while not data.endswith(b'TestServer> '):
+            data += s.recv(1024)
+        self.assertEqual(AdmittedHandler.admission.stats()['sessions'], 1)
+        s2 = socket.create_connection(self.server.server_address, timeout=5)
+        self.assertEqual(self.read_all(s2), b"Go away.\r\n")
+        s2.close()
+        s.sendall(b'exit\r\n')
+        self.read_all(s)
+        s.close()
+        # The place is free again
+        s3 = socket.create_connection(self.server.server_address, timeout=5)
+        data = b''
+        while not data.endswith(b'TestServer> '):
+            data += s3.recv(1024)
+        s3.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
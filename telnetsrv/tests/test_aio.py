@@ -0,0 +1,382 @@
+import asyncio
+import itertools
+import threading
+import time
+import unittest
+from telnetsrv.aio import TelnetHandler, command
+from telnetsrv.metrics import Metrics
+from telnetsrv.telnetsrvlib import SessionRegistry, IAC, SB, SE, NAWS, TTYPE, IS, \
+    DO, DONT, WILL, WONT, ECHO, SGA, NEW_ENVIRON, IP, AO
+
+
+class AioTelnetHandler(TelnetHandler):
+    WELCOME = b'You have connected to the test server.'
+    PROMPT = b"TestServer> "
+    NEGOTIATION_TIMEOUT = 0.1
+    release = threading.Event()
+    message_loops = []
+
+    @command('echo')
+    def command_echo(self, params):
+        """<text to echo>
+        Echo text back to the console.
+        """
+        self.writeresponse(' '.join(params))
+
+    @command('status')
+    def command_status(self, params):
+        """
+        Return a status value, not written.
+        """
+        return 'ok' if params else True
+
+    @command('ask')
+    async def command_ask(self, params):
+        """
+        Ask for a value and echo it back.
+        """
+        answer = await self.readline(prompt=b"Value: ", use_history=False)
+        self.writeresponse(b"Got " + answer)
+
+    @command('rows')
+    async def command_rows(self, params):
+        """<count>
+        Display numbered rows.
+        """
+        for i in range(int(params[0])):
+            yield 'row %d' % i
+
+    @command('sleep')
+    async def command_sleep(self, params):
+        """
+        Sleep until interrupted.
+        """
+        self.writeresponse('Sleeping')
+        self.flush()
+        await asyncio.sleep(10)
+        self.writeresponse('Woke')
+
+    @command('count', executor='thread')
+    def command_count(self, params):
+        """
+        Count for ever, on a thread.
+        """
+        for i in itertools.count():
+            yield 'count %d' % i
+
+    @command('lookup', executor='thread')
+    def command_lookup(self, params):
+        """
+        Look up on a thread, until released.
+        """
+        self.writeresponse('Looking up')
+        self.flush()
+        self.release.wait(5)
+        for i in range(3):
+            self.writeresponse('found %d' % i)
+
+    @command('notify', executor='thread')
+    def command_notify(self, params):
+        """
+        Write a message, and one to the other sessions, on a thread.
+        """
+        self.writemessage('Notice')
+        self.broadcast('All', filter=lambda handler: handler is not self)
+        self.writeresponse('done')
+
+    def _writemessage_cooked(self, data):
+        try:
+            self.message_loops.append(asyncio.get_running_loop())
+        except RuntimeError:
+            self.message_loops.append(None)
+        TelnetHandler._writemessage_cooked(self, data)
+
+    @command('report', executor='process')
+    def command_report(self, params):
+        """[count]
+        Report on items, in a child process; for ever without a count.
+        """
+        self.writeresponse('Report for %s' % self.TERM)
+        for i in range(int(params[0])) if params else itertools.count():
+            yield 'item %d' % i
+
+
+class TestAioTelnetServer(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        AioTelnetHandler.release.clear()
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_server(AioTelnetHandler, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        AioTelnetHandler.release.set()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def converse(self, *lines, port=None):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port or self.port)
+        await reader.readuntil(b'TestServer> ')
+        for line in lines:
+            writer.write(line)
+        await writer.drain()
+        data = b''
+        while not data.endswith(b'TestServer> '):
+            data += await asyncio.wait_for(reader.read(1024), 5)
+        writer.close()
+        return data
+
+    async def test_cmd_echo(self):
+        data = await self.converse(b'echo Hi! This is a test!\r\n')
+        self.assertEqual(data, b'echo Hi! This is a test!\r\nHi! This is a test!\r\nTestServer> ')
+
+    async def test_cmd_return_value(self):
+        for line in (b'status x\r\n', b'status\r\n'):
+            data = await self.converse(line)
+            self.assertEqual(data, line + b'TestServer> ')
+
+    async def test_async_cmd_readline(self):
+        data = await self.converse(b'ask\r\n', b'42\r\n')
+        self.assertIn(b'Value: 42\r\nGot 42\r\nTestServer> ', data)
+
+    async def test_continuation_line(self):
+        data = await self.converse(b'echo 1 \\\r\n', b'2\r\n')
+        self.assertIn(b'... 2\r\n1 2\r\nTestServer> ', data)
+
+    async def test_unknown_cmd(self):
+        data = await self.converse(b'unknown command\r\n')
+        self.assertIn(b"Unknown command 'UNKNOWN'", data)
+
+    async def interrupt(self, line, started, interrupt):
+        """Run a command, interrupting it once it has written started"""
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        await reader.readuntil(b'TestServer> ')
+        writer.write(line)
+        await asyncio.wait_for(reader.readuntil(started), 5)
+        start = time.monotonic()
+        writer.write(interrupt)
+        data = await asyncio.wait_for(reader.readuntil(b'TestServer> '), 5)
+        self.assertLess(time.monotonic() - start, 2)
+        writer.close()
+        return data
+
+    async def test_interrupt(self):
+        data = await self.interrupt(b'sleep\r\n', b'Sleeping\r\n', IAC + IP)
+        self.assertEqual(data, b'^C Interrupted\r\nTestServer> ')
+        # Paged output is interrupted at MORE_PROMPT, which is erased
+        data = await self.interrupt(IAC + SB + NAWS + b'\x00\x50\x00\x03' + IAC + SE + b'rows 1000\r\n',
+                                    b'--More--', b'\x03')
+        self.assertEqual(data, b'\r\x1b[K^C Interrupted\r\nTestServer> ')
+
+    async def test_thread_command(self):
+        AioTelnetHandler.release.set()
+        data = await self.converse(b'lookup\r\n')
+        self.assertEqual(data, b'lookup\r\nLooking up\r\nfound 0\r\nfound 1\r\nfound 2\r\nTestServer> ')
+
+    async def test_thread_command_lines(self):
+        # The lines are taken from the generator as they are paged
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        await reader.readuntil(b'TestServer> ')
+        writer.write(IAC + SB + NAWS + b'\x00\x50\x00\x03' + IAC + SE + b'count\r\n')
+        data = await asyncio.wait_for(reader.readuntil(b'--More--'), 5)
+        self.assertTrue(data.endswith(b'count 0\r\ncount 1\r\n--More--'))
+        writer.write(b'q')
+        data = await asyncio.wait_for(reader.readuntil(b'TestServer> '), 5)
+        self.assertNotIn(b'count', data)
+        writer.close()
+
+    async def test_thread_command_message(self):
+        # The messages are written on the loop, not the command's thread
+        del AioTelnetHandler.message_loops[:]
+        clients = []
+        for _ in range(2):
+            reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+            await reader.readuntil(b'TestServer> ')
+            clients.append((reader, writer))
+        clients[0][1].write(b'notify\r\n')
+        data = await asyncio.wait_for(clients[0][0].readuntil(b'done\r\nTestServer> '), 5)
+        self.assertIn(b'\r\nNotice\r\n', data)
+        data = await asyncio.wait_for(clients[1][0].readuntil(b'\r\nAll\r\nTestServer> '), 5)
+        for reader, writer in clients:
+            writer.close()
+        self.assertEqual(set(AioTelnetHandler.message_loops), {asyncio.get_running_loop()})
+
+    async def test_thread_command_interrupt(self):
+        data = await self.interrupt(b'lookup\r\n', b'Looking up\r\n', IAC + AO)
+        self.assertEqual(data, b'^C Interrupted\r\nTestServer> ')
+
+    async def test_process_command(self):
+        data = await self.converse(b'report 3\r\n')
+        self.assertEqual(data, b'report 3\r\nReport for ansi\r\nitem 0\r\nitem 1\r\nitem 2\r\nTestServer> ')
+
+    async def test_process_command_lines(self):
+        # The command is stopped once the pager is quit
+        pool = AioTelnetHandler.command_process_pool()
+        stopped = pool.stats()['stopped']
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        await reader.readuntil(b'TestServer> ')
+        writer.write(IAC + SB + NAWS + b'\x00\x50\x00\x03' + IAC + SE + b'report\r\n')
+        data = await asyncio.wait_for(reader.readuntil(b'--More--'), 5)
+        self.assertTrue(data.endswith(b'Report for ansi\r\nitem 0\r\nitem 1\r\n--More--'))
+        writer.write(b'q')
+        data = await asyncio.wait_for(reader.readuntil(b'TestServer> '), 5)
+        self.assertNotIn(b'item', data)
+        writer.close()
+        for _ in range(50):
+            if pool.stats()['stopped'] > stopped:
+                break
+            await asyncio.sleep(0.1)
+        self.assertEqual(pool.stats()['stopped'], stopped + 1)
+
+    async def test_start_server_handle(self):
+        server = await asyncio.start_server(AioTelnetHandler.start_server_handle, '127.0.0.1', 0)
+        try:
+            data = await self.converse(b'echo streams\r\n', port=server.sockets[0].getsockname()[1])
+            self.assertIn(b'\r\nstreams\r\nTestServer> ', data)
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    async def test_start_server_handle_flow_control(self):
+        # The handler gets the transport's flow control, so 'block' engages
+        class Handler(AioTelnetHandler):
+            OUTPUT_POLICY = 'block'
+            session_registry = SessionRegistry()
+
+            @command('flood')
+            async def command_flood(self, params):
+                await self.writestream(['x' * 65536] * 256)
+        server = await asyncio.start_server(Handler.start_server_handle, '127.0.0.1', 0)
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', server.sockets[0].getsockname()[1])
+            await reader.readuntil(b'TestServer> ')
+            writer.write(b'flood\r\n')
+            handler, = Handler.session_registry
+            for _ in range(50):
+                if handler.drain_waiter is not None:
+                    break
+                await asyncio.sleep(0.1)
+            self.assertIs(handler.transport.get_protocol(), handler)
+            self.assertIsNotNone(handler.drain_waiter)
+            writer.close()
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    async def test_paged_rows(self):
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        await reader.readuntil(b'TestServer> ')
+        writer.write(IAC + SB + NAWS + b'\x00\x50\x00\x03' + IAC + SE + b'rows 1000\r\n')
+        data = await asyncio.wait_for(reader.readuntil(b'--More--'), 5)
+        self.assertTrue(data.endswith(b'row 0\r\nrow 1\r\n--More--'))
+        writer.write(b' ')
+        data = await asyncio.wait_for(reader.readuntil(b'--More--'), 5)
+        self.assertTrue(data.endswith(b'row 2\r\nrow 3\r\n--More--'))
+        writer.write(b'q')
+        data = await asyncio.wait_for(reader.readuntil(b'TestServer> '), 5)
+        self.assertNotIn(b'row', data)
+        writer.close()
+
+    async def test_broadcast(self):
+        class Handler(AioTelnetHandler):
+            session_registry = SessionRegistry()
+        server = await asyncio.start_server(Handler.start_server_handle, '127.0.0.1', 0)
+        try:
+            port = server.sockets[0].getsockname()[1]
+            clients = []
+            for _ in range(3):
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                await reader.readuntil(b'TestServer> ')
+                clients.append((reader, writer))
+            self.assertEqual(len(Handler.session_registry), 3)
+            # The first client has started typing a line, and is left out of the first message
+            clients[0][1].write(b'ech')
+            await clients[0][0].readexactly(3)
+            first = clients[0][1].get_extra_info('sockname')
+            self.assertEqual(Handler.broadcast('Going down\xff', filter=lambda h: h.client_address != first), 2)
+            self.assertEqual(Handler.broadcast('Now'), 3)
+            expected = [b'\r\nNow\r\nTestServer> ech'] + [
+                b'\r\nGoing down\xff\xff\r\nTestServer> \r\nNow\r\nTestServer> '] * 2
+            for (reader, writer), data in zip(clients, expected):
+                self.assertEqual(await asyncio.wait_for(reader.readexactly(len(data)), 5), data)
+                writer.close()
+        finally:
+            server.close()
+            await server.wait_closed()
+
+
+    async def negotiate(self, answers):
+        class Handler(AioTelnetHandler):
+            NEGOTIATION_TIMEOUT = 5
+            session_registry = SessionRegistry()
+        server = await asyncio.start_server(Handler.start_server_handle, '127.0.0.1', 0)
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', server.sockets[0].getsockname()[1])
+            start = time.monotonic()
+            await reader.readuntil(IAC + DO + NEW_ENVIRON)
+            writer.write(answers)
+            await asyncio.wait_for(reader.readuntil(b'TestServer> '), 5)
+            elapsed = time.monotonic() - start
+            handler, = Handler.session_registry
+            writer.close()
+            return handler, elapsed
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    async def test_negotiation_answered(self):
+        # The session starts as soon as the client has answered
+        handler, elapsed = await self.negotiate(
+            IAC + DO + ECHO + IAC + DO + SGA + IAC + WILL + SGA + IAC + WONT + NEW_ENVIRON +
+            IAC + WILL + NAWS + IAC + SB + NAWS + b'\x00\x50\x00\x1e' + IAC + SE +
+            IAC + WILL + TTYPE + IAC + SB + TTYPE + IS + b'vt100' + IAC + SE)
+        self.assertLess(elapsed, 2)
+        self.assertEqual((handler.TERM, handler.HEIGHT), ('vt100', 30))
+        self.assertEqual(handler.CODES['DEOL'], b'\x1b[K')
+        self.assertFalse(handler.negotiating)
+
+    async def test_negotiation_refused(self):
+        handler, elapsed = await self.negotiate(
+            IAC + DO + ECHO + IAC + DONT + SGA + IAC + WONT + SGA + IAC + WONT + NAWS +
+            IAC + WONT + TTYPE + IAC + WONT + NEW_ENVIRON)
+        self.assertLess(elapsed, 2)
+        self.assertEqual(handler.windowsize, None)
+
+    async def test_negotiation_ends_on_input(self):
+        # A client that starts typing is not going to answer
+        handler, elapsed = await self.negotiate(b'echo typed\r\n')
+        self.assertLess(elapsed, 2)
+
+    async def test_metrics(self):
+        class Handler(AioTelnetHandler):
+            METRICS = Metrics()
+            session_registry = SessionRegistry()
+        server = await asyncio.start_server(Handler.start_server_handle, '127.0.0.1', 0)
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', server.sockets[0].getsockname()[1])
+            await reader.readuntil(b'TestServer> ')
+            for line in (b'echo hi\r\n', b'echo there\r\n'):
+                writer.write(line)
+                await asyncio.wait_for(reader.readuntil(b'TestServer> '), 5)
+            # An error ends the session
+            writer.write(b'rows x\r\n')
+            await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+            for _ in range(50):
+                if not Handler.session_registry:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            server.close()
+            await server.wait_closed()
+        snapshot = Handler.METRICS.snapshot()
+        self.assertEqual(snapshot['telnet_commands_total'], {(('command', 'ECHO'), ): 2, (('command', 'ROWS'), ): 1})
+        self.assertEqual(snapshot['telnet_command_errors_total'], {(('command', 'ROWS'), ): 1})
+        self.assertEqual(snapshot['telnet_command_seconds'][(('command', 'ECHO'), )]['count'], 2)
+        self.assertEqual(snapshot['telnet_negotiation_seconds'][()]['count'], 1)
+        self.assertEqual(snapshot['telnet_sessions_total'], {(): 1})
+        self.assertEqual(snapshot['telnet_session_received_bytes'][()]['sum'], 29)
+        self.assertGreater(snapshot['telnet_session_sent_bytes'][()]['sum'], 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
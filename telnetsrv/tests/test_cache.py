@@ -0,0 +1,160 @@
+import threading
+import time
+import unittest
+from telnetsrv.cache import CommandCache, cached
+from telnetsrv.telnetsrvlib import command
+from telnetsrv.tests.stubs import RecordingHandler
+
+
+class CachedHandler(RecordingHandler):
+    """A recording handler counting the runs of its cached commands."""
+    def __init__(self, username='alice', cache=None):
+        RecordingHandler.__init__(self)
+        self.username = username
+        self.COMMAND_CACHE = cache
+        self.runs = 0
+
+    @command('report')
+    @cached(60)
+    def command_report(self, params):
+        self.runs += 1
+        self.writeresponse('Report')
+        for p in params:
+            yield 'line %s' % p
+
+    @cached(60, key='username')
+    def command_whoami(self, params):
+        self.runs += 1
+        self.writeline(self.username)
+
+    @cached(60)
+    def command_stream(self, params):
+        self.runs += 1
+        self.writestream(iter(['one', 'two']))
+        self.writemessage('Note')
+        self.writepaged(['three'])
+
+    @cached(0.05)
+    def command_brief(self, params):
+        self.runs += 1
+        return ['brief']
+
+
+class TestCommandCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = CommandCache()
+
+    def test_hit(self):
+        handler = CachedHandler(cache=self.cache)
+        self.assertEqual(handler.command_report(['a', 'b']), ('line a', 'line b'))
+        other = CachedHandler('bob', self.cache)
+        self.assertEqual(other.command_report(['a', 'b']), ('line a', 'line b'))
+        self.assertEqual((handler.runs, other.runs), (1, 0))
+        other.flush()
+        self.assertEqual(other.output, b'Report\r\n')
+        other.command_report(['c'])
+        self.assertEqual(other.runs, 1)
+        stats = self.cache.stats()
+        self.assertEqual((stats['entries'], stats['hits'], stats['misses']), (2, 1, 2))
+
+    def test_decorators_stack(self):
+        self.assertEqual(CachedHandler.command_report.command_name, 'report')
+
+    def test_key_username(self):
+        alice = CachedHandler(cache=self.cache)
+        bob = CachedHandler('bob', self.cache)
+        for handler in (alice, bob, CachedHandler(cache=self.cache)):
+            handler.command_whoami([])
+        self.assertEqual(self.cache.stats()['entries'], 2)
+        bob.flush()
+        self.assertEqual(bob.output, b'bob\r\n')
+
+    def test_all_output_kept(self):
+        handler = CachedHandler(cache=self.cache)
+        handler.command_stream([])
+        handler.flush()
+        other = CachedHandler('bob', self.cache)
+        other.command_stream([])
+        other.flush()
+        self.assertEqual(other.runs, 0)
+        self.assertEqual(other.output, handler.output)
+        for text in (b'one', b'two', b'Note', b'three'):
+            self.assertIn(text, other.output)
+
+    def test_ttl(self):
+        handler = CachedHandler(cache=self.cache)
+        handler.command_brief([])
+        handler.command_brief([])
+        self.assertEqual(handler.runs, 1)
+        time.sleep(0.1)
+        handler.command_brief([])
+        self.assertEqual(handler.runs, 2)
+
+    def test_invalidate(self):
+        handler = CachedHandler(cache=self.cache)
+        handler.command_report([])
+        handler.command_whoami([])
+        self.cache.invalidate(handler.command_report)
+        self.assertEqual(self.cache.stats()['entries'], 1)
+        handler.command_report([])
+        self.assertEqual(handler.runs, 3)
+        self.cache.invalidate()
+        self.assertEqual(self.cache.stats(), dict(self.cache.stats(), entries=0, bytes=0))
+
+    def test_limits(self):
+        cache = CommandCache(max_entries=2, max_bytes=40)
+        handler = CachedHandler(cache=cache)
+        for p in ('a', 'b', 'c'):
+            handler.command_report([p])
+        self.assertEqual(cache.stats()['entries'], 2)
+        self.assertEqual(cache.stats()['evictions'], 1)
+        # Too big to keep at all
+        handler.command_report(['x' * 50])
+        handler.command_report(['x' * 50])
+        self.assertEqual(handler.runs, 5)
+        self.assertLessEqual(cache.stats()['bytes'], 40)
+
+    def test_single_flight(self):
+        started = threading.Event()
+        release = threading.Event()
+        runs = []
+
+        def run():
+            runs.append(1)
+            started.set()
+            release.wait(5)
+            return b'slow\r\n', None, 6
+
+        results = []
+        first = threading.Thread(target=lambda: results.append(self.cache.call(('slow', ), 60, run)))
+        first.start()
+        started.wait(5)
+        second = threading.Thread(target=lambda: results.append(self.cache.call(('slow', ), 60, run)))
+        second.start()
+        for _ in range(50):
+            if self.cache.stats()['shared']:
+                break
+            time.sleep(0.01)
+        release.set()
+        first.join(5)
+        second.join(5)
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(sorted(ran for entry, ran in results), [False, True])
+        self.assertIs(results[0][0], results[1][0])
+
+    def test_failure_not_kept(self):
+        def fail():
+            raise ValueError('bad')
+        self.assertRaises(ValueError, self.cache.call, ('fail', ), 60, fail)
+        entry, ran = self.cache.call(('fail', ), 60, lambda: (b'', ['ok'], 2))
+        self.assertTrue(ran)
+
+    def test_coroutine_refused(self):
+        async def coroutine(self, params):
+            pass
+        self.assertRaises(TypeError, cached(60), coroutine)
+        self.assertRaises(ValueError, cached, 60, key='user')
+
+
+if __name__ == '__main__':
+    unittest.main()
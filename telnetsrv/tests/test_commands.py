@@ -0,0 +1,197 @@
+import curses
+import unittest
+from telnetsrv.telnetsrvlib import TelnetHandlerBase, OptionState, command, DO, DONT, WILL, ECHO, SGA, NAWS, IAC
+from telnetsrv.tests.stubs import RecordingHandler
+
+
+class CommandHandler(RecordingHandler):
+    """A recording handler keeping the lines written as they are."""
+    def __init__(self):
+        RecordingHandler.__init__(self)
+        self.output = []
+
+    def writeline(self, text):
+        self.output.append(text)
+
+    def interfaces(self, params, text):
+        return ['eth0', 'eth1', 'lo'] if not params else []
+
+    @command('show', completer=interfaces)
+    def command_show(self, params):
+        """<interface>
+        Show an interface.
+        """
+        self.writeline('showing %s' % ' '.join(params))
+
+    @command('secret', hidden=True)
+    def command_secret(self, params):
+        self.writeline('hush')
+
+    @command(['status', 'stat'])
+    def command_status(self, params):
+        """[<detail>]
+        Show the status.
+        Show the status, in detail if asked.
+        """
+        self.writeline('ok %s' % ' '.join(params))
+
+    @command('done')
+    def command_done(self, params):
+        """
+        Return a status string.
+        """
+        self.writeline('finished')
+        return 'done'
+
+    @command('flag')
+    def command_flag(self, params):
+        """
+        Return a status flag.
+        """
+        return True
+
+    @command('rows')
+    def command_rows(self, params):
+        """
+        Return lines to page.
+        """
+        return ('row %d' % i for i in range(2))
+
+    def cmdPING(self, params):
+        """
+        Reply.
+        """
+        self.writeline('pong')
+
+
+class TestCommandRegistry(unittest.TestCase):
+    def test_registry_built_per_class(self):
+        registry = CommandHandler.command_registry
+        self.assertIs(registry.commands['STAT'], CommandHandler.command_status)
+        self.assertIn('PING', registry.commands)
+        self.assertNotIn('STATUS', TelnetHandlerBase.command_registry.commands)
+        self.assertIs(CommandHandler().COMMANDS.registry, registry)
+
+    def test_bound_lookup(self):
+        handler = CommandHandler()
+        handler.COMMANDS['STATUS'](['a'])
+        handler.COMMANDS['PING']([])
+        self.assertEqual(handler.output, ['ok a', 'pong'])
+
+    def test_return_values(self):
+        # Only lists, tuples and iterators are paged; other values are ignored
+        handler = CommandHandler()
+        self.assertTrue(handler.run_command(b'done'))
+        self.assertTrue(handler.run_command(b'flag'))
+        self.assertTrue(handler.run_command(b'rows'))
+        self.assertEqual(handler.output, ['finished', 'row 0', 'row 1'])
+
+    def test_help_precomputed(self):
+        handler = CommandHandler()
+        handler.cmdHELP(['stat'])
+        self.assertEqual(handler.output, ['STAT [<detail>]\n\nShow the status, in detail if asked.\n'])
+        self.assertEqual(handler.COMMANDS.help('PING').brief, 'PING - Reply.')
+
+    def test_help_listing(self):
+        handler = CommandHandler()
+        handler.cmdHELP([])
+        listing = CommandHandler.command_registry.listing
+        self.assertIs(handler.COMMANDS.listing(), listing)
+        self.assertEqual(handler.output[1:], list(listing))
+        self.assertIn('PING - Reply.', listing)
+        self.assertFalse([line for line in listing if line.startswith('SECRET')])
+
+    def test_changes_stay_in_session(self):
+        handler = CommandHandler()
+        handler.COMMANDS['EXTRA'] = handler.cmdPING
+        del handler.COMMANDS['STAT']
+        handler.COMMANDS['EXTRA']([])
+        self.assertEqual(handler.output, ['pong'])
+        self.assertNotIn('STAT', handler.COMMANDS)
+        self.assertEqual(handler.COMMANDS.help('EXTRA').brief, 'EXTRA - Reply.')
+        self.assertIn('STAT', CommandHandler().COMMANDS)
+        self.assertNotIn('EXTRA', CommandHandler.command_registry.commands)
+
+
+class TestCompletion(unittest.TestCase):
+    def test_matching(self):
+        commands = CommandHandler().COMMANDS
+        self.assertEqual(commands.matching('S'), ('SHOW', 'STAT', 'STATUS'))
+        self.assertEqual(commands.matching('X'), ())
+        self.assertEqual(commands.resolve('STA'), ['STAT'])
+        self.assertEqual(commands.resolve('S'), ['SHOW', 'STAT'])
+        self.assertEqual(commands.resolve('SECRET'), ['SECRET'])
+        self.assertEqual(commands.resolve('SEC'), [])
+
+    def test_abbreviations(self):
+        handler = CommandHandler()
+        handler.run_command(b'sh')
+        self.assertEqual(handler.output, ["Unknown command 'SH'"])
+        handler.output = []
+        handler.COMMAND_ABBREVIATIONS = True
+        handler.run_command(b'sh eth0')
+        handler.run_command(b'st x')
+        handler.run_command(b's')
+        handler.run_command(b'sec')
+        self.assertEqual(handler.output, ['showing eth0', 'ok x', "Ambiguous command 'S': SHOW, STAT",
+                                          "Unknown command 'SEC'"])
+
+    def test_complete(self):
+        handler = CommandHandler()
+        self.assertEqual(handler.complete(b'st'), [b'stat', b'status'])
+        self.assertEqual(handler.complete(b'ST'), [b'STAT', b'STATUS'])
+        self.assertEqual(handler.complete(b'show e'), [b'eth0', b'eth1'])
+        self.assertEqual(handler.complete(b'show '), [b'eth0', b'eth1', b'lo'])
+        self.assertEqual(handler.complete(b'show eth0 '), [])
+        self.assertEqual(handler.complete(b'sh e'), [])
+        handler.COMMAND_ABBREVIATIONS = True
+        self.assertEqual(handler.complete(b'sh e'), [b'eth0', b'eth1'])
+        self.assertEqual(handler.complete(b'ping '), [])
+
+    def test_tab(self):
+        handler = CommandHandler()
+        handler.writes = []
+        handler.write = handler.writes.append
+        editor = handler.readline_editor(prompt=b'> ', use_completion=True)
+        next(editor)
+        for key in [b's', b'h', b'\t', b'e', b'\t']:
+            editor.send(key)
+        self.assertEqual(bytes(handler._current_editor), b'show eth')
+        self.assertEqual(handler.writes[-3:], [b'ow ', b'e', b'th'])
+        editor.send(b'\t')
+        self.assertEqual(handler.writes[-1], b'\n' + b'eth0  eth1' + b'\n' + b'> show eth')
+        editor.send(curses.KEY_BACKSPACE)
+        editor.send(b'x')
+        editor.send(b'\t')
+        self.assertEqual(handler.writes[-1], b'\x07')
+
+
+class TestSessionState(unittest.TestCase):
+    def test_option_state(self):
+        options = OptionState()
+        self.assertIsNone(options.get(ECHO))
+        options[ECHO] = True
+        options[NAWS] = False
+        self.assertEqual(dict(options), {ECHO: True, NAWS: False})
+        options[ECHO] = False
+        del options[NAWS]
+        self.assertEqual(dict(options), {ECHO: False})
+        self.assertRaises(KeyError, options.__delitem__, SGA)
+
+    def test_sendcommand_once(self):
+        handler = CommandHandler()
+        self.assertTrue(handler.sendcommand(DO, SGA))
+        self.assertFalse(handler.sendcommand(DO, SGA))
+        self.assertTrue(handler.sendcommand(DONT, SGA))
+        self.assertTrue(handler.sendcommand(WILL, SGA))
+        self.assertEqual(bytes(handler.outbuf), IAC + DO + SGA + IAC + DONT + SGA + IAC + WILL + SGA)
+
+    def test_state_in_slots(self):
+        handler = CommandHandler()
+        self.assertNotIn('outbuf', handler.__dict__)
+        # Subclasses keep their own attributes as usual
+        self.assertEqual(handler.__dict__, {'keys': [], 'output': []})
+
+
+if __name__ == '__main__':
+    unittest.main()
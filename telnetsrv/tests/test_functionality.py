@@ -1,9 +1,29 @@
+import hashlib
+import time
 import unittest
 import gevent
 from gevent import server, socket
+from telnetsrv.green import command, thread_ident
 from telnetsrv.tests.telnet_handler import DummyTelnetHandler
 
 
+class NotifyTelnetHandler(DummyTelnetHandler):
+    message_threads = []
+
+    @command('notify', executor='thread')
+    def command_notify(self, params):
+        """
+        Write a message, and one to the other sessions, on a thread.
+        """
+        self.writemessage('Notice')
+        self.broadcast('All', filter=lambda handler: handler is not self)
+        self.writeresponse('done')
+
+    def _writemessage_cooked(self, data):
+        self.message_threads.append(thread_ident())
+        DummyTelnetHandler._writemessage_cooked(self, data)
+
+
 class TestTelnetServer(unittest.TestCase):
     def setUp(self):
         self.Handler = DummyTelnetHandler
@@ -15,144 +35,130 @@ class TestTelnetServer(unittest.TestCase):
         self.server.stop(timeout=5)
         gevent.joinall([self.server_greenlet])
 
-    def test_auth_banner_welcome(self):
+    def connect(self):
+        """Connect and log in, returning the socket and what was received after the username"""
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.connect(('127.0.0.1', self.server.server_port))
         _ = s.recv(2048)
-        s.send(b'test_user\r\n')
-        _ = s.recv(1024)
-        s.send(b'\r\n')
-        data = s.recv(1024)
+        return s, self.command(s, b'test_user\r\n')
+
+    def command(self, s, line):
+        """Send a line and return the output, up to the next prompt"""
+        s.sendall(line)
+        data = b''
+        while not data.endswith(b'TestServer> '):
+            chunk = s.recv(1024)
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def test_auth_banner_welcome(self):
+        s, data = self.connect()
         s.close()
         self.assertIn(b'This server is running.\r\nHello test_user!', data)
 
     def test_cmd_echo(self):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect(('127.0.0.1', self.server.server_port))
-        _ = s.recv(2048)
-        s.sendall(b'test_user\r\n')
-        _ = s.recv(1024)
-        s.sendall(b'\r\n')
-        _ = s.recv(1024)
-        s.sendall(b'echo Hi! This is a test!\r\n')
-        _ = s.recv(1024)
-        s.sendall(b'\r\n')
-        data = s.recv(1024)
+        s, _ = self.connect()
+        data = self.command(s, b'echo Hi! This is a test!\r\n')
         s.close()
-        self.assertEqual(data, b'TestServer> echo Hi! This is a test!\r\nHi! This is a test!\r\nTestServer> ')
+        self.assertEqual(data, b'echo Hi! This is a test!\r\nHi! This is a test!\r\nTestServer> ')
 
     def test_cmd_help(self):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect(('127.0.0.1', self.server.server_port))
-        _ = s.recv(2048)
-        s.sendall(b'test_user\r\n')
-        _ = s.recv(1024)
-        s.sendall(b'\r\n')
-        _ = s.recv(1024)
-        s.sendall(b'?\r\n')
-        _ = s.recv(1024)
-        s.sendall(b'\r\n')
-        data = s.recv(1024)
+        s, _ = self.connect()
+        data = self.command(s, b'?\r\n')
         s.close()
-        self.assertIn(b'TestServer> ?\r\nHelp on built in commands\r\n\r\n? [<command>] - '
+        self.assertIn(b'?\r\nHelp on built in commands\r\n\r\n? [<command>] - '
                       b'Display help\r\nBYE - Exit the command shell\r\nDEBUG - Display some debugging data\r\nECHO '
-                      b'<text to echo> - Echo text back to the console.\r\nEXIT - Exit the command shell\r\nHELP '
+                      b'<text to echo> - Echo text back to the console.\r\nEXIT - Exit the command shell\r\nHASH '
+                      b'<text> [<rounds>] - Hash text, on a thread.\r\nHELP '
                       b'[<command>] - Display help\r\nHISTORY - Display the command history\r\nINFO - '
                       b'Provides some information about the current terminal.\r\nLOGOUT - Exit the command shell'
                       b'\r\nPARAMS [<params>]* - Echos back the raw received parameters.\r\nPASSWD [<password>] - '
                       b'Pretends to set a console password.\r\nQUIT - Exit the command shell\r\nREPEAT <text to echo> '
-                      b'- Echo text back to the console.\r\nTIMEIT <time> <message> - In <time> seconds, display '
+                      b'- Echo text back to the console.\r\nSLEEP [<seconds>] - Sleep, unless interrupted.\r\nTIMEIT <time> <message> - In <time> seconds, display '
                       b'<message>.\r\nTIMER <time> <message> - In <time> seconds, display <message>.\r\nTestServer> ',
                       data)
 
     def test_hidden_cmd(self):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect(('127.0.0.1', self.server.server_port))
-        _ = s.recv(2048)
-        s.sendall(b'test_user\r\n')
-        _ = s.recv(1024)
-        s.sendall(b'\r\n')
-        _ = s.recv(1024)
-        s.sendall(b'term\r\n')
-        _ = s.recv(1024)
-        s.sendall(b'\r\n')
-        data = s.recv(1024)
+        s, _ = self.connect()
+        data = self.command(s, b'term\r\n')
         s.close()
-        self.assertEqual(b'TestServer> term\r\nansi\r\nTestServer> ', data)
+        self.assertEqual(b'term\r\nansi\r\nTestServer> ', data)
 
     def test_cmd_info(self):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect(('127.0.0.1', self.server.server_port))
-        _ = s.recv(2048)
-        s.sendall(b'test_user\r\n')
-        _ = s.recv(1024)
-        s.sendall(b'\r\n')
-        _ = s.recv(1024)
-        s.sendall(b'info\r\n')
-        _ = s.recv(1024)
-        s.sendall(b'\r\n')
-        data = s.recv(1024)
+        s, _ = self.connect()
+        data = self.command(s, b'info\r\n')
         s.close()
-        self.assertEqual(b"TestServer> info\r\nUsername: 'test_user', terminal type: 'ansi'\r\nCommand history:\r\n  "
-                         b"''\r\n  'info'\r\nTestServer> ", data)
+        self.assertEqual(b"info\r\nUsername: 'test_user', terminal type: 'ansi'\r\nCommand history:\r\n  "
+                         b"'info'\r\nTestServer> ", data)
 
     def test_cmd_params(self):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect(('127.0.0.1', self.server.server_port))
-        _ = s.recv(2048)
-        s.sendall(b'test_user\r\n')
-        _ = s.recv(1024)
-        s.sendall(b'\r\n')
-        _ = s.recv(1024)
-        s.sendall(b'params alpha beta charlie test\r\n')
-        _ = s.recv(1024)
-        s.sendall(b'\r\n')
-        data = s.recv(1024)
+        s, _ = self.connect()
+        data = self.command(s, b'params alpha beta charlie test\r\n')
         s.close()
         self.assertIn(b"params == ['alpha', 'beta', 'charlie', 'test']", data)
 
     def test_cmd_timer(self):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect(('127.0.0.1', self.server.server_port))
-        _ = s.recv(2048)
-        s.sendall(b'test_user\r\n')
-        _ = s.recv(1024)
-        s.sendall(b'\r\n')
-        _ = s.recv(1024)
-        s.sendall(b'timer 2 testing\r\n')
-        _ = s.recv(1024)
-        s.sendall(b'\r\n')
-        data = s.recv(1024)
+        s, _ = self.connect()
+        data = self.command(s, b'timer 2 testing\r\n')
         s.close()
-        self.assertIn(b'TestServer> timer 2 testing\r\nWaiting 2 seconds...\r\nTestServer> ', data)
+        self.assertIn(b'timer 2 testing\r\nWaiting 2 seconds...\r\nTestServer> ', data)
 
     def test_cmd_debug(self):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect(('127.0.0.1', self.server.server_port))
-        _ = s.recv(2048)
-        s.sendall(b'test_user\r\n')
-        _ = s.recv(1024)
-        s.sendall(b'\r\n')
-        _ = s.recv(1024)
-        s.sendall(b'debug\r\n')
-        _ = s.recv(1024)
-        s.sendall(b'\r\n')
-        data = s.recv(1024)
+        s, _ = self.connect()
+        data = self.command(s, b'debug\r\n')
+        s.close()
+        self.assertIn(b'debug\r\nBackspace  : ^H\r\nDown       : ^[[B\r\nLeft       : ^[[D\r\n'
+                      b'Right      : ^[[C\r\nUp         : ^[[A\r\nTestServer> ', data)
+
+    def test_cmd_interrupt(self):
+        s, _ = self.connect()
+        start = time.monotonic()
+        s.sendall(b'sleep\r\n')
+        data = b''
+        while not data.endswith(b'Sleeping...\r\n'):
+            data += s.recv(1024)
+        data = self.command(s, b'\x03')
+        s.close()
+        self.assertEqual(data, b'^C Interrupted\r\nTestServer> ')
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_cmd_thread(self):
+        s, _ = self.connect()
+        data = self.command(s, b'hash secret 1000\r\n')
         s.close()
-        self.assertIn(b'TestServer> debug\r\nTestServer> ', data)
+        digest = hashlib.pbkdf2_hmac('sha256', b'secret', b'telnetsrv', 1000).hex().encode()
+        self.assertEqual(data, b'hash secret 1000\r\n' + digest + b'\r\nTestServer> ')
+
+    def test_cmd_thread_message(self):
+        # The messages are written on the hub's thread, not the command's
+        notify_server = gevent.server.StreamServer(('127.0.0.1', 0), NotifyTelnetHandler.streamserver_handle)
+        notify_server.start()
+        try:
+            clients = []
+            for _ in range(2):
+                s = socket.create_connection(('127.0.0.1', notify_server.server_port))
+                s.recv(2048)
+                self.command(s, b'test_user\r\n')
+                clients.append(s)
+            clients[0].sendall(b'notify\r\n')
+            data = b''
+            while not data.endswith(b'done\r\nTestServer> '):
+                data += clients[0].recv(1024)
+            other = b''
+            while not other.endswith(b'\r\nAll\r\nTestServer> '):
+                other += clients[1].recv(1024)
+            for s in clients:
+                s.close()
+        finally:
+            notify_server.stop(timeout=5)
+        self.assertIn(b'\r\nNotice\r\n', data)
+        self.assertEqual(set(NotifyTelnetHandler.message_threads), {thread_ident()})
 
     def test_unknown_cmmd(self):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect(('127.0.0.1', self.server.server_port))
-        _ = s.recv(2048)
-        s.sendall(b'test_user\r\n')
-        _ = s.recv(1024)
-        s.sendall(b'\r\n')
-        _ = s.recv(1024)
-        s.sendall(b'unkown command\r\n')
-        _ = s.recv(1024)
-        s.sendall(b'\r\n')
-        data = s.recv(1024)
+        s, _ = self.connect()
+        data = self.command(s, b'unkown command\r\n')
         s.close()
         self.assertIn(b"Unknown command", data)
 
@@ -0,0 +1,107 @@
+import curses
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+from telnetsrv.history import History, FileHistoryStore
+from telnetsrv.tests.stubs import RecordingHandler as HistoryHandler
+
+
+def keys(text):
+    return [bytes([c]) for c in text]
+
+
+class TestHistory(unittest.TestCase):
+    def test_ring(self):
+        history = History(3)
+        for line in [b'a', b'b', b'b', b'', b'c', b'd']:
+            history.append(line)
+        self.assertEqual(list(history), [b'b', b'c', b'd'])
+        self.assertEqual(history.dropped, 1)
+        self.assertEqual(history[-1], b'd')
+        self.assertEqual(history[:2], [b'b', b'c'])
+
+    def test_search(self):
+        history = History()
+        for line in [b'show interfaces', b'show version', b'ping core', b'show ip route']:
+            history.append(line)
+        self.assertEqual(history.search(b'show'), 3)
+        self.assertEqual(history.search(b'show', 2), 1)
+        self.assertEqual(history.search(b'version', 0), None)
+        self.assertEqual(history.search(b'in', prefix=True), None)
+        self.assertEqual(history.search(b'ping', prefix=True), 2)
+
+    def test_reverse_search(self):
+        handler = HistoryHandler(keys(b'show interfaces\nping core\nshow version\n') +
+                                 [b'\x12'] + keys(b'show') + [b'\x12', b'\n'])
+        for _ in range(3):
+            handler.readline()
+        self.assertEqual(handler.readline(), b'show interfaces')
+        self.assertEqual(list(handler.history), [b'show interfaces', b'ping core', b'show version',
+                                                 b'show interfaces'])
+
+    def test_reverse_search_then_edit(self):
+        handler = HistoryHandler(keys(b'ping core\n') + [b'\x12'] + keys(b'pi') + [curses.KEY_LEFT] +
+                                 keys(b'x\n') + [b'\x12', b'c', b'\x07'] + keys(b'y\n'))
+        handler.readline()
+        # A key other than a letter takes the line and is then handled as typed
+        self.assertEqual(handler.readline(), b'ping corxe')
+        # Ctrl-G gives up the search
+        self.assertEqual(handler.readline(), b'y')
+
+
+class TestFileHistoryStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_batched_writes(self):
+        store = FileHistoryStore(self.directory, batch=3)
+        history = History(10, store, 'ops/1')
+        history.append(b'one')
+        history.append(b'two')
+        self.assertEqual(os.listdir(self.directory), [])
+        history.append(b'three')
+        # Written on the store's thread
+        store.writer.submit(int).result()
+        self.assertEqual(os.listdir(self.directory), ['ops%2F1.history'])
+        history.append(b'four')
+        history.flush()
+        self.assertEqual(list(History(10, store, 'ops/1')), [b'one', b'two', b'three', b'four'])
+        self.assertEqual(list(History(10, store, 'other')), [])
+
+    def test_unwritten_lines_loaded(self):
+        store = FileHistoryStore(self.directory)
+        History(10, store, 'ops').append(b'one')
+        self.assertEqual(list(History(10, store, 'ops')), [b'one'])
+
+    def test_cut_back(self):
+        store = FileHistoryStore(self.directory, batch=1)
+        history = History(2, store, 'ops')
+        for i in range(5):
+            history.append(b'%d' % i)
+        history = History(2, store, 'ops')
+        self.assertEqual(list(history), [b'3', b'4'])
+        # The lines cut back are still counted
+        self.assertEqual(history.dropped, 3)
+        with open(os.path.join(self.directory, 'ops.history'), 'rb') as f:
+            self.assertEqual(f.read(), b'3\n4\n')
+
+    def test_handler_store(self):
+        class StoreHandler(HistoryHandler):
+            HISTORY_STORE = FileHistoryStore(self.directory)
+            username = 'ops'
+        handler = StoreHandler(keys(b'echo 1\n'))
+        handler.readline()
+        handler.sock, client = socket.socketpair()
+        handler.finish()
+        handler.sock.close()
+        client.close()
+        self.assertEqual(list(StoreHandler().history), [b'echo 1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
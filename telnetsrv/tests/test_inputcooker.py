@@ -0,0 +1,86 @@
+import curses
+import unittest
+from telnetsrv import terminfo
+from telnetsrv.telnetsrvlib import IAC, SB, SE, WILL, TTYPE, IS
+from telnetsrv.tests.stubs import RecordingHandler
+
+
+class CookerHandler(RecordingHandler):
+    """A recording handler keeping what the input cooker produces."""
+    def __init__(self):
+        RecordingHandler.__init__(self)
+        self.cooked = []
+        self.options = []
+
+    def inputcooker_store_queue(self, char):
+        self.cooked.append(char)
+
+    def options_handler(self, sock, cmd, opt):
+        self.options.append((cmd, opt, self.read_sb_data() if cmd == SE else None))
+
+
+class TestInputCooker(unittest.TestCase):
+    def cook(self, *blocks):
+        handler = CookerHandler()
+        for block in blocks:
+            handler.inputcooker_feed(block)
+        return handler
+
+    def test_plain_run_single_store(self):
+        handler = self.cook(b'x' * 100000)
+        self.assertEqual(handler.cooked, [b'x' * 100000])
+
+    def test_line_endings(self):
+        handler = self.cook(b'a\r\nb\r\x00c\rd\n')
+        self.assertEqual(b''.join(handler.cooked), b'a\nb\nc\nd\n')
+
+    def test_line_ending_split_across_blocks(self):
+        handler = self.cook(b'a\r', b'\nb')
+        self.assertEqual(b''.join(handler.cooked), b'a\nb')
+
+    def test_iac_escaping(self):
+        handler = self.cook(b'a' + IAC + IAC + b'b')
+        self.assertEqual(b''.join(handler.cooked), b'a' + IAC + b'b')
+
+    def test_negotiation_split_across_blocks(self):
+        handler = self.cook(b'ab' + IAC, WILL, TTYPE + b'c')
+        self.assertEqual(b''.join(handler.cooked), b'abc')
+        self.assertEqual(handler.options, [(WILL, TTYPE, None)])
+
+    def test_subnegotiation(self):
+        handler = self.cook(b'a' + IAC + SB + TTYPE + IS + b'VT100\r' + IAC, SE + b'b')
+        self.assertEqual(b''.join(handler.cooked), b'ab')
+        self.assertEqual(handler.options[-1][2], TTYPE + IS + b'VT100\r')
+
+    def test_ansi_keys(self):
+        handler = self.cook(b'a\x1b[Ab\x1bOP\x1b[5~\x1b[1;5C')
+        self.assertEqual(handler.cooked, [b'a', curses.KEY_UP, b'b', curses.KEY_F1, curses.KEY_PPAGE,
+                                          curses.KEY_RIGHT])
+
+    def test_key_split_across_blocks(self):
+        handler = self.cook(b'a\x1b', b'[', b'D')
+        self.assertEqual(handler.cooked, [b'a', curses.KEY_LEFT])
+
+    def test_not_a_key_sequence(self):
+        handler = self.cook(b'\x1bx\x1b[200z')
+        self.assertEqual(handler.cooked, [b'\x1b', b'x'])
+
+    def test_terminal_key_sequences(self):
+        handler = CookerHandler()
+        handler.setterm('xterm')
+        handler.inputcooker_feed(b'\x1bOA\x1b[3~\x1b[A')
+        self.assertEqual(handler.cooked, [curses.KEY_UP, curses.KEY_DC, curses.KEY_UP])
+
+    def test_key_starting_another(self):
+        handler = CookerHandler()
+        handler.keydecoder = terminfo.KeyDecoder({b'\x1bx': 1000, b'\x1bxy': 1001})
+        handler.inputcooker_feed(b'\x1bxy\x1bxz\x1bx')
+        self.assertEqual(handler.cooked, [1001, 1000, b'z', 1000])
+        # A longer sequence still completes across blocks
+        handler.inputcooker_feed(b'\x1b')
+        handler.inputcooker_feed(b'xy')
+        self.assertEqual(handler.cooked[4:], [1001])
+
+
+if __name__ == '__main__':
+    unittest.main()
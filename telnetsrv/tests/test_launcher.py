@@ -0,0 +1,92 @@
+import os
+import signal
+import socket
+import time
+import unittest
+from unittest import mock
+from telnetsrv import green
+from telnetsrv.launcher import Launcher, serve_green
+from telnetsrv.telnetsrvlib import SessionRegistry
+from telnetsrv.tests.test_threaded import ThreadedTelnetHandler
+
+
+class LaunchedHandler(ThreadedTelnetHandler):
+    session_registry = SessionRegistry()
+
+
+class TestLauncher(unittest.TestCase):
+    def setUp(self):
+        self.launcher = Launcher(LaunchedHandler, ('127.0.0.1', 0), workers=2, grace=5,
+                                 heartbeat=0.1, health_timeout=5)
+        self.launcher.start()
+        self.wait_for(lambda: all(worker.last_report for worker in self.launcher.workers))
+
+    def tearDown(self):
+        self.launcher.stop()
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            self.launcher.poll(0.1)
+
+    def connect(self):
+        s = socket.create_connection(self.launcher.server_address, timeout=5)
+        self.command(s, None)
+        return s
+
+    def command(self, s, line):
+        if line is not None:
+            s.sendall(line + b'\r\n')
+        data = b''
+        while not data.endswith(b'TestServer> '):
+            chunk = s.recv(1024)
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def test_stats(self):
+        sessions = [self.connect() for _ in range(3)]
+        self.wait_for(lambda: self.launcher.stats()['total']['sessions'] == 3)
+        stats = self.launcher.stats()
+        self.assertEqual(stats['total']['workers'], 2)
+        self.assertEqual(sorted(worker['pid'] for worker in stats['workers']),
+                         sorted(worker.pid for worker in self.launcher.workers))
+        self.assertTrue(all(worker['healthy'] for worker in stats['workers']))
+        for s in sessions:
+            s.close()
+        self.wait_for(lambda: self.launcher.stats()['total']['sessions'] == 0)
+        self.assertEqual(self.launcher.stats()['total']['started'], 3)
+
+    def test_restart_keeps_sessions(self):
+        s = self.connect()
+        old = set(worker.pid for worker in self.launcher.workers)
+        self.assertTrue(self.launcher.restart())
+        self.assertFalse(old & set(worker.pid for worker in self.launcher.workers))
+        # The old worker no longer accepts, but finishes its session
+        self.assertIn(b'still here\r\n', self.command(s, b'echo still here'))
+        s2 = self.connect()
+        self.assertIn(b'new\r\n', self.command(s2, b'echo new'))
+        s.close()
+        s2.close()
+        self.wait_for(lambda: not self.launcher.retiring)
+
+    def test_replaces_dead_worker(self):
+        pid = self.launcher.workers[0].pid
+        os.kill(pid, signal.SIGKILL)
+        self.wait_for(lambda: pid not in [worker.pid for worker in self.launcher.workers]
+                      and all(worker.last_report for worker in self.launcher.workers))
+        self.assertEqual(len(self.launcher.workers), 2)
+
+
+class TestGreenLauncher(unittest.TestCase):
+    def test_needs_patching(self):
+        self.assertIs(Launcher(green.TelnetHandler, ('127.0.0.1', 0)).serve, serve_green)
+        with mock.patch('gevent.monkey.is_module_patched', return_value=False):
+            with self.assertRaises(RuntimeError):
+                Launcher(green.TelnetHandler, ('127.0.0.1', 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
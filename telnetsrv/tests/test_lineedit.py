@@ -0,0 +1,109 @@
+import curses
+import unittest
+from telnetsrv.lineedit import LineEditor
+from telnetsrv.telnetsrvlib import TelnetHandlerBase
+from telnetsrv.tests.stubs import RecordingHandler
+
+# The codes of an ansi terminal
+CODES = {
+    'DEOL': b'\x1b[K',
+    'DEL': b'\x1b[P',
+    'INS': b'',
+    'CSRLEFT': b'\x08',
+    'CSRRIGHT': b'\x1b[C',
+    'CSRLEFTN': b'\x1b[%p1%dD',
+    'CSRRIGHTN': b'\x1b[%p1%dC',
+    'INSN': b'\x1b[%p1%d@',
+    'DELN': b'\x1b[%p1%dP',
+}
+
+
+class EchoHandler(RecordingHandler):
+    """A recording handler keeping each write as it is."""
+    CODES = CODES
+
+    def __init__(self, keys=()):
+        RecordingHandler.__init__(self, keys)
+        self.writes = []
+
+    def write(self, text):
+        self.writes.append(text)
+
+
+class TestLineEditor(unittest.TestCase):
+    def test_moves(self):
+        line = LineEditor(CODES, b'show interfaces')
+        self.assertEqual(line.move(14), b'\x08')
+        self.assertEqual(line.move(0), b'\x1b[14D')
+        # Moving right writes out the characters passed over, while shorter
+        self.assertEqual(line.move(4), b'show')
+        self.assertEqual(line.move(15), b'\x1b[11C')
+        self.assertEqual(line.pos, 15)
+
+    def test_insert(self):
+        line = LineEditor(CODES, b'show')
+        self.assertEqual(line.insert(b' ip'), b' ip')
+        line.move(1)
+        self.assertEqual(line.insert(b'x'), b'\x1b[1@x')
+        line.move(len(line) - 1)
+        self.assertEqual(line.insert(b'y'), b'yp\x08')
+        self.assertEqual(bytes(line), b'sxhow iyp')
+
+    def test_delete(self):
+        line = LineEditor(CODES, b'show ip route')
+        self.assertEqual(line.backspace(), b'\x08 \x08')
+        line.move(3)
+        self.assertEqual(line.backspace(), b'\x08\x1b[P')
+        line.move(0)
+        self.assertEqual(line.delete(5), b'\x1b[5P')
+        self.assertEqual(bytes(line), b'p rout')
+        line.move(len(line))
+        self.assertIsNone(line.delete())
+        self.assertIsNone(LineEditor(CODES).backspace())
+
+    def test_without_codes(self):
+        line = LineEditor({'CSRLEFT': b'\x08'}, b'abcd')
+        line.move(1)
+        self.assertEqual(line.delete(), b'cd \x08\x08\x08')
+        self.assertEqual(line.replace(b'a'), b'  \x08\x08')
+
+    def test_replace(self):
+        line = LineEditor(CODES, b'show interfaces')
+        self.assertEqual(line.replace(b'show ip route'), b'\x1b[9Dp route\x1b[K')
+        self.assertEqual(line.replace(b'show ip route detail'), b' detail')
+        self.assertEqual(line.pos, 20)
+
+    def test_redraw(self):
+        line = LineEditor(CODES, b'ping core')
+        line.move(4)
+        self.assertEqual(line.redraw(), b'ping core\x1b[5D')
+
+
+class TestEcho(unittest.TestCase):
+    def test_one_write_per_key(self):
+        handler = EchoHandler([b'a', b'b', curses.KEY_LEFT, b'x', curses.KEY_HOME, b'\x7f', b'\n'])
+        self.assertEqual(handler.readline(prompt=b'> '), b'axb')
+        self.assertEqual(handler.writes, [b'> ', b'a', b'b', b'\x08', b'xb\x08', b'\x08\x08', b'\x07', b'\n'])
+
+    def test_history_recall(self):
+        handler = EchoHandler([b'a', b'b', b'c', b'\n', b'a', b'x', curses.KEY_UP, curses.KEY_DOWN, b'\n'])
+        handler.readline()
+        handler.writes = []
+        self.assertEqual(handler.readline(), b'ax')
+        self.assertEqual(handler.writes, [b'', b'a', b'x', b'\x08bc', b'\x08\x08x \x08', b'\n'])
+
+    def test_message_restores_cursor(self):
+        handler = EchoHandler()
+        editor = handler.readline_editor(prompt=b'> ')
+        next(editor)
+        for key in [b'a', b'b', b'c', curses.KEY_LEFT]:
+            editor.send(key)
+        handler.writes = []
+        handler.writemessage_cooked = TelnetHandlerBase.writemessage_cooked.__get__(handler)
+        handler.sendcooked = handler.writes.append
+        handler.writemessage_cooked(b'\r\nhello\r\n')
+        self.assertEqual(handler.writes, [b'\r\nhello\r\n', b'> abc\x08'])
+
+
+if __name__ == '__main__':
+    unittest.main()
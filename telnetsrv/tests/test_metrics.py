@@ -0,0 +1,80 @@
+import socket
+import time
+import unittest
+from telnetsrv.metrics import Metrics, StatsdSink
+from telnetsrv.telnetsrvlib import command
+from telnetsrv.tests.stubs import RecordingHandler
+
+
+class SlowTypistHandler(RecordingHandler):
+    """A recording handler whose client takes its time over each key."""
+    def getc(self, block=True):
+        if not block:
+            return b''
+        time.sleep(0.1)
+        return RecordingHandler.getc(self)
+
+    @command('ask')
+    def command_ask(self, params):
+        self.readline(prompt='Value: ')
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def test_snapshot(self):
+        self.metrics.command('HELP', 0.002)
+        self.metrics.command('HELP', 0.2, error=True)
+        self.metrics.auth(20, True)
+        snapshot = self.metrics.snapshot()
+        labels = (('command', 'HELP'), )
+        self.assertEqual(snapshot['telnet_commands_total'], {labels: 2})
+        self.assertEqual(snapshot['telnet_command_errors_total'], {labels: 1})
+        seconds = snapshot['telnet_command_seconds'][labels]
+        self.assertEqual(seconds['count'], 2)
+        self.assertAlmostEqual(seconds['sum'], 0.202)
+        self.assertEqual((seconds['buckets'][0.0025], seconds['buckets'][0.25]), (1, 1))
+        self.assertEqual(snapshot['telnet_auth_seconds'][(('result', 'ok'), )]['buckets'][float('inf')], 1)
+
+    def test_prometheus(self):
+        self.metrics.command('SAY "HI"', 0.003)
+        self.metrics.session(10, 2000)
+        text = self.metrics.prometheus()
+        self.assertIn('# TYPE telnet_commands_total counter\ntelnet_commands_total{command="SAY \\"HI\\""} 1\n', text)
+        self.assertIn('telnet_command_seconds_bucket{command="SAY \\"HI\\"",le="0.0025"} 0\n', text)
+        self.assertIn('telnet_command_seconds_bucket{command="SAY \\"HI\\"",le="0.005"} 1\n', text)
+        self.assertIn('telnet_command_seconds_bucket{command="SAY \\"HI\\"",le="+Inf"} 1\n', text)
+        self.assertIn('telnet_sessions_total 1\n', text)
+        self.assertIn('telnet_session_sent_bytes_sum 2000\ntelnet_session_sent_bytes_count 1\n', text)
+
+    def test_input_wait_not_counted(self):
+        handler = SlowTypistHandler([b'y', b'\n'])
+        handler.METRICS = self.metrics
+        handler.run_command(b'ask')
+        seconds = self.metrics.snapshot()['telnet_command_seconds'][(('command', 'ASK'), )]
+        self.assertEqual(seconds['count'], 1)
+        self.assertLess(seconds['sum'], 0.1)
+
+    def test_statsd(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        sink = StatsdSink(port=server.getsockname()[1])
+        try:
+            metrics = Metrics([sink])
+            metrics.command('HELP', 0.0125)
+            metrics.session(10, 2000)
+            packets = [server.recv(512) for _ in range(5)]
+        finally:
+            sink.close()
+            server.close()
+        self.assertEqual(packets, [b'telnetsrv.telnet_commands_total.HELP:1|c',
+                                   b'telnetsrv.telnet_command_seconds.HELP:12.500|ms',
+                                   b'telnetsrv.telnet_sessions_total:1|c',
+                                   b'telnetsrv.telnet_session_received_bytes:10|h',
+                                   b'telnetsrv.telnet_session_sent_bytes:2000|h'])
+
+
+if __name__ == '__main__':
+    unittest.main()
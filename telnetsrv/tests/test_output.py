@@ -0,0 +1,97 @@
+import io
+import unittest
+import gevent
+from gevent import socket
+from telnetsrv.green import TelnetHandler
+from telnetsrv.telnetsrvlib import cook_output, cook_output_stream, IAC, AO
+
+
+class QueueHandler(TelnetHandler):
+    """A green handler sending to a socket, with no session running."""
+    OUTPUT_QUEUE_HIGH = 4096
+    OUTPUT_QUEUE_LOW = 1024
+
+    def __init__(self, sock, policy):
+        self.OUTPUT_POLICY = policy
+        self.client_address = ('test', 0)
+        self.init_session()
+        self.sock = sock
+        self.greenlet_oc = gevent.spawn(self.outputsender)
+
+
+class TestOutputQueue(unittest.TestCase):
+    def setUp(self):
+        self.server_sock, self.client_sock = socket.socketpair()
+        # Keep the kernel buffers small, so the client stalls quickly
+        self.server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        self.client_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+
+    def tearDown(self):
+        self.server_sock.close()
+        self.client_sock.close()
+
+    def flood(self, handler, chunks=200):
+        for _ in range(chunks):
+            handler.sendcooked(b'x' * 1000)
+            gevent.sleep(0)
+
+    def test_block(self):
+        handler = QueueHandler(self.server_sock, 'block')
+        writer = gevent.spawn(self.flood, handler)
+        gevent.sleep(0.1)
+        self.assertFalse(writer.dead)
+        self.assertLessEqual(handler.output_queued(), handler.OUTPUT_QUEUE_HIGH + 1000)
+        received = 0
+        while received < 200000:
+            received += len(self.client_sock.recv(65536))
+        writer.join()
+        stats = handler.output_stats()
+        self.assertEqual(stats['sent'], 200000)
+        self.assertEqual(stats['dropped'], 0)
+        self.assertGreater(stats['blocked'], 0)
+
+    def test_drop(self):
+        handler = QueueHandler(self.server_sock, 'drop')
+        self.flood(handler)
+        stats = handler.output_stats()
+        self.assertGreater(stats['dropped'], 0)
+        self.assertLessEqual(stats['peak'], handler.OUTPUT_QUEUE_HIGH + 1000)
+        self.assertEqual(stats['queued'] + stats['sent'] + stats['dropped'], 200000)
+
+    def test_disconnect(self):
+        handler = QueueHandler(self.server_sock, 'disconnect')
+        self.flood(handler)
+        self.assertFalse(handler.RUNSHELL)
+        self.assertTrue(handler.eof)
+
+    def test_abort_output(self):
+        # The telnet AO command throws away the output not yet sent
+        handler = QueueHandler(self.server_sock, 'block')
+        writer = gevent.spawn(self.flood, handler)
+        gevent.sleep(0.1)
+        handler.writecooked(b'y' * 100)
+        handler.inputcooker_feed(IAC + AO)
+        stats = handler.output_stats()
+        self.assertEqual(handler.outbuf, b'')
+        self.assertLessEqual(stats['queued'], 1000)
+        self.assertGreater(stats['dropped'], 0)
+        writer.kill()
+
+
+class TestCookOutput(unittest.TestCase):
+    def test_cook(self):
+        self.assertEqual(cook_output('a\xffb\nc'), b'a\xff\xffb\r\nc')
+
+    def test_plain_text_not_copied(self):
+        text = b'x' * 100000
+        self.assertIs(cook_output(text), text)
+
+    def test_stream(self):
+        text = b'line \xff\n' * 10000
+        self.assertEqual(b''.join(cook_output_stream(io.BytesIO(text), 1000)), cook_output(text))
+        self.assertEqual(b''.join(cook_output_stream(iter(text.splitlines(True)))), cook_output(text))
+        self.assertEqual(b''.join(cook_output_stream(io.StringIO('a\nb'))), b'a\r\nb')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+from telnetsrv.telnetsrvlib import IAC, SB, SE, NAWS
+from telnetsrv.tests.stubs import RecordingHandler
+
+
+class PagerHandler(RecordingHandler):
+    """A recording handler with rows to page."""
+    fetched = 0
+
+    def rows(self, count):
+        for i in range(count):
+            self.fetched += 1
+            yield 'row %d' % i
+
+
+class TestPager(unittest.TestCase):
+    def test_naws(self):
+        handler = PagerHandler()
+        handler.inputcooker_feed(IAC + SB + NAWS + b'\x00' + IAC + IAC + b'\x00\x05' + IAC + SE)
+        self.assertEqual((handler.WIDTH, handler.HEIGHT), (255, 5))
+        self.assertEqual(handler.page_rows(), 4)
+
+    def test_no_paging_without_window_size(self):
+        handler = PagerHandler()
+        handler.writepaged(handler.rows(100))
+        handler.flush()
+        self.assertEqual(handler.output.count(b'\r\n'), 100)
+        self.assertNotIn(handler.MORE_PROMPT, handler.output)
+
+    def test_pages(self):
+        handler = PagerHandler([b' ', b'\r'])
+        handler.setwindowsize(80, 4)
+        handler.writepaged(handler.rows(7))
+        handler.flush()
+        # Three rows, a key for the next three, then Enter for the last one
+        self.assertEqual(handler.output.count(handler.MORE_PROMPT), 2)
+        self.assertTrue(handler.output.endswith(b'\rrow 6\r\n'))
+        self.assertEqual(handler.keys, [])
+
+    def test_quit_stops_fetching(self):
+        handler = PagerHandler([b'q'])
+        handler.setwindowsize(80, 11)
+        rows = handler.rows(100000)
+        handler.writepaged(rows)
+        self.assertEqual(handler.fetched, 11)
+        self.assertIsNone(rows.gi_frame)
+
+    def test_long_lines_wrap(self):
+        handler = PagerHandler([b'q'])
+        handler.setwindowsize(10, 4)
+        handler.writepaged(['x' * 25, 'y'])
+        handler.flush()
+        self.assertNotIn(b'y', handler.output)
+
+
+if __name__ == '__main__':
+    unittest.main()
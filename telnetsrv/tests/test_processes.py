@@ -0,0 +1,70 @@
+import itertools
+import time
+import types
+import unittest
+from telnetsrv.processes import ProcessPool, ProcessSession
+
+
+def report(session, params):
+    session.writeline('Report for %s' % session.username)
+    return ['line %s' % p for p in params]
+
+
+def endless(session, params):
+    for i in itertools.count():
+        yield 'line %d' % i
+
+
+def fail(session, params):
+    raise ValueError(params[0])
+
+
+class TestProcessPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = ProcessPool(1, 0)
+        self.session = ProcessSession(types.SimpleNamespace(username='alice', TERM='ansi', WIDTH=80, HEIGHT=24), 2)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def take(self, task):
+        message = task.take()
+        while message is None:
+            task.waiter().result(5)
+            message = task.take()
+        return message
+
+    def test_output(self):
+        task = self.pool.submit(report, self.session, ['a', 'b'])
+        self.assertEqual(self.take(task), ('output', [('writeline', 'Report for alice'), (None, 'line a')]))
+        self.assertEqual(self.take(task), ('output', [(None, 'line b')]))
+        self.assertEqual(self.take(task), ('end', None))
+        stats = self.pool.stats()
+        self.assertEqual((stats['submitted'], stats['completed'], stats['running']), (1, 1, 0))
+
+    def test_error(self):
+        task = self.pool.submit(fail, self.session, ['bad'])
+        kind, error = self.take(task)
+        self.assertEqual(kind, 'end')
+        self.assertIsInstance(error, ValueError)
+        self.assertEqual(self.pool.stats()['failed'], 1)
+
+    def test_full(self):
+        task = self.pool.submit(endless, self.session, [])
+        self.assertEqual(self.take(task)[0], 'output')
+        self.assertEqual(self.pool.stats()['running'], 1)
+        self.assertIsNone(self.pool.submit(report, self.session, []))
+        self.assertEqual(self.pool.stats()['refused'], 1)
+        # Stopped as it next writes, which frees its place
+        task.close()
+        for _ in range(50):
+            task = self.pool.submit(report, self.session, [])
+            if task is not None:
+                break
+            time.sleep(0.1)
+        self.assertEqual(self.take(task)[0], 'output')
+        self.assertEqual(self.pool.stats()['stopped'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+import asyncio
+import os
+import pstats
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from telnetsrv import profiling
+from telnetsrv.telnetsrvlib import command
+from telnetsrv.tests.stubs import RecordingHandler
+
+
+def spin(seconds):
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        pass
+
+
+class ProfiledHandler(RecordingHandler):
+    """A recording handler keeping the lines written as they are."""
+    PROFILE_USERS = ['admin']
+
+    def __init__(self, username='admin'):
+        RecordingHandler.__init__(self)
+        self.username = username
+        self.client_address = ('127.0.0.1', 4000)
+        self.output = []
+
+    def writeline(self, text):
+        self.output.append(text)
+
+    @command('spin')
+    def command_spin(self, params):
+        spin(0.05)
+
+
+class TestProfile(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        ProfiledHandler.PROFILE_DIR = self.directory
+
+    def tearDown(self):
+        profiling.stop()
+        shutil.rmtree(self.directory)
+
+    def wait_saved(self, profile):
+        for _ in range(100):
+            if profile.saved:
+                return
+            time.sleep(0.05)
+        self.fail("Profile not written")
+
+    def test_command(self):
+        handler = ProfiledHandler()
+        profile = profiling.start(10, kind='cprofile', command='SPIN', directory=self.directory)
+        self.assertTrue(profile.covers(handler, 'SPIN'))
+        self.assertFalse(profile.covers(handler))
+        handler.run_command(b'spin')
+        # Not a section of the command
+        handler.inputcooker_feed(b'x')
+        profiling.stop()
+        self.wait_saved(profile)
+        functions = set(name for filename, line, name in pstats.Stats(profile.path).stats)
+        self.assertIn('command_spin', functions)
+        self.assertNotIn('_inputcooker_feed', functions)
+        self.assertTrue(os.path.basename(profile.path).startswith('telnetsrv-command-spin-'))
+
+    def test_session(self):
+        handler, other = ProfiledHandler(), ProfiledHandler()
+        profile = profiling.start(10, session=handler, directory=self.directory)
+        handler.inputcooker_feed(b'x')
+        other.run_command(b'spin')
+        profiling.stop()
+        self.wait_saved(profile)
+        functions = set(name for filename, line, name in pstats.Stats(profile.path).stats)
+        self.assertIn('_inputcooker_feed', functions)
+        self.assertNotIn('command_spin', functions)
+
+    def test_sampling_server(self):
+        profile = profiling.start(0.2, kind='sampling', directory=self.directory)
+        spin(0.3)
+        self.wait_saved(profile)
+        self.assertIsNone(profiling.active)
+        with open(profile.path) as f:
+            stacks = f.read()
+        self.assertTrue(profile.path.endswith('.collapsed'))
+        self.assertIn('spin (test_profiling.py:', stacks)
+
+    def test_awaitable(self):
+        profile = profiling.start(10, directory=self.directory)
+
+        async def task():
+            spin(0.01)
+            await asyncio.sleep(0.01)
+            spin(0.01)
+            return 'done'
+
+        async def main():
+            return await profile.wrap(task())
+
+        self.assertEqual(asyncio.run(main()), 'done')
+        profiling.stop()
+        self.wait_saved(profile)
+        stats = pstats.Stats(profile.path)
+        calls = dict((name, stat[0]) for (filename, line, name), stat in stats.stats.items())
+        self.assertEqual(calls['spin'], 2)
+
+    def test_written_with_section_open(self):
+        # A section left open, as by a command in the pager, does not hold the profile back
+        profile = profiling.start(10, directory=self.directory)
+        self.assertTrue(profile.enter())
+        spin(0.01)
+        profiling.stop()
+        self.assertTrue(profile.saved)
+        profile.exit()
+        self.assertIsNone(sys.getprofile())
+        functions = set(name for filename, line, name in pstats.Stats(profile.path).stats)
+        self.assertIn('spin', functions)
+
+    def test_one_at_a_time(self):
+        profiling.start(10, directory=self.directory)
+        self.assertRaises(RuntimeError, profiling.start, 10, directory=self.directory)
+
+
+class TestProfileCommand(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        ProfiledHandler.PROFILE_DIR = self.directory
+
+    def tearDown(self):
+        profiling.stop()
+        shutil.rmtree(self.directory)
+
+    def test_not_allowed(self):
+        handler = ProfiledHandler('guest')
+        handler.cmdPROFILE(['server'])
+        self.assertEqual(handler.output, ['Not allowed to profile'])
+        self.assertIsNone(profiling.active)
+
+    def test_session(self):
+        handler = ProfiledHandler()
+        registry = ProfiledHandler.session_registry
+        registry.add(handler)
+        try:
+            handler.cmdPROFILE(['session', '127.0.0.1:4000', '5', 'sampling'])
+        finally:
+            registry.discard(handler)
+        self.assertIs(profiling.active.session, handler)
+        self.assertEqual(profiling.active.kind, 'sampling')
+        self.assertTrue(handler.output[0].startswith('Profiling for 5 seconds to %s' % self.directory))
+        handler.cmdPROFILE(['stop'])
+        self.assertIsNone(profiling.active)
+
+    def test_usage(self):
+        handler = ProfiledHandler()
+        handler.cmdPROFILE(['session', 'nobody'])
+        handler.cmdPROFILE(['everything'])
+        handler.cmdPROFILE(['server', 'soon'])
+        self.assertEqual(handler.output[0], "No sessions of 'nobody'")
+        self.assertTrue(handler.output[1].startswith('Usage: PROFILE server|session'))
+        self.assertEqual(handler.output[2], 'Not a number of seconds: soon')
+
+    def test_hidden(self):
+        self.assertIn('PROFILE', ProfiledHandler.command_registry.commands)
+        self.assertNotIn('PROFILE', ProfiledHandler.command_registry.names)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import curses
+import unittest
+from telnetsrv import terminfo
+from telnetsrv.telnetsrvlib import TelnetHandlerBase
+
+
+class TestTermInfo(unittest.TestCase):
+    def test_shared_record(self):
+        caps = terminfo.lookup('ansi', TelnetHandlerBase.KEYS, TelnetHandlerBase.CODES)
+        self.assertIs(caps, terminfo.lookup(b'ANSI', TelnetHandlerBase.KEYS, TelnetHandlerBase.CODES))
+        self.assertEqual(caps.escseq[b'\x1b[A'], curses.KEY_UP)
+        self.assertEqual(caps.codes['DEOL'], b'\x1b[K')
+        with self.assertRaises(TypeError):
+            caps.codes['DEOL'] = b''
+
+    def test_terminal_types_differ(self):
+        ansi = terminfo.lookup('ansi', TelnetHandlerBase.KEYS, TelnetHandlerBase.CODES)
+        xterm = terminfo.lookup('xterm', TelnetHandlerBase.KEYS, TelnetHandlerBase.CODES)
+        self.assertEqual(xterm.escseq[b'\x1bOA'], curses.KEY_UP)
+        self.assertNotEqual(ansi.escseq, xterm.escseq)
+
+    def test_missing_code_keeps_default(self):
+        caps = terminfo.lookup('ansi', TelnetHandlerBase.KEYS, TelnetHandlerBase.CODES)
+        self.assertEqual(caps.codes['INS'], b'')
+
+    def test_counted_codes(self):
+        caps = terminfo.lookup('ansi', TelnetHandlerBase.KEYS, TelnetHandlerBase.CODES)
+        self.assertEqual(caps.codes['CSRLEFTN'], b'\x1b[%p1%dD')
+        # Padding is left out
+        vt100 = terminfo.lookup('vt100', TelnetHandlerBase.KEYS, TelnetHandlerBase.CODES)
+        self.assertEqual(vt100.codes['DEOL'], b'\x1b[K')
+
+    def test_unknown_terminal(self):
+        for _ in range(2):
+            with self.assertRaises(curses.error):
+                terminfo.lookup('no-such-terminal', TelnetHandlerBase.KEYS, TelnetHandlerBase.CODES)
+
+    def test_bad_terminal_name(self):
+        for term in (b'', b'../../etc/passwd', b'x' * 1000, b'-xterm'):
+            with self.assertRaises(curses.error):
+                terminfo.lookup(term, TelnetHandlerBase.KEYS, TelnetHandlerBase.CODES)
+        self.assertNotIn('-xterm', terminfo._unknown)
+
+    def test_unknown_terminals_bounded(self):
+        for n in range(terminfo.UNKNOWN_MAX + 1):
+            terminfo._unknown['unknown-%d' % n] = curses.error('not known')
+        with self.assertRaises(curses.error):
+            terminfo.lookup('no-such-terminal-2', TelnetHandlerBase.KEYS, TelnetHandlerBase.CODES)
+        self.assertEqual(len(terminfo._unknown), terminfo.UNKNOWN_MAX)
+        self.assertNotIn('unknown-0', terminfo._unknown)
+        self.assertIn('no-such-terminal-2', terminfo._unknown)
+
+    def test_lookup_without_query(self):
+        self.assertIsNone(terminfo.lookup('vt220', TelnetHandlerBase.KEYS, {}, query=False))
+        caps = terminfo.lookup('vt220', TelnetHandlerBase.KEYS, {})
+        self.assertIs(caps, terminfo.lookup('vt220', TelnetHandlerBase.KEYS, {}, query=False))
+
+    def test_key_starting_another(self):
+        escseqs = [(b'\x1bx', 1000), (b'\x1bxy', 1001)]
+        for order in (escseqs, escseqs[::-1]):
+            decoder = terminfo.KeyDecoder(dict(order))
+            self.assertIs(decoder.match(b'\x1bx'), decoder.INCOMPLETE)
+            self.assertEqual(decoder.match(b'\x1bxy'), (1001, 3))
+            self.assertEqual(decoder.match(b'\x1bxz'), (1000, 2))
+            self.assertEqual(decoder.resolve(b'\x1bx'), (1000, 2))
+            self.assertIs(decoder.resolve(b'\x1b'), decoder.INCOMPLETE)
+
+
+if __name__ == '__main__':
+    unittest.main()
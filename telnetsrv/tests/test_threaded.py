@@ -0,0 +1,217 @@
+import socket
+import threading
+import time
+import unittest
+from telnetsrv.threaded import TelnetHandler, TelnetServer, command
+from telnetsrv.telnetsrvlib import IAC, IP, SessionRegistry
+
+
+class ThreadedTelnetHandler(TelnetHandler):
+    WELCOME = b'You have connected to the test server.'
+    PROMPT = b"TestServer> "
+    NEGOTIATION_TIMEOUT = 0.1
+    release = threading.Event()
+    session_registry = SessionRegistry()
+
+    @command('echo')
+    def command_echo(self, params):
+        """<text to echo>
+        Echo text back to the console.
+        """
+        self.writeresponse(' '.join(params))
+
+    @command('ask')
+    def command_ask(self, params):
+        """
+        Ask for a value and echo it back.
+        """
+        answer = self.readline(prompt=b"Value: ", use_history=False)
+        self.writeresponse(b"Got " + answer)
+
+    @command('wait')
+    def command_wait(self, params):
+        """
+        Hold a worker thread until released.
+        """
+        self.release.wait(5)
+        self.writeresponse("Released")
+
+    @command('shout')
+    def command_shout(self, params):
+        """<text>
+        Broadcast text to the other sessions.
+        """
+        self.writeresponse("Sent to %d" % self.broadcast(' '.join(params), filter=lambda h: h is not self))
+
+    @command('count', executor='thread')
+    def command_count(self, params):
+        """<count>
+        Count, on the command executor.
+        """
+        for i in range(int(params[0])):
+            yield 'count %d' % i
+
+    @command('report', executor='process')
+    def command_report(self, params):
+        """<count>
+        Report on items, in a child process.
+        """
+        self.writeresponse('Report')
+        for i in range(int(params[0])):
+            yield 'item %d' % i
+
+    @command('lookup', executor='thread')
+    def command_lookup(self, params):
+        """
+        Look up on the command executor until released.
+        """
+        self.writeresponse("Looking up")
+        self.flush()
+        self.release.wait(5)
+        self.writeresponse("Found")
+
+
+class TestThreadedTelnetServer(unittest.TestCase):
+    def setUp(self):
+        ThreadedTelnetHandler.release.clear()
+        self.server = TelnetServer(('127.0.0.1', 0), ThreadedTelnetHandler, max_workers=1, queue_depth=1)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        ThreadedTelnetHandler.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def connect(self):
+        s = socket.create_connection(self.server.server_address, timeout=5)
+        self.read_prompt(s)
+        return s
+
+    def read_prompt(self, s, prompt=b'TestServer> '):
+        data = b''
+        while not data.endswith(prompt):
+            chunk = s.recv(1024)
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def test_cmd_echo(self):
+        s = self.connect()
+        s.sendall(b'echo Hi! This is a test!\r\n')
+        self.assertEqual(self.read_prompt(s), b'echo Hi! This is a test!\r\nHi! This is a test!\r\nTestServer> ')
+        s.close()
+
+    def test_cmd_readline(self):
+        s = self.connect()
+        s.sendall(b'ask\r\n42\r\n')
+        self.assertIn(b'Value: 42\r\nGot 42\r\nTestServer> ', self.read_prompt(s))
+        s.close()
+
+    def test_typed_ahead(self):
+        s = self.connect()
+        s.sendall(b'echo 1\r\necho 2\r\n')
+        data = self.read_prompt(s)
+        data += self.read_prompt(s) if data.count(b'TestServer> ') < 2 else b''
+        self.assertEqual(data, b'echo 1\r\n1\r\nTestServer> echo 2\r\n2\r\nTestServer> ')
+        s.close()
+
+    def test_busy(self):
+        # One worker runs a command, one command waits, the next is turned away
+        sessions = [self.connect() for _ in range(3)]
+        for s in sessions[:2]:
+            s.sendall(b'wait\r\n')
+            self.assertEqual(s.recv(1024), b'wait\r\n')
+        sessions[2].sendall(b'wait\r\n')
+        self.assertEqual(self.read_prompt(sessions[2]), b'wait\r\nServer busy, try again later.\r\nTestServer> ')
+        ThreadedTelnetHandler.release.set()
+        for s in sessions[:2]:
+            self.assertIn(b'Released\r\nTestServer> ', self.read_prompt(s))
+            s.close()
+        sessions[2].close()
+
+    def interrupt(self, line, started, interrupt):
+        s = self.connect()
+        s.sendall(line)
+        self.read_prompt(s, started)
+        start = time.monotonic()
+        s.sendall(interrupt)
+        data = self.read_prompt(s)
+        self.assertLess(time.monotonic() - start, 2)
+        s.close()
+        return data
+
+    def test_interrupt_input(self):
+        self.assertEqual(self.interrupt(b'ask\r\n', b'Value: ', IAC + IP), b'^C Interrupted\r\nTestServer> ')
+
+    def test_interrupt_thread_command(self):
+        self.assertEqual(self.interrupt(b'lookup\r\n', b'Looking up\r\n', b'\x03'),
+                         b'^C Interrupted\r\nTestServer> ')
+
+    def test_thread_command(self):
+        ThreadedTelnetHandler.release.set()
+        s = self.connect()
+        s.sendall(b'lookup\r\n')
+        self.assertEqual(self.read_prompt(s), b'lookup\r\nLooking up\r\nFound\r\nTestServer> ')
+        s.close()
+
+    def test_thread_command_lines(self):
+        s = self.connect()
+        s.sendall(b'count 200\r\n')
+        data = self.read_prompt(s)
+        self.assertTrue(data.startswith(b'count 200\r\ncount 0\r\ncount 1\r\n'))
+        self.assertTrue(data.endswith(b'count 199\r\nTestServer> '))
+        s.close()
+
+    def test_process_command(self):
+        s = self.connect()
+        s.sendall(b'report 2\r\n')
+        self.assertEqual(self.read_prompt(s), b'report 2\r\nReport\r\nitem 0\r\nitem 1\r\nTestServer> ')
+        s.close()
+
+    def test_broadcast(self):
+        stalled, s = self.connect(), self.connect()
+        # The first session's client is not taking its output
+        handler = min(ThreadedTelnetHandler.session_registry, key=lambda h: h.session_started)
+        with handler.lock:
+            handler.outq_bytes = handler.OUTPUT_QUEUE_HIGH
+        start = time.monotonic()
+        s.sendall(b'shout Going down\r\n')
+        self.assertEqual(self.read_prompt(s), b'shout Going down\r\nSent to 1\r\nTestServer> ')
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(self.read_prompt(stalled), b'\r\nGoing down\r\nTestServer> ')
+        with handler.lock:
+            handler.outq_bytes = 0
+        stalled.close()
+        s.close()
+
+    def test_exit(self):
+        s = self.connect()
+        s.sendall(b'exit\r\n')
+        data = b''
+        while True:
+            chunk = s.recv(1024)
+            if not chunk:
+                break
+            data += chunk
+        self.assertEqual(data, b'exit\r\nGoodbye\r\n')
+        s.close()
+
+
+class TestThreadedOutput(unittest.TestCase):
+    def test_client_gone(self):
+        # Output left once the client is gone is counted as dropped, not sent
+        ours, theirs = socket.socketpair()
+        theirs.close()
+        handler = ThreadedTelnetHandler(ours, ('127.0.0.1', 0), None)
+        handler.sock = ours
+        handler.sendcooked(b'output')
+        ours.close()
+        self.assertEqual((handler.eof, handler.outq_bytes, handler.outq_sent, handler.outq_dropped),
+                         (1, 0, 0, 6))
+
+
+if __name__ == '__main__':
+    unittest.main()
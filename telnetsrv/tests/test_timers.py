@@ -0,0 +1,154 @@
+import socket
+import threading
+import time
+import unittest
+from unittest import mock
+import gevent
+from gevent import socket as gsocket
+from telnetsrv.telnetsrvlib import IAC, NOP
+from telnetsrv.threaded import TelnetServer
+from telnetsrv.timers import TimerWheel
+from telnetsrv.tests.test_threaded import ThreadedTelnetHandler
+from telnetsrv.tests.test_output import QueueHandler
+
+
+class TestTimerWheel(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.ticks = []
+        with mock.patch('time.monotonic', return_value=self.now):
+            self.wheel = TimerWheel(lambda delay, callback: self.ticks.append(callback), slots=8)
+
+    def advance(self, seconds):
+        """Move the clock on, running the ticks the wheel asked for"""
+        self.now += seconds
+        with mock.patch('time.monotonic', return_value=self.now):
+            while self.ticks and self.wheel.time + self.wheel.resolution <= self.now:
+                self.ticks.pop(0)()
+
+    def schedule(self, delay, calls, name):
+        with mock.patch('time.monotonic', return_value=self.now):
+            self.wheel.schedule(self.now + delay, lambda now: calls.append((name, now)))
+
+    def test_runs_when_due(self):
+        calls = []
+        self.schedule(2.5, calls, 'a')
+        self.schedule(1, calls, 'b')
+        self.advance(1)
+        self.assertEqual(calls, [('b', 1001.0)])
+        self.advance(1)
+        self.assertEqual(len(calls), 1)
+        self.advance(1)
+        self.assertEqual(calls[1], ('a', 1003.0))
+        self.assertEqual(len(self.wheel), 0)
+        # An empty wheel stops ticking
+        self.assertFalse(self.wheel.ticking)
+        self.assertEqual(self.ticks, [])
+
+    def test_beyond_one_turn(self):
+        calls = []
+        self.schedule(20, calls, 'a')
+        for _ in range(19):
+            self.advance(1)
+        self.assertEqual(calls, [])
+        self.advance(1)
+        self.assertEqual(calls, [('a', 1020.0)])
+
+
+class TimeoutHandler(ThreadedTelnetHandler):
+    IDLE_TIMEOUT = 0.5
+
+
+class TestSessionTimeouts(unittest.TestCase):
+    handler_class = TimeoutHandler
+
+    def setUp(self):
+        self.server = TelnetServer(('127.0.0.1', 0), self.handler_class)
+        self.server.timer_wheel = TimerWheel(self.server.call_later, resolution=0.1)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def read_all(self, s):
+        data = b''
+        while True:
+            chunk = s.recv(1024)
+            if not chunk:
+                return data
+            data += chunk
+
+    def test_idle_timeout(self):
+        s = socket.create_connection(self.server.server_address, timeout=5)
+        # Typing keeps the session alive
+        for _ in range(4):
+            time.sleep(0.2)
+            s.sendall(b'x')
+        start = time.monotonic()
+        data = self.read_all(s)
+        self.assertTrue(data.endswith(b'TestServer> xxxx\r\nIdle for too long, disconnecting.\r\n'))
+        self.assertGreater(time.monotonic() - start, 0.3)
+        self.assertEqual(len(self.server.timer_wheel), 0)
+        s.close()
+
+    def test_session_timeout(self):
+        class Handler(ThreadedTelnetHandler):
+            SESSION_TIMEOUT = 0.5
+        self.server.handler_class = Handler
+        s = socket.create_connection(self.server.server_address, timeout=5)
+        # Typing does not extend it
+        for _ in range(2):
+            time.sleep(0.2)
+            s.sendall(b'x')
+        self.assertTrue(self.read_all(s).endswith(b'Session time limit reached, disconnecting.\r\n'))
+        s.close()
+
+    def test_probe(self):
+        class Handler(ThreadedTelnetHandler):
+            PROBE_INTERVAL = 0.2
+        self.server.handler_class = Handler
+        s = socket.create_connection(self.server.server_address, timeout=5)
+        data = b''
+        while data.count(IAC + NOP) < 2:
+            data += s.recv(1024)
+        self.assertTrue(data.endswith(b'TestServer> ' + IAC + NOP + IAC + NOP))
+        s.close()
+
+
+class GreenTimeoutHandler(QueueHandler):
+    IDLE_TIMEOUT = 0.3
+
+
+class TestGreenTimeouts(unittest.TestCase):
+    def test_stalled_client(self):
+        # A client not reading its output holds up neither its own
+        # timeout nor those of the other sessions on the wheel
+        wheel = TimerWheel(gevent.spawn_later, resolution=0.1)
+        handlers, socks = [], []
+        for _ in range(2):
+            server_sock, client_sock = gsocket.socketpair()
+            server_sock.setsockopt(gsocket.SOL_SOCKET, gsocket.SO_SNDBUF, 4096)
+            client_sock.setsockopt(gsocket.SOL_SOCKET, gsocket.SO_RCVBUF, 4096)
+            socks += [server_sock, client_sock]
+            handler = GreenTimeoutHandler(server_sock, 'block')
+            handler.timer_wheel = wheel
+            wheel.schedule(handler.timeouts_next(), handler.timeouts_check)
+            handlers.append(handler)
+        stalled, idle = handlers
+        writer = gevent.spawn(lambda: [stalled.sendcooked(b'x' * 1000) for _ in range(100)])
+        gevent.sleep(1)
+        for handler in handlers:
+            self.assertIsNone(handler.timer_wheel)
+            self.assertFalse(handler.RUNSHELL)
+        self.assertTrue(stalled.eof)
+        self.assertEqual(socks[3].recv(1024), b'\r\nIdle for too long, disconnecting.\r\n')
+        writer.kill()
+        for sock in socks:
+            sock.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
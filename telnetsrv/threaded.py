@@ -0,0 +1,558 @@
+"""
+# Telnet handler concrete class using threads
+"""
+
+import collections
+import heapq
+import itertools
+import logging
+import selectors
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from telnetsrv.utils import chr_py3, str_to_bytes
+from telnetsrv.telnetsrvlib import TelnetHandlerBase, CommandInterrupted, command
+from telnetsrv.timers import TimerWheel
+
+log = logging.getLogger(__name__)
+
+
+class TelnetHandler(TelnetHandlerBase):
+    """A telnet server handler using threads, served by TelnetServer
+
+    One I/O thread cooks the input and sends the output of every
+    session, and runs the line editor at the command prompt.  Logging
+    in and commands run on the server's bounded pool of worker threads,
+    where getc and readline block as usual.  A command waiting for input
+    holds its worker thread; an idle session at the prompt holds none.
+
+    An interrupted command stops as it next writes a line or waits for
+    input.  A command marked executor='thread' runs on the command
+    executor instead, its worker thread waiting for it, and is left
+    behind as soon as it is interrupted.
+    """
+    # Seconds to wait for queued output to be sent as the session ends
+    OUTPUT_CLOSE_TIMEOUT = 5
+    __slots__ = ('lock', 'changed', 'cookedq', 'cookedbuf', 'cookedpos', 'editor',
+                 'job_running', 'started', 'closing', 'closed')
+
+    def __init__(self, sock, client_address, server):
+        self.init_session()
+        self.server = server
+        self.client_address = client_address
+        self.request = self._FalseRequest()
+        self.request._sock = sock
+        # Guards the input queue and the output buffer and queue, which
+        # worker threads share with the I/O thread
+        self.lock = threading.RLock()
+        # Notified as input arrives, as the output drains, as a command
+        # is interrupted or finishes on the command executor and as the
+        # session ends.  Only the session's one worker thread waits on it.
+        self.changed = threading.Condition(self.lock)
+        # Cooked input runs (and key codes), read out through a local buffer
+        self.cookedq = collections.deque()
+        self.cookedbuf = b''
+        self.cookedpos = 0
+        # The command prompt's line editor, while the I/O thread runs it
+        self.editor = None
+        self.job_running = False
+        self.started = False
+        self.closing = False
+        self.closed = False
+
+    # -- Run by the I/O thread --
+
+    def start(self):
+        """Log in on a worker thread, once the options are negotiated
+        or NEGOTIATION_TIMEOUT has passed"""
+        if not self.started and not self.closing:
+            self.started = True
+            self.server.run(self, self.login, wait=True)
+
+    def negotiation_done(self):
+        TelnetHandlerBase.negotiation_done(self)
+        self.start()
+
+    def get_timer_wheel(self):
+        return self.server.timer_wheel
+
+    def lookup_terminfo(self, term, request):
+        """Read the terminal type on a worker thread, then use it on the I/O thread"""
+        future = self.server.executor.submit(self.read_terminfo, term)
+        future.add_done_callback(
+            lambda future: self.server.call_soon(self.terminfo_read, term, future.result(), request))
+
+    def prompt_start(self):
+        """Start reading a command line at the prompt"""
+        self.editor = self.readline_editor(True, str_to_bytes(self.PROMPT), True, True)
+        next(self.editor)
+        self.prompt_feed()
+
+    def prompt_feed(self):
+        """Feed the cooked input to the prompt's line editor, running the
+        command once a line is complete"""
+        while self.editor is not None:
+            c = self.getc(block=False)
+            if not c:
+                break
+            try:
+                self.profiled(self.editor.send, c)
+            except StopIteration as stop:
+                self.editor = None
+                if not self.server.run(self, self.run_command, stop.value):
+                    self.writeerror(self.BUSY_MESSAGE)
+                    self.prompt_start()
+        self.flush()
+
+    def job_done(self, ok):
+        """Back from a worker thread: prompt for the next command or end the session"""
+        self.job_running = False
+        if ok and self.RUNSHELL and not self.eof and not self.closing:
+            self.prompt_start()
+        else:
+            self.close()
+
+    def io_read(self):
+        """Cook the data the client sent"""
+        try:
+            data = self.sock.recv(self.RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error:
+            data = b''
+        if not data:
+            with self.lock:
+                self.eof = 1
+                self.changed.notify_all()
+            self.server.forget(self)
+            if not self.job_running:
+                self.close()
+            return
+        self.inputcooker_feed(data)
+        if self.editor is not None:
+            self.prompt_feed()
+        # Send any negotiation replies
+        self.flush()
+
+    def close(self):
+        """End the session once its output is sent, or after OUTPUT_CLOSE_TIMEOUT"""
+        if self.closing:
+            return
+        self.closing = True
+        self.RUNSHELL = False
+        self.editor = None
+        self.flush()
+        if self.outq and not self.eof:
+            self.server.call_later(self.OUTPUT_CLOSE_TIMEOUT, self.finish)
+        else:
+            self.finish()
+
+    def finish(self):
+        """Called as the session is ending"""
+        if self.closed:
+            return
+        self.closed = True
+        log.debug("Session disconnected.")
+        self.session_registry.discard(self)
+        self.record_session()
+        if self.admission_ticket is not None:
+            self.admission_ticket.release()
+        self.timer_wheel = None
+        if self._history is not None:
+            self._history.flush()
+        self.server.forget(self)
+        with self.lock:
+            self.eof = 1
+            self.changed.notify_all()
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+        self.session_end()
+
+    # -- Run by a worker thread --
+
+    def login(self):
+        """Show the banner and authenticate.
+        Returns False if the session should end."""
+        if self.TELNET_ISSUE:
+            self.writeline(self.TELNET_ISSUE)
+        if not self.authentication_ok():
+            return False
+        if self.admission_ticket is not None:
+            self.admission_ticket.established()
+        if self.HISTORY_STORE is not None:
+            # Load the user's history here, not on the I/O thread
+            self.history
+        if self.DOECHO:
+            self.writeline(self.WELCOME)
+        self.session_start()
+        return True
+
+    # -- Threaded input handling functions --
+
+    def getc(self, block=True):
+        """Return one character from the input buffer, refilled from the
+        input queue when it runs dry.
+        Raise EOFError once the connection is closed and the queue is empty."""
+        with self.lock:
+            if self.cookedpos < len(self.cookedbuf):
+                c = self.cookedbuf[self.cookedpos]
+                self.cookedpos += 1
+                return chr_py3(c)
+            while not self.cookedq:
+                if not block:
+                    return b''
+                if self.eof:
+                    raise EOFError
+                if self.interrupted and self.command_running:
+                    raise CommandInterrupted
+                self.changed.wait()
+            item = self.cookedq.popleft()
+            if type(item) is int:
+                # A key code
+                return item
+            self.cookedbuf = item
+            self.cookedpos = 1
+            return chr_py3(item[0])
+
+    def inputcooker_store_queue(self, char):
+        """Put the cooked data in the input queue"""
+        if type(char) in [type(()), type([])]:
+            char = bytes(char)
+        if char:
+            with self.lock:
+                self.cookedq.append(char)
+                self.changed.notify_all()
+
+    # -- Threaded command execution --
+
+    def cancel_command(self):
+        """Wake up the worker thread, if it is waiting for input or for the
+        command executor"""
+        with self.lock:
+            self.changed.notify_all()
+
+    def wait_command(self, future):
+        """Wait for a command running on the command executor, until it is
+        interrupted"""
+        future.add_done_callback(self.command_done)
+        with self.lock:
+            while not future.done():
+                if self.eof:
+                    raise EOFError
+                if self.interrupted:
+                    raise CommandInterrupted
+                self.changed.wait()
+        return future.result()
+
+    def command_done(self, future):
+        """A command running on the command executor has finished"""
+        with self.lock:
+            self.changed.notify_all()
+
+    # -- Threaded output handling functions --
+
+    def writecooked(self, text):
+        """Put data directly into the output buffer, see TelnetHandlerBase.writecooked"""
+        with self.lock:
+            TelnetHandlerBase.writecooked(self, text)
+
+    def flush(self):
+        """Send the buffered output"""
+        with self.lock:
+            TelnetHandlerBase.flush(self)
+
+    def sendcooked(self, data):
+        """Queue cooked data for the client"""
+        with self.lock:
+            TelnetHandlerBase.sendcooked(self, data)
+
+    def writebroadcast(self, data):
+        """Write out a message broadcast to many sessions on the I/O thread,
+        which never waits for a session's OUTPUT_POLICY, so a session not
+        taking its output does not hold up the others"""
+        self.server.call_soon(self.writemessage_cooked, data)
+
+    def output_discard(self):
+        """Throw away the output not yet sent, releasing any blocked writer"""
+        with self.lock:
+            TelnetHandlerBase.output_discard(self)
+            self.changed.notify_all()
+
+    def output_ready(self):
+        """Send what the socket takes now, and have the I/O thread send the rest"""
+        if self.io_write():
+            self.server.call_soon(self.server.watch_output, self)
+
+    def io_write(self):
+        """Send queued output without blocking.  Returns True if some is left."""
+        with self.lock:
+            while self.outq:
+                data = self.outq[0]
+                try:
+                    sent = self.sock.send(data)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except socket.error:
+                    # The client is gone; the reader will find out
+                    self.output_discard()
+                    self.eof = 1
+                    break
+                self.output_sent(sent)
+                if sent < len(data):
+                    self.outq[0] = memoryview(data)[sent:]
+                    break
+                self.outq.popleft()
+            if self.outq_bytes <= self.OUTPUT_QUEUE_LOW:
+                self.changed.notify_all()
+            return bool(self.outq)
+
+    def output_wait(self):
+        """Wait for the I/O thread to drain the queue to OUTPUT_QUEUE_LOW.
+        The I/O thread itself never waits."""
+        if threading.current_thread() is self.server.io_thread:
+            return
+        with self.lock:
+            while self.outq_bytes > self.OUTPUT_QUEUE_LOW and not self.eof:
+                self.changed.wait()
+
+
+class TelnetServer(object):
+    """Serves a threaded TelnetHandler
+
+    One I/O thread (the one calling serve_forever) accepts connections
+    and does the socket I/O of every session.  Logins and commands run
+    on a pool of max_workers threads.  When queue_depth commands are
+    already waiting for a worker, a new command is answered with the
+    handler's BUSY_MESSAGE instead; logins wait their turn.
+
+    The interface follows socketserver.TCPServer.
+    """
+    allow_reuse_address = True
+    request_queue_size = 128
+    # Default worker threads and waiting commands
+    max_workers = 16
+    queue_depth = 64
+
+    def __init__(self, server_address, handler_class, max_workers=None, queue_depth=None, sock=None):
+        self.handler_class = handler_class
+        if max_workers is not None:
+            self.max_workers = max_workers
+        if queue_depth is not None:
+            self.queue_depth = queue_depth
+        if sock is not None:
+            # Serve a socket already listening, such as one shared by several processes
+            self.socket = sock
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            if self.allow_reuse_address:
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.bind(server_address)
+            self.socket.listen(self.request_queue_size)
+        self.socket.setblocking(False)
+        self.server_address = self.socket.getsockname()
+        self.executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='telnetsrv')
+        self.selector = selectors.DefaultSelector()
+        self.io_thread = None
+        self.jobs = 0
+        # Logins waiting for room in the worker queue
+        self.waiting = collections.deque()
+        self.running = False
+        self.accepting = False
+        self.stopped = threading.Event()
+        # Callbacks for the I/O thread, and the socket pair waking it up
+        self.lock = threading.Lock()
+        self.callbacks = collections.deque()
+        self.timers = []
+        # Checks the timeouts of every session
+        self.timer_wheel = TimerWheel(self.call_later)
+        self.timer_ids = itertools.count()
+        self.waker, self.wakee = socket.socketpair()
+        self.waker.setblocking(False)
+        self.wakee.setblocking(False)
+
+    def serve_forever(self):
+        """Run the I/O thread until shutdown is called"""
+        self.io_thread = threading.current_thread()
+        self.selector.register(self.socket, selectors.EVENT_READ, None)
+        self.selector.register(self.wakee, selectors.EVENT_READ, self)
+        self.accepting = True
+        self.running = True
+        self.stopped.clear()
+        try:
+            while self.running:
+                timeout = None
+                if self.timers:
+                    timeout = max(0, self.timers[0][0] - time.monotonic())
+                for key, mask in self.selector.select(timeout):
+                    if key.data is None:
+                        self.accept()
+                    elif key.data is self:
+                        try:
+                            while self.wakee.recv(4096):
+                                pass
+                        except (BlockingIOError, InterruptedError):
+                            pass
+                    else:
+                        self.handle_events(key.data, mask)
+                self.run_callbacks()
+        finally:
+            self.close_listener()
+            self.selector.unregister(self.wakee)
+            self.stopped.set()
+
+    def shutdown(self):
+        """Stop serve_forever and wait for it to return"""
+        self.running = False
+        self.wake()
+        self.stopped.wait()
+
+    def stop_accepting(self):
+        """Close the listening socket, leaving the sessions running"""
+        self.call_soon(self.close_listener)
+
+    def server_close(self):
+        """Close the listening socket and the sessions"""
+        for key in list(self.selector.get_map().values()):
+            if isinstance(key.data, TelnetHandler):
+                key.data.finish()
+        self.executor.shutdown(wait=False)
+        self.selector.close()
+        self.socket.close()
+        self.waker.close()
+        self.wakee.close()
+
+    # -- Run by the I/O thread --
+
+    def close_listener(self):
+        if self.accepting:
+            self.accepting = False
+            self.selector.unregister(self.socket)
+            self.socket.close()
+
+    def accept(self):
+        """Accept the waiting connections and start their sessions"""
+        while True:
+            try:
+                sock, address = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except socket.error:
+                log.exception("Error accepting a connection")
+                return
+            admission = self.handler_class.admission
+            ticket = None
+            if admission is not None:
+                ticket = admission.admit(address)
+                if ticket is None:
+                    admission.reject(sock)
+                    continue
+            log.debug("Accepted connection, starting telnet session for {}.".format(address))
+            sock.setblocking(False)
+            handler = self.handler_class(sock, address, self)
+            handler.request.admission_ticket = ticket
+            self.selector.register(sock, selectors.EVENT_READ, handler)
+            try:
+                handler.setup()
+            except Exception:
+                log.exception("Error setting up a session")
+                handler.finish()
+                continue
+            if handler.negotiating:
+                self.call_later(handler.NEGOTIATION_TIMEOUT, handler.start)
+            else:
+                handler.start()
+
+    def handle_events(self, handler, mask):
+        try:
+            if mask & selectors.EVENT_WRITE and not handler.closed:
+                if not handler.io_write():
+                    self.selector.modify(handler.sock, selectors.EVENT_READ, handler)
+                    if handler.closing:
+                        handler.finish()
+            if mask & selectors.EVENT_READ and not handler.closed:
+                handler.io_read()
+        except Exception:
+            log.exception("Error in session for %s" % (handler.client_address, ))
+            handler.finish()
+
+    def watch_output(self, handler):
+        """Send the rest of a session's output once the socket takes it"""
+        if handler.outq and not handler.closed and handler.sock in self.selector.get_map():
+            self.selector.modify(handler.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, handler)
+
+    def forget(self, handler):
+        """Stop watching a session's socket"""
+        try:
+            self.selector.unregister(handler.sock)
+        except (KeyError, ValueError):
+            pass
+
+    def run(self, handler, fn, *args, wait=False):
+        """Run fn(*args) for a session on a worker thread, then call its
+        job_done with the result.  Returns False if the queue is full,
+        unless wait is set: then the job runs once there is room."""
+        if self.jobs >= self.max_workers + self.queue_depth:
+            if not wait:
+                return False
+            self.waiting.append((handler, fn, args))
+            return True
+        self.jobs += 1
+        handler.job_running = True
+        self.executor.submit(self.job, handler, fn, args)
+        return True
+
+    def run_callbacks(self):
+        with self.lock:
+            callbacks, self.callbacks = self.callbacks, collections.deque()
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            callbacks.append((heapq.heappop(self.timers)[2], ()))
+        for callback, args in callbacks:
+            try:
+                callback(*args)
+            except Exception:
+                log.exception("Error calling %r" % (callback, ))
+
+    def job_done(self, handler, ok):
+        self.jobs -= 1
+        if not handler.closed:
+            handler.job_done(ok)
+        while self.waiting and self.jobs < self.max_workers + self.queue_depth:
+            handler, fn, args = self.waiting.popleft()
+            if not handler.closing:
+                self.run(handler, fn, *args)
+
+    def call_later(self, delay, callback):
+        """Call callback on the I/O thread after delay seconds"""
+        heapq.heappush(self.timers, (time.monotonic() + delay, next(self.timer_ids), callback))
+
+    # -- Run by any thread --
+
+    def job(self, handler, fn, args):
+        ok = False
+        try:
+            ok = fn(*args)
+        except EOFError:
+            pass
+        except Exception:
+            log.exception("Error in session for %s" % (handler.client_address, ))
+        try:
+            handler.flush()
+        except socket.error:
+            pass
+        self.call_soon(self.job_done, handler, ok)
+
+    def call_soon(self, callback, *args):
+        """Call callback(*args) on the I/O thread"""
+        with self.lock:
+            self.callbacks.append((callback, args))
+        self.wake()
+
+    def wake(self):
+        try:
+            self.waker.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            pass
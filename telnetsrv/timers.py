@@ -0,0 +1,75 @@
+"""
+A timer wheel shared by the sessions of a server.
+
+Each backend keeps one TimerWheel for all of its sessions, ticking on
+the loop (or I/O thread) that runs them, rather than a timer per
+session.  The sessions use it to check their idle and session time
+limits and to send keepalive probes.
+"""
+
+import logging
+import math
+import time
+
+log = logging.getLogger(__name__)
+
+
+class TimerWheel(object):
+    """A hashed timer wheel.
+
+    Callbacks land in one of slots buckets, resolution seconds apart,
+    and are run by the tick at or after their time, so they may run up
+    to resolution seconds late.  One further away than a turn of the
+    wheel waits in its bucket for the later turns.
+
+    call_later(delay, callback) runs callback on the loop owning the
+    wheel; the wheel uses it to tick while it holds any callbacks.
+    Not thread safe: schedule from the loop owning the wheel.
+    """
+    def __init__(self, call_later, resolution=1.0, slots=512):
+        self.call_later = call_later
+        self.resolution = resolution
+        self.slots = [[] for _ in range(slots)]
+        self.index = 0
+        # The time of the current slot
+        self.time = time.monotonic()
+        self.count = 0
+        self.ticking = False
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, when, callback):
+        """Call callback(now) at time.monotonic() time when"""
+        if not self.count:
+            # Idle wheels do not tick; catch up
+            self.time = time.monotonic()
+        ticks = max(1, int(math.ceil((when - self.time) / self.resolution)))
+        self.slots[(self.index + ticks) % len(self.slots)].append((when, callback))
+        self.count += 1
+        if not self.ticking:
+            self.ticking = True
+            self.call_later(self.resolution, self.tick)
+
+    def tick(self):
+        """Run the callbacks that are due"""
+        now = time.monotonic()
+        while self.time + self.resolution <= now:
+            self.time += self.resolution
+            self.index = (self.index + 1) % len(self.slots)
+            slot = self.slots[self.index]
+            if not slot:
+                continue
+            due = [entry for entry in slot if entry[0] <= now]
+            if due:
+                slot[:] = [entry for entry in slot if entry[0] > now]
+                self.count -= len(due)
+                for when, callback in due:
+                    try:
+                        callback(now)
+                    except Exception:
+                        log.exception("Error calling %r" % (callback, ))
+        if self.count:
+            self.call_later(self.resolution, self.tick)
+        else:
+            self.ticking = False
@@ -1,3 +1,4 @@
+from collections.abc import AsyncIterator, Iterator
 from typing import Union
 
 
@@ -27,3 +28,10 @@ def bytes_to_str(text):
         return text.decode('latin-1')
     else:
         return text
+
+
+def is_lines(result):
+    """Is what a command returned lines to page: a list, a tuple or an
+    iterator such as a generator?  Any other value, a str or bytes
+    included, is not written."""
+    return isinstance(result, (list, tuple, Iterator, AsyncIterator))